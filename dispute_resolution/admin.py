@@ -1,3 +1,4 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.models import Group
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
@@ -5,8 +6,10 @@ from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
-from .forms import UserAdminCreationForm, UserAdminChangeForm
-from .models import User, ContractCase, UserInfo, ContractStage, NotifyEvent
+from .forms import UserAdminCreationForm, UserAdminChangeForm, \
+    VersionedModelForm
+from .models import User, ContractCase, UserInfo, ContractStage, \
+    NotifyEvent, ConcurrentUpdateError, Job
 
 
 class UserInfoInline(admin.StackedInline):
@@ -81,7 +84,30 @@ admin.site.register(User, UserAdmin)
 admin.site.unregister(Group)
 
 
-class ContractStageInline(admin.StackedInline):
+class VersionedAdminMixin:
+    """
+    Forms of a ``VersionedModel`` carry the version they were rendered
+    with in a hidden field, so saving over a change made meanwhile fails
+    validation and the form is shown again, with the edits and an error,
+    instead of overwriting that change.
+    """
+    form = VersionedModelForm
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name == 'version':
+            kwargs['widget'] = forms.HiddenInput
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+    def changeform_view(self, request, *args, **kwargs):
+        try:
+            return super().changeform_view(request, *args, **kwargs)
+        except ConcurrentUpdateError:
+            # changed between validation and saving: validating again
+            # shows the form with the conflict
+            return super().changeform_view(request, *args, **kwargs)
+
+
+class ContractStageInline(VersionedAdminMixin, admin.StackedInline):
     model = ContractStage
 
 
@@ -137,22 +163,27 @@ def admin_link(attr, short_description, many=False, empty_description="-"):
     return wrap
 
 
-class ContractStageAdmin(admin.ModelAdmin):
+class ContractStageAdmin(VersionedAdminMixin, admin.ModelAdmin):
     list_display = ('__str__', 'owner_link', 'case_link',
                     'dispute_started', 'dispute_finished',
                     'dispute_starter')
     list_filter = ('start', 'dispute_start_allowed', 'dispute_started',
-                   'dispute_finished')
+                   'dispute_finished', 'result_verification')
+    list_select_related = ('owner', 'contract', 'dispute_starter')
 
     readonly_fields = ('owner', 'dispute_started', 'contract',
                        'dispute_start_allowed', 'start', 'dispute_starter',
-                       'dispute_finished', 'result_file')
+                       'dispute_finished', 'result_file', 'result_hash',
+                       'result_verification', 'result_verified_at')
 
     fieldsets = (
         (None, {'fields': ('owner', 'start', 'contract',
-                           'dispute_start_allowed')}),
+                           'dispute_start_allowed', 'version')}),
         ('State', {'fields': ('dispute_started', 'dispute_starter',
                               'dispute_finished', 'result_file')}),
+        ('Result verification', {'fields': ('result_hash',
+                                            'result_verification',
+                                            'result_verified_at')}),
     )
     search_fields = ('start', 'dispute_start_allowed',
                      'contract__party__email',
@@ -180,7 +211,7 @@ class UserInline(admin.StackedInline):
     model = ContractCase.party.through
 
 
-class ContractCaseAdmin(admin.ModelAdmin):
+class ContractCaseAdmin(VersionedAdminMixin, admin.ModelAdmin):
     inlines = [
         UserInline,
         ContractStageInline,
@@ -194,7 +225,7 @@ class ContractCaseAdmin(admin.ModelAdmin):
     readonly_fields = ('party', 'files', 'stages', 'finished')
 
     fieldsets = (
-        (None, {'fields': ('name', 'files')}),
+        (None, {'fields': ('name', 'files', 'version')}),
     )
     search_fields = ('files', 'name',
                      'stages__dispute_start_allowed',
@@ -203,6 +234,10 @@ class ContractCaseAdmin(admin.ModelAdmin):
                      'party__info__tax_num', 'party__info__payment_num',
                      'party__info__eth_account')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('party',
+                                                              'stages')
+
     @admin_link('party', 'Participants', True)
     def party_link(self, user):
         return str(user)
@@ -217,14 +252,18 @@ admin.site.register(ContractCase, ContractCaseAdmin)
 
 class NotifyEventAdmin(admin.ModelAdmin):
     list_display = ('pk', 'event_type', 'case_link', 'stage_link',
-                    'user_by_link', 'user_to_link', 'seen')
+                    'user_by_link', 'audience', 'user_to_link',
+                    'notify_judges')
     list_display_links = ('pk', 'event_type')
-    list_filter = ('event_type', 'seen')
+    list_filter = ('event_type', 'audience', 'notify_judges')
+    list_select_related = ('user_by', 'user_to', 'contract',
+                           'stage__contract')
 
     readonly_fields = ('user_by', 'user_to', 'event_type', 'contract', 'stage')
 
     fieldsets = (
-        (None, {'fields': ('event_type', 'user_by', 'user_to', 'seen')}),
+        (None, {'fields': ('event_type', 'user_by', 'audience', 'user_to',
+                           'notify_judges')}),
         ('Case', {'fields': ('contract', 'stage')}),
     )
     search_fields = ('event_type',
@@ -259,3 +298,14 @@ class NotifyEventAdmin(admin.ModelAdmin):
 
 
 admin.site.register(NotifyEvent, NotifyEventAdmin)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'task', 'status', 'priority', 'attempts',
+                    'run_after', 'locked_by')
+    list_filter = ('status', 'task')
+    readonly_fields = ('task', 'args', 'attempts', 'locked_by', 'locked_at',
+                       'last_error', 'created')
+
+
+admin.site.register(Job, JobAdmin)
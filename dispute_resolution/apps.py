@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class DisputeResolutionConfig(AppConfig):
     name = 'dispute_resolution'
+
+    def ready(self):
+        from dispute_resolution import signals  # noqa: F401
+        from dispute_resolution.db import configure_sqlite_connection
+        from dispute_resolution.slowlog import install
+        connection_created.connect(configure_sqlite_connection,
+                                   dispatch_uid='drm_sqlite_pragmas')
+        connection_created.connect(install, dispatch_uid='drm_slow_queries')
@@ -0,0 +1,278 @@
+"""
+ASGI application.
+
+Django 2.2 has neither an ASGI handler nor an async ORM, so both halves
+live here. The hottest read endpoints (``users/self``, the ``/events/``
+list and contract detail) are served natively: the request is received,
+bearer tokens found in the token cache are resolved, the response is
+rendered to JSON and sent on the event loop, and only the view itself
+(ORM queries and serialization) runs in a pool of ``ASGI_THREADS``
+threads. Every other request goes to the regular WSGI application in the
+same pool, with the body spooled before and the response streamed after,
+so a slow client never holds a thread while it uploads or downloads.
+"""
+import asyncio
+import logging
+import re
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.handlers.exception import response_for_exception
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections, connections
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.common import CommonMiddleware
+from django.middleware.security import SecurityMiddleware
+from django.utils.cache import patch_vary_headers
+
+from dispute_resolution import metrics
+from dispute_resolution.authentication import BearerTokenAuthentication
+from dispute_resolution.middleware import SessionUserMiddleware, \
+    add_debug_headers
+from dispute_resolution.viewsets import UserViewSet, NotifyEventViewSet, \
+    ContractCaseViewSet
+
+
+logger = logging.getLogger(__name__)
+
+# (path, viewset, action) served without the WSGI stack
+ASYNC_ROUTES = (
+    (re.compile(r'^/users/self/$'), UserViewSet, 'self'),
+    (re.compile(r'^/events/$'), NotifyEventViewSet, 'list'),
+    (re.compile(r'^/contracts/(?P<pk>[^/.]+)/$'), ContractCaseViewSet,
+     'retrieve'),
+)
+
+
+def build_environ(scope, body, size):
+    """A WSGI environ for an ASGI HTTP ``scope`` and its spooled body."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    # the body is complete, whatever the client announced
+    environ['CONTENT_LENGTH'] = str(size)
+    return environ
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers]
+
+
+class ASGIHandler:
+    response_middleware = (XFrameOptionsMiddleware, CommonMiddleware,
+                           CorsMiddleware, SecurityMiddleware)
+
+    def __init__(self, wsgi_application):
+        self.wsgi_application = wsgi_application
+        self.response_middleware = [middleware()
+                                    for middleware in self.response_middleware]
+        self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(
+                'Unsupported ASGI scope type {}'.format(scope['type']))
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        try:
+            size = body.tell()
+            body.seek(0)
+            route = self.match(scope)
+            if route is None:
+                await self.serve_wsgi(scope, body, size, send)
+            else:
+                await self.serve_view(*route, scope, body, size, send)
+        finally:
+            body.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """Spool the request body; None if the client went away."""
+        body = tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                return body
+
+    def match(self, scope):
+        # query strings may carry filters or ?format=api, and browsers get
+        # the browsable API: both stay on the full WSGI path
+        if scope['method'] != 'GET' or scope.get('query_string'):
+            return None
+        for name, value in scope.get('headers', ()):
+            if name == b'accept' and b'text/html' in value:
+                return None
+        for pattern, view_class, action in ASYNC_ROUTES:
+            match = pattern.match(scope['path'])
+            if match:
+                return view_class, action, match.groupdict()
+        return None
+
+    async def run(self, func, *args):
+        """Run blocking ``func`` in the thread pool (inline if disabled)."""
+        if not settings.ASGI_THREADS:
+            return func(*args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=settings.ASGI_THREADS,
+                thread_name_prefix='drm-asgi')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def serve_view(self, view_class, action, kwargs, scope, body, size,
+                         send):
+        stats = metrics.RequestStats()
+        stats.view = '{}.{}'.format(view_class.__name__, action)
+        request = WSGIRequest(build_environ(scope, body, size))
+        SessionMiddleware().process_request(request)
+        SessionUserMiddleware().process_request(request)
+
+        credentials = None
+        if issubclass(view_class.authentication_classes[0],
+                      BearerTokenAuthentication):
+            credentials = view_class.authentication_classes[0]() \
+                .authenticate_cached(request)
+        try:
+            view, drf_request, response = await self.run(
+                self.call_view, stats, view_class, action, request, kwargs,
+                credentials)
+            response = view.finalize_response(drf_request, response)
+            response.render()
+        except Exception as exc:
+            response = await self.run(response_for_exception, request, exc)
+
+        if getattr(request, 'session', None) is not None and \
+                request.session.accessed:
+            patch_vary_headers(response, ('Cookie',))
+        for middleware in self.response_middleware:
+            response = middleware.process_response(request, response)
+        latency = stats.latency
+        metrics.record(stats, latency)
+        if settings.METRICS_DEBUG_HEADERS:
+            add_debug_headers(response, stats, latency)
+
+        headers = encode_headers(response.items())
+        for cookie in response.cookies.values():
+            headers.append((b'set-cookie',
+                            cookie.output(header='').strip().encode('ascii')))
+        await send({'type': 'http.response.start',
+                    'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.content})
+
+    def call_view(self, stats, view_class, action, request, kwargs,
+                  credentials):
+        """
+        ``APIView.dispatch`` up to the rendering: authentication,
+        permissions and the action itself. ``credentials`` found on the
+        event loop skip the authenticators.
+        """
+        with self.request_context(stats):
+            view = view_class(action=action, action_map={'get': action},
+                              args=(), kwargs=kwargs, format_kwarg=None)
+            drf_request = view.initialize_request(request, **kwargs)
+            if credentials is not None:
+                drf_request.user, drf_request.auth = credentials
+            view.request = drf_request
+            view.headers = view.default_response_headers
+            try:
+                view.initial(drf_request, **kwargs)
+                response = getattr(view, action)(drf_request, **kwargs)
+            except Exception as exc:
+                response = view.handle_exception(exc)
+            return view, drf_request, response
+
+    @contextmanager
+    def request_context(self, stats):
+        pooled = bool(settings.ASGI_THREADS)
+        if pooled:
+            close_old_connections()
+        metrics.start_request(stats)
+        try:
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(
+                        conn.execute_wrapper(stats.execute_wrapper))
+                yield
+        finally:
+            metrics.finish_request()
+            if pooled:
+                close_old_connections()
+
+    async def serve_wsgi(self, scope, body, size, send):
+        environ = build_environ(scope, body, size)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        def call():
+            result = self.wsgi_application(environ, start_response)
+            return result, iter(result)
+
+        result, chunks = await self.run(call)
+        try:
+            # start_response may be deferred to the first chunk
+            chunk = await self.run(next, chunks, None)
+            await send({'type': 'http.response.start',
+                        'status': started['status'],
+                        'headers': encode_headers(started['headers'])})
+            while chunk is not None:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+                chunk = await self.run(next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                await self.run(close)
@@ -0,0 +1,153 @@
+"""
+Signed bearer tokens with an in-process lookup cache.
+
+A token is a timestamped signature of the user id and the user's session
+auth hash (derived from the password hash), so it needs no table and is
+invalidated by a password change. Verified tokens are kept in an LRU cache
+for ``TOKEN_CACHE_TTL`` seconds; saving or deleting a user drops its
+entries in this process, other worker processes pick the change up once
+their entry expires. Every request gets its own copy of a cached user.
+
+Users of browser sessions are memoized the same way by session key in
+``session_user_cache`` (see ``middleware.SessionUserMiddleware``).
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core import signing
+from django.utils.crypto import constant_time_compare
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, \
+    get_authorization_header
+
+from dispute_resolution.models import User
+
+
+TOKEN_SALT = 'dispute_resolution.authentication.token'
+
+
+def issue_token(user):
+    return signing.dumps({'id': user.pk, 'h': user.get_session_auth_hash()},
+                         salt=TOKEN_SALT)
+
+
+class TokenCache:
+    """
+    Thread-safe LRU of token (or session key) -> user with a time-to-live
+    per entry.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.monotonic():
+                self._discard(token)
+                return None
+            self._entries.move_to_end(token)
+            return user
+
+    def put(self, token, user):
+        with self._lock:
+            self._entries[token] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token)
+            self._by_user.setdefault(user.pk, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def revoke_user(self, user_id):
+        with self._lock:
+            for token in self._by_user.pop(user_id, ()):
+                self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def _discard(self, token):
+        user, _ = self._entries.pop(token)
+        tokens = self._by_user.get(user.pk)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_user[user.pk]
+
+
+token_cache = TokenCache(getattr(settings, 'TOKEN_CACHE_SIZE', 10000),
+                         getattr(settings, 'TOKEN_CACHE_TTL', 60))
+session_user_cache = TokenCache(
+    getattr(settings, 'SESSION_USER_CACHE_SIZE', 10000),
+    getattr(settings, 'SESSION_USER_CACHE_TTL', 60))
+
+
+class BearerTokenAuthentication(BaseAuthentication):
+    """
+    Authenticates ``Authorization: Bearer <token>`` headers issued by
+    ``issue_token``; a cache hit costs no query and no password hashing.
+    """
+    keyword = b'bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword:
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+
+        user = token_cache.get(token)
+        if user is None:
+            user = self._load_user(token)
+            token_cache.put(token, copy.deepcopy(user))
+        else:
+            user = copy.deepcopy(user)
+        return user, token
+
+    def authenticate_cached(self, request):
+        """
+        Like ``authenticate`` but only answers from the token cache, so it
+        never touches the database; None means "ask ``authenticate``".
+        """
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() != self.keyword:
+            return None
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            return None
+        user = token_cache.get(token)
+        return None if user is None else (copy.deepcopy(user), token)
+
+    def authenticate_header(self, request):
+        return 'Bearer'
+
+    def _load_user(self, token):
+        try:
+            payload = signing.loads(token, salt=TOKEN_SALT,
+                                    max_age=settings.TOKEN_MAX_AGE)
+        except signing.SignatureExpired:
+            raise exceptions.AuthenticationFailed('Token has expired.')
+        except signing.BadSignature:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        user = User.objects.select_related('info') \
+            .filter(pk=payload.get('id')).first()
+        if user is None or not user.is_active or not constant_time_compare(
+                payload.get('h', ''), user.get_session_auth_hash()):
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        return user
@@ -0,0 +1,162 @@
+"""
+Local content-addressed blob store.
+
+Files live under ``BLOB_STORE_ROOT/<aa>/<bb>/<sha256>`` and are written
+once: an upload is streamed into a temporary file while it is hashed and
+then renamed into place, so identical documents uploaded for different
+cases share one file. ``ContractCase.files``, ``UserInfo.files`` and
+``ContractStage.result_file`` reference blobs by their hex sha256; the
+``Blob.refcount`` of every referenced blob is kept up to date by
+``adjust_refcounts``.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from dispute_resolution.models import Blob, ContractCase, UserInfo, \
+    ContractStage
+
+
+BLOB_REF_RE = re.compile(r'\b[0-9a-f]{64}\b')
+
+# model -> field whose value references blobs
+BLOB_REF_FIELDS = {
+    ContractCase: 'files',
+    UserInfo: 'files',
+    ContractStage: 'result_file',
+}
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobStore:
+    def __init__(self, root, chunk_size, max_size=None):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def save(self, stream):
+        """
+        Store everything readable from ``stream`` and return its sha256 hex
+        digest and size. Memory use is bounded by the chunk size.
+        """
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_size is not None and size > self.max_size:
+                        raise BlobTooLarge(size)
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+            digest = sha256.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest, size
+
+    def iter_range(self, digest, start=0, length=None):
+        """Yield ``length`` bytes (all by default) from ``start`` in chunks."""
+        with open(self.path(digest), 'rb') as blob:
+            blob.seek(start)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = self.chunk_size if remaining is None else \
+                    min(self.chunk_size, remaining)
+                chunk = blob.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, digest):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+
+def get_store():
+    return BlobStore(settings.BLOB_STORE_ROOT, settings.BLOB_CHUNK_SIZE,
+                     settings.BLOB_MAX_SIZE)
+
+
+def blob_refs(value):
+    """The set of blob digests referenced from a field value."""
+    return set(BLOB_REF_RE.findall(value)) if value else set()
+
+
+def adjust_refcounts(added=(), removed=()):
+    """
+    Add one reference per digest in ``added`` and drop one per digest in
+    ``removed``; a digest may appear several times in either.
+    """
+    delta = Counter(added)
+    delta.subtract(Counter(removed))
+    by_change = defaultdict(list)
+    for digest, change in delta.items():
+        if change:
+            by_change[change].append(digest)
+    for change, digests in by_change.items():
+        Blob.objects.filter(sha256__in=digests).update(
+            refcount=Greatest(F('refcount') + change, 0))
+
+
+def count_refs(digest):
+    """The number of references to ``digest`` in the referencing fields."""
+    count = 0
+    for model, field in BLOB_REF_FIELDS.items():
+        values = model.objects.filter(**{field + '__contains': digest}) \
+            .values_list(field, flat=True)
+        count += sum(1 for value in values if digest in blob_refs(value))
+    return count
+
+
+def recount_refs():
+    """
+    Recompute every ``Blob.refcount`` from the referencing fields, to
+    repair counts after writes that bypassed the model signals.
+    """
+    counts = Counter()
+    for model, field in BLOB_REF_FIELDS.items():
+        values = model.objects.exclude(**{field + '__isnull': True}) \
+            .values_list(field, flat=True)
+        for value in values.iterator():
+            counts.update(blob_refs(value))
+    by_count = defaultdict(list)
+    for digest, count in counts.items():
+        by_count[count].append(digest)
+    Blob.objects.exclude(refcount=0).update(refcount=0)
+    for count, digests in by_count.items():
+        for start in range(0, len(digests), 500):
+            Blob.objects.filter(sha256__in=digests[start:start + 500]) \
+                .update(refcount=count)
@@ -0,0 +1,34 @@
+"""
+Bulk insert helpers shared by the bulk API endpoints and import commands.
+"""
+from django.db import connections, router
+from django.db.models import Max
+
+
+def bulk_insert(model, objs, batch_size=None):
+    """
+    ``bulk_create`` that always leaves primary keys on ``objs``.
+
+    Backends that return ids from bulk inserts are used as is. SQLite does
+    not (on the Django versions we support), so there the ids are derived
+    instead: the call must run inside ``transaction.atomic()``, which makes
+    this connection hold the database write lock from its first INSERT to
+    the commit, so the new rows got consecutive ids ending at the current
+    maximum.
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+    alias = router.db_for_write(model)
+    connection = connections[alias]
+    model.objects.using(alias).bulk_create(objs, batch_size=batch_size)
+    if objs[0].pk is not None:
+        return objs
+    if connection.vendor != 'sqlite' or not connection.in_atomic_block:
+        raise RuntimeError('bulk_insert() cannot recover the ids of {} '
+                           'outside an SQLite transaction'.format(
+                               model.__name__))
+    last = model.objects.using(alias).aggregate(last=Max('pk'))['last']
+    for pk, obj in enumerate(objs, start=last - len(objs) + 1):
+        obj.pk = pk
+    return objs
@@ -0,0 +1,71 @@
+"""
+Per-user case counters for ``users/self/overview``.
+
+``CaseCounters`` rows are recomputed for the users concerned whenever a
+case gains or loses parties, changes its ``finished`` state or one of its
+stages starts or ends a dispute (see ``signals``). Bulk writes bypassing
+the model signals call ``schedule_refresh`` themselves. The refresh is a
+``refresh_counters`` job: by default it runs inline, with ``JOBS_ASYNC``
+on it runs on the ``run_workers`` processes and counters may lag behind
+for a moment.
+"""
+from django.db import transaction
+from django.db.models import Count, Q
+
+from dispute_resolution.jobs import enqueue, task
+from dispute_resolution.models import CaseCounters, ContractCase, User
+
+
+# user ids per aggregate query
+BATCH_SIZE = 500
+STATES = {'open': 0, 'pending': 1, 'finished': 2}
+
+
+def case_users(case_ids):
+    """Ids of the parties of the cases ``case_ids``."""
+    return set(ContractCase.party.through.objects
+               .filter(contractcase_id__in=case_ids)
+               .values_list('user_id', flat=True))
+
+
+def active_dispute(stage):
+    return stage.dispute_started is not None and \
+        stage.dispute_finished is None
+
+
+def _counts(user_ids):
+    counts = {name: Count('contracts', filter=Q(contracts__finished=state),
+                          distinct=True)
+              for name, state in STATES.items()}
+    counts['disputes'] = Count(
+        'contracts__stages', distinct=True,
+        filter=Q(contracts__stages__dispute_started__isnull=False,
+                 contracts__stages__dispute_finished__isnull=True))
+    return User.objects.filter(pk__in=user_ids).order_by() \
+        .values('pk').annotate(**counts)
+
+
+@task(priority=10)
+def refresh_counters(user_ids):
+    """Recompute the counters of ``user_ids``: three statements a batch."""
+    user_ids = sorted(set(user_ids))
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        batch = user_ids[start:start + BATCH_SIZE]
+        rows = [CaseCounters(user_id=row.pop('pk'), **row)
+                for row in _counts(batch)]
+        with transaction.atomic(savepoint=False):
+            CaseCounters.objects.filter(user_id__in=batch).delete()
+            CaseCounters.objects.bulk_create(rows)
+
+
+def schedule_refresh(user_ids):
+    user_ids = sorted(set(user_ids))
+    if user_ids:
+        enqueue('refresh_counters', user_ids)
+
+
+def counters(user):
+    """The counters of ``user`` as a dict; zeros if they have none yet."""
+    row = CaseCounters.objects.filter(user_id=user.pk) \
+        .values(*STATES, 'disputes').first()
+    return row or dict.fromkeys(tuple(STATES) + ('disputes',), 0)
@@ -0,0 +1,108 @@
+"""
+Database helpers for the single-node SQLite production profile.
+
+``configure_sqlite_connection`` is connected to ``connection_created`` and
+applies ``settings.SQLITE_PRAGMAS`` to every new SQLite connection.
+``run_serialized_write`` routes a write through one writer thread per
+process when ``settings.SQLITE_SERIALIZED_WRITER`` is on, so concurrent
+requests queue in Python instead of fighting over the database lock.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    """Apply the configured pragmas to a freshly opened SQLite connection."""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None) or {}
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+    if pragmas:
+        logger.debug('Applied SQLite pragmas %s to %s', pragmas,
+                     connection.alias)
+
+
+class SerializedWriter:
+    """
+    Executes write callables one at a time on a dedicated thread.
+
+    Every callable runs inside its own ``transaction.atomic()`` block on the
+    writer thread's connection; callers wait on the returned future.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._ensure_started()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def is_current(self):
+        return threading.current_thread() is self._thread
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='drm-sqlite-writer',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            close_old_connections()
+            try:
+                with transaction.atomic():
+                    result = func(*args, **kwargs)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+        connection.close()
+
+
+writer = SerializedWriter()
+
+
+def run_serialized_write(func, *args, **kwargs):
+    """
+    Run ``func`` through the process-wide writer when it is enabled.
+
+    Falls back to a plain inline call when the writer is disabled, when
+    the caller is already inside a transaction, whose rows the writer
+    thread could not see, or when the caller is the writer thread itself,
+    e.g. in an ``on_commit`` callback of a write, which would otherwise
+    wait on itself.
+    """
+    if not getattr(settings, 'SQLITE_SERIALIZED_WRITER', False) or \
+            connection.in_atomic_block or writer.is_current():
+        return func(*args, **kwargs)
+    return writer.submit(func, *args, **kwargs).result()
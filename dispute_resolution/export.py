@@ -0,0 +1,167 @@
+"""
+Streaming export of contract cases for audits and reconciliation.
+
+Cases are read in keyset chunks (``id > last id``, ``CHUNK_SIZE`` at a
+time), with one query apiece for the stages, party accounts and events of
+a chunk, and written out as JSON lines or CSV, optionally gzipped on the
+fly. Memory use depends on the chunk size, not on the number of cases.
+
+An export covers the cases with ``since < id <= until``, ``until`` being
+the newest case when it starts; passing it as ``since`` to the next
+export only exports the cases created in between. Cases exported before
+change later, as stages and events are added to them: with
+``stages_since`` and ``events_since``, the newest stage and event ids of
+the previous export (see ``changes_until``), the older cases with a newer
+stage or event are exported again, with all their stages and events.
+"""
+import csv
+import io
+import json
+import zlib
+from collections import defaultdict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from dispute_resolution.models import ContractCase, ContractStage, \
+    NotifyEvent
+
+
+CHUNK_SIZE = 500
+# bytes handed to the response (or the compressor) at a time
+BLOCK_SIZE = 64 * 1024
+FORMATS = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+
+CASE_FIELDS = ('id', 'name', 'finished', 'files')
+STAGE_FIELDS = ('id', 'start', 'owner_id', 'dispute_start_allowed',
+                'dispute_started', 'dispute_finished', 'dispute_starter_id',
+                'result_file', 'result_hash', 'result_verification',
+                'result_verified_at')
+EVENT_FIELDS = ('id', 'creation_date', 'stage_id', 'event_type',
+                'user_by_id', 'audience', 'user_to_id', 'notify_judges')
+CSV_COLUMNS = CASE_FIELDS + ('parties', 'stages', 'events')
+
+
+def export_until():
+    """The id of the newest case, the upper bound of a new export."""
+    return ContractCase.objects.order_by('-pk') \
+        .values_list('pk', flat=True).first() or 0
+
+
+def changes_until():
+    """
+    The ids of the newest stage and event: the ``stages_since`` and
+    ``events_since`` of the next export.
+    """
+    return tuple(model.objects.order_by('-pk')
+                 .values_list('pk', flat=True).first() or 0
+                 for model in (ContractStage, NotifyEvent))
+
+
+def _changed_cases(since, stages_since, events_since):
+    """Cases above ``since`` or with stages or events above the others."""
+    rule = Q(pk__gt=since)
+    if stages_since is not None:
+        rule |= Q(pk__in=ContractStage.objects.filter(pk__gt=stages_since)
+                  .values('contract_id'))
+    if events_since is not None:
+        rule |= Q(pk__in=NotifyEvent.objects.filter(pk__gt=events_since)
+                  .values('contract_id'))
+    return ContractCase.objects.filter(rule)
+
+
+def _by_case(rows):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row.pop('contract_id')].append(row)
+    return grouped
+
+
+def iter_cases(since=0, until=None, chunk_size=CHUNK_SIZE,
+               stages_since=None, events_since=None):
+    """
+    Yield the cases with ``since < id <= until``, and those up to
+    ``until`` with stages or events above ``stages_since`` or
+    ``events_since``, as dicts, oldest first, with the eth accounts of
+    their parties, their stages and events.
+    """
+    if until is None:
+        until = export_until()
+    Membership = ContractCase.party.through
+    changed = _changed_cases(since, stages_since, events_since)
+    last = 0 if stages_since is not None or events_since is not None \
+        else since
+    while True:
+        cases = list(changed
+                     .filter(pk__gt=last, pk__lte=until).order_by('pk')
+                     .values(*CASE_FIELDS)[:chunk_size])
+        if not cases:
+            return
+        ids = [case['id'] for case in cases]
+        parties = defaultdict(list)
+        for case_id, account in Membership.objects \
+                .filter(contractcase_id__in=ids) \
+                .order_by('contractcase_id', 'user_id') \
+                .values_list('contractcase_id', 'user__info__eth_account'):
+            parties[case_id].append(account)
+        stages = _by_case(ContractStage.objects
+                          .filter(contract_id__in=ids).order_by('pk')
+                          .values('contract_id', *STAGE_FIELDS))
+        events = _by_case(NotifyEvent.objects
+                          .filter(contract_id__in=ids).order_by('pk')
+                          .values('contract_id', *EVENT_FIELDS))
+        for case in cases:
+            case['parties'] = parties[case['id']]
+            case['stages'] = stages[case['id']]
+            case['events'] = events[case['id']]
+            yield case
+        last = ids[-1]
+
+
+def _to_json(value):
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+def _lines(cases, fmt):
+    if fmt == 'jsonl':
+        for case in cases:
+            yield _to_json(case) + '\n'
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for case in cases:
+        writer.writerow([case[name] for name in CASE_FIELDS] + [
+            ' '.join(account or '' for account in case['parties']),
+            _to_json(case['stages']), _to_json(case['events'])])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _blocks(lines):
+    block, size = [], 0
+    for line in lines:
+        data = line.encode()
+        block.append(data)
+        size += len(data)
+        if size >= BLOCK_SIZE:
+            yield b''.join(block)
+            block, size = [], 0
+    if block:
+        yield b''.join(block)
+
+
+def _gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encode(cases, fmt='jsonl', gzip=False):
+    """Yield ``cases`` as JSON lines or CSV, in blocks of bytes."""
+    blocks = _blocks(_lines(cases, fmt))
+    return _gzipped(blocks) if gzip else blocks
@@ -0,0 +1,119 @@
+"""
+Per-user "seen" state of notifications.
+
+An event is stored once for all of its recipients (see ``NotifyEvent``),
+so whether a recipient has seen it is kept per user: every event of a
+user's feed up to their ``EventWatermark`` is seen, above it a sparse
+``EventReceipt`` row marks each seen event. Marking events seen moves the
+watermark over the seen head of the feed and drops the receipts below it,
+so a user only has receipts for events seen out of order.
+
+Events entering a feed below its watermark later, e.g. those of a case a
+user joins, count as seen.
+
+Watermarks and receipts are kept on the shard of the user (see
+``sharding``), so the writes of a user are atomic on that database.
+"""
+from django.db import transaction
+from django.db.models import Count, Max
+
+from dispute_resolution.models import EventReceipt, EventWatermark, \
+    NotifyEvent
+from dispute_resolution.sharding import shard_for
+
+
+def watermark(user):
+    return EventWatermark.objects.for_user(user.pk) \
+        .values_list('event_id', flat=True).first() or 0
+
+
+def _receipts(user, mark):
+    return EventReceipt.objects.for_user(user.pk) \
+        .filter(event_id__gt=mark).values_list('event_id', flat=True)
+
+
+def seen_ids(user, event_ids):
+    """The ids among ``event_ids`` that ``user`` has seen."""
+    event_ids = set(event_ids)
+    if not event_ids:
+        return set()
+    mark = watermark(user)
+    seen = {pk for pk in event_ids if pk <= mark}
+    if seen != event_ids:
+        seen.update(_receipts(user, mark).filter(
+            event_id__in=event_ids - seen))
+    return seen
+
+
+def unseen(user):
+    """The events of the feed of ``user`` they have not seen yet."""
+    mark = watermark(user)
+    return NotifyEvent.objects.feed(user).filter(pk__gt=mark) \
+        .exclude(pk__in=list(_receipts(user, mark)))
+
+
+def unseen_digest(user):
+    """
+    The unseen events of ``user`` grouped by case and event type, newest
+    group first: one row per group with the number of events, the latest
+    creation date and the latest event id.
+    """
+    return unseen(user).order_by().values('contract', 'event_type') \
+        .annotate(count=Count('pk'), latest=Max('creation_date'),
+                  last_event=Max('pk')) \
+        .order_by('-last_event')
+
+
+def _set_watermark(user, mark):
+    EventWatermark.objects.for_user(user.pk).update_or_create(
+        user_id=user.pk, defaults={'event_id': mark})
+    EventReceipt.objects.for_user(user.pk).filter(event_id__lte=mark) \
+        .delete()
+
+
+def _advance(user, mark):
+    receipts = set(_receipts(user, mark))
+    if not receipts:
+        return
+    first_unseen = NotifyEvent.objects.feed(user) \
+        .filter(pk__gt=mark).exclude(pk__in=receipts) \
+        .order_by('pk').values_list('pk', flat=True).first()
+    new_mark = max(receipts) if first_unseen is None else first_unseen - 1
+    if new_mark > mark:
+        _set_watermark(user, new_mark)
+
+
+def mark_seen(user, event_ids):
+    with transaction.atomic(using=shard_for(user.pk)):
+        mark = watermark(user)
+        EventReceipt.objects.bulk_create(
+            [EventReceipt(user_id=user.pk, event_id=pk)
+             for pk in set(event_ids) if pk > mark],
+            ignore_conflicts=True)
+        _advance(user, mark)
+
+
+def mark_unseen(user, event_id):
+    with transaction.atomic(using=shard_for(user.pk)):
+        mark = watermark(user)
+        if event_id <= mark:
+            # the other events up to the watermark stay seen
+            EventReceipt.objects.bulk_create(
+                [EventReceipt(user_id=user.pk, event_id=pk)
+                 for pk in NotifyEvent.objects.feed(user).filter(
+                     pk__gt=event_id, pk__lte=mark
+                 ).values_list('pk', flat=True)],
+                ignore_conflicts=True)
+            EventWatermark.objects.for_user(user.pk) \
+                .update(event_id=event_id - 1)
+        EventReceipt.objects.for_user(user.pk).filter(event_id=event_id) \
+            .delete()
+
+
+def mark_all_seen(user):
+    """Mark the whole feed of ``user`` seen by moving the watermark."""
+    last = NotifyEvent.objects.feed(user).order_by('-pk') \
+        .values_list('pk', flat=True).first()
+    with transaction.atomic(using=shard_for(user.pk)):
+        if last is not None and last > watermark(user):
+            _set_watermark(user, last)
@@ -0,0 +1,115 @@
+"""
+Filter policy for the ``django-url-filter`` backend.
+
+``url_filter`` accepts any lookup on the ``filter_fields`` of a view, and
+on their related models, so a single request could scan a whole table.
+Views using ``PolicyFilterBackend`` declare which ``field: lookups`` are
+allowed: ``indexed_filters`` are served by an index, ``expensive_filters``
+are not and share a per-user rate limit. ``view_filters`` are checked
+the same way but applied by the view itself, for fields whose stored
+value differs from what the API shows. Anything else on a filter field
+is rejected with a 400, as are requests with more than
+``FILTER_MAX_TERMS`` filters or ``__in`` lists longer than
+``FILTER_MAX_IN_VALUES``.
+
+The plan of every new query shape (view and filter keys) is checked once
+per process and logged when it still scans a whole table.
+"""
+import logging
+import re
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import DatabaseError
+from rest_framework import exceptions
+from rest_framework.throttling import SimpleRateThrottle
+from url_filter.integrations.drf import DjangoFilterBackend
+
+
+logger = logging.getLogger(__name__)
+
+# SQLite ("SCAN <table>") and PostgreSQL ("Seq Scan on <table>") plans
+FULL_SCAN_RE = re.compile(r'\bSCAN\b|\bSeq Scan\b')
+
+
+class ExpensiveFilterThrottle(SimpleRateThrottle):
+    scope = 'expensive_filters'
+
+    def get_rate(self):
+        return settings.FILTER_EXPENSIVE_RATE
+
+    def get_cache_key(self, request, view):
+        if request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+
+def allows(policy, key):
+    """Whether ``key`` (``field`` or ``field__lookup``) is in ``policy``."""
+    if 'exact' in policy.get(key, ()):
+        return True
+    path, _, lookup = key.rpartition('__')
+    return bool(path) and lookup in policy.get(path, ())
+
+
+class PolicyFilterBackend(DjangoFilterBackend):
+    checked_shapes = set()
+
+    def filter_queryset(self, request, queryset, view):
+        keys = self.check_policy(request, view)
+        queryset = super().filter_queryset(request, queryset, view)
+        if keys and settings.FILTER_PLAN_CHECK:
+            self.check_plan(queryset, view, keys)
+        return queryset
+
+    def check_policy(self, request, view):
+        """Validate the filter parameters; return their sorted keys."""
+        fields = set(getattr(view, 'filter_fields', None) or ()) | \
+            set(getattr(view, 'view_filters', ()))
+        indexed = getattr(view, 'indexed_filters', {})
+        expensive = getattr(view, 'expensive_filters', {})
+        keys, errors, throttle = [], {}, False
+        for param, values in request.query_params.lists():
+            # url_filter negates "field!=value"
+            key = param.rstrip('!')
+            if key.split('__', 1)[0] not in fields:
+                continue
+            keys.append(key)
+            if allows(indexed, key):
+                pass
+            elif allows(expensive, key):
+                throttle = True
+            else:
+                errors[param] = ['Filtering by "{}" is not supported.'
+                                 .format(key)]
+                continue
+            if key.endswith('__in') and any(
+                    value.count(',') >= settings.FILTER_MAX_IN_VALUES
+                    for value in values):
+                errors[param] = ['At most {} values are allowed.'.format(
+                    settings.FILTER_MAX_IN_VALUES)]
+        if len(keys) > settings.FILTER_MAX_TERMS:
+            errors['non_field_errors'] = ['At most {} filters are allowed.'
+                                          .format(settings.FILTER_MAX_TERMS)]
+        if errors:
+            raise exceptions.ValidationError(errors)
+        if throttle:
+            limiter = ExpensiveFilterThrottle()
+            if not limiter.allow_request(request, view):
+                raise exceptions.Throttled(limiter.wait())
+        return sorted(keys)
+
+    def check_plan(self, queryset, view, keys):
+        shape = (type(view).__name__, tuple(keys))
+        if shape in self.checked_shapes:
+            return
+        self.checked_shapes.add(shape)
+        try:
+            plan = queryset.explain()
+        except (EmptyResultSet, DatabaseError):
+            return
+        if FULL_SCAN_RE.search(plan):
+            logger.warning('Filtering %s by %s scans a whole table:\n%s',
+                           shape[0], ', '.join(keys), plan)
@@ -70,4 +70,24 @@ class UserAdminChangeForm(forms.ModelForm):
         # Regardless of what the user provides, return the initial value.
         # This is done here, rather than on the field, because the
         # field does not have access to the initial value
-        return self.initial["password"]
\ No newline at end of file
+        return self.initial["password"]
+
+
+class VersionedModelForm(forms.ModelForm):
+    """
+    A form of a ``VersionedModel`` that fails validation when the row was
+    saved by someone else since the form was rendered.
+    """
+
+    def clean(self):
+        cleaned_data = super().clean()
+        instance = self.instance
+        if instance.pk is None or 'version' not in cleaned_data:
+            return cleaned_data
+        current = type(instance)._default_manager.filter(
+            pk=instance.pk).values_list('version', flat=True).first()
+        if current is not None and current != cleaned_data['version']:
+            raise forms.ValidationError(
+                'It was changed by someone else in the meantime; check '
+                'and save again.', code='conflict')
+        return cleaned_data
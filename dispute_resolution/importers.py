@@ -0,0 +1,195 @@
+"""
+Bulk user import from CSV or JSON lines.
+
+Rows are validated and de-duplicated a chunk at a time, passwords are
+hashed in a process pool spread over all cores, and each chunk's ``User``
+and ``UserInfo`` rows are written with two bulk inserts. Bad or duplicate
+rows are reported and skipped; they never abort the rest of the import.
+"""
+import csv
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+
+from dispute_resolution.bulk import bulk_insert
+from dispute_resolution.models import User, UserInfo
+from dispute_resolution.serializers import UserImportSerializer, \
+    user_cache, user_info_cache
+
+
+logger = logging.getLogger(__name__)
+
+# stays below SQLite's default limit of 999 variables in the
+# duplicate checks
+CHUNK_SIZE = 500
+INFO_FIELDS = ('eth_account', 'organization_name', 'tax_num', 'payment_num')
+
+
+def read_rows(stream, fmt):
+    """
+    Yield dicts from a text stream of CSV (with header) or JSON lines;
+    lines that are not valid JSON are passed on as is and reported.
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line
+
+
+def text_stream(binary):
+    return io.TextIOWrapper(binary, encoding='utf-8', newline='')
+
+
+def _init_worker():
+    if not apps.ready:
+        django.setup()
+
+
+@contextmanager
+def password_hasher(processes=None):
+    """
+    Yield a function hashing a list of passwords, in a pool of
+    ``processes`` workers (all cores by default, inline when 0).
+    """
+    if processes == 0:
+        yield lambda passwords: [make_password(pwd) for pwd in passwords]
+        return
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=_init_worker) as pool:
+        def hash_many(passwords):
+            chunksize = max(1, len(passwords) // (processes * 4))
+            return list(pool.map(make_password, passwords,
+                                 chunksize=chunksize))
+        yield hash_many
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+
+    def error(self, line, row, errors):
+        self.errors.append({'line': line, 'email': row.get('email'),
+                            'errors': errors})
+
+    def as_dict(self):
+        return {'created': self.created, 'failed': len(self.errors),
+                'errors': sorted(self.errors, key=lambda e: e['line'])}
+
+
+class UserImporter:
+    def __init__(self, processes=None, chunk_size=CHUNK_SIZE):
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.report = ImportReport()
+        self._emails = set()
+        self._accounts = set()
+
+    def run(self, rows):
+        numbered = enumerate(rows, start=1)
+        with password_hasher(self.processes) as hash_many:
+            while True:
+                chunk = list(islice(numbered, self.chunk_size))
+                if not chunk:
+                    break
+                valid = self._unique(self._validate(chunk))
+                hashes = hash_many([data.get('password') or None
+                                    for _, data in valid])
+                self._insert(valid, hashes)
+        return self.report
+
+    def _validate(self, chunk):
+        valid = []
+        for line, row in chunk:
+            if not isinstance(row, dict):
+                self.report.error(line, {}, {'non_field_errors': [
+                    'Expected a JSON object.']})
+                continue
+            # CSV leaves empty cells for omitted optional columns
+            row = {name: value for name, value in row.items()
+                   if name is not None and value not in ('', None)}
+            serializer = UserImportSerializer(data=row)
+            if not serializer.is_valid():
+                self.report.error(line, row, serializer.errors)
+                continue
+            data = dict(serializer.validated_data)
+            data['email'] = User.objects.normalize_email(data['email'])
+            valid.append((line, data))
+        return valid
+
+    def _unique(self, valid):
+        emails = {data['email'] for _, data in valid}
+        accounts = {data['eth_account'] for _, data in valid}
+        taken_emails = set(User.objects.filter(email__in=emails)
+                           .values_list('email', flat=True))
+        taken_accounts = set(
+            UserInfo.objects.filter(eth_account__in=accounts)
+            .values_list('eth_account', flat=True))
+        unique = []
+        for line, data in valid:
+            errors = {}
+            if data['email'] in taken_emails or data['email'] in self._emails:
+                errors['email'] = ['Duplicate email.']
+            if data['eth_account'] in taken_accounts or \
+                    data['eth_account'] in self._accounts:
+                errors['eth_account'] = ['Duplicate eth account.']
+            if errors:
+                self.report.error(line, data, errors)
+                continue
+            self._emails.add(data['email'])
+            self._accounts.add(data['eth_account'])
+            unique.append((line, data))
+        return unique
+
+    def _insert(self, valid, hashes):
+        users = [User(email=data['email'], name=data['name'],
+                      family_name=data['family_name'], password=pwd_hash)
+                 for (_, data), pwd_hash in zip(valid, hashes)]
+        try:
+            with transaction.atomic():
+                self._insert_rows(users, valid)
+        except IntegrityError:
+            # somebody else took an email or account since the duplicate
+            # check; fall back to row by row to isolate the offending rows
+            logger.warning('Chunk insert failed, retrying row by row')
+            for user, item in zip(users, valid):
+                user.pk = None
+                try:
+                    with transaction.atomic():
+                        self._insert_rows([user], [item])
+                except IntegrityError as exc:
+                    self.report.error(item[0], item[1],
+                                      {'non_field_errors': [str(exc)]})
+
+    def _insert_rows(self, users, valid):
+        bulk_insert(User, users)
+        infos = bulk_insert(UserInfo, [
+            UserInfo(user=user, **{name: data[name] for name in INFO_FIELDS
+                                   if name in data})
+            for user, (_, data) in zip(users, valid)])
+        # bulk inserts bypass the signals; ids of rolled back rows may be
+        # handed out again
+        user_cache.invalidate_many(user.pk for user in users)
+        user_info_cache.invalidate_many(info.pk for info in infos)
+        self.report.created += len(users)
+
+
+def import_users(rows, processes=None, chunk_size=CHUNK_SIZE):
+    return UserImporter(processes, chunk_size).run(rows).as_dict()
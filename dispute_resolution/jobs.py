@@ -0,0 +1,166 @@
+"""
+Background jobs in a table of the application database.
+
+Functions registered with ``@task()`` are queued with ``enqueue``, which
+inserts a ``Job`` row (in the caller's transaction, if any, so a job of a
+rolled back change is never run) or, with ``JOBS_ASYNC`` off, calls the
+task at once. ``manage.py run_workers`` runs ``work`` in worker processes:
+
+- a job is claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+  backend supports it, else with a conditional ``UPDATE ... WHERE status
+  = 'queued'`` that only one worker can win;
+- due jobs of the highest priority run first, then the oldest;
+- a failed job is retried after an exponential backoff with jitter until
+  it has had ``max_attempts`` attempts, then it stays ``failed`` for
+  inspection; finished jobs are deleted;
+- jobs of a worker that died are queued again after ``JOBS_LOCK_TIMEOUT``,
+  or fail if that was their last attempt.
+
+Queued jobs only run while workers run: with ``JOBS_ASYNC`` on, deploy
+``manage.py run_workers`` next to the server.
+
+Task arguments are stored as JSON.
+"""
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from dispute_resolution.db import run_serialized_write
+from dispute_resolution.models import Job
+
+
+logger = logging.getLogger(__name__)
+
+# candidates tried per claim where a conditional UPDATE decides
+CLAIM_CANDIDATES = 5
+
+registry = {}
+
+
+class Task:
+    def __init__(self, func, name, priority, max_attempts):
+        self.func = func
+        self.name = name
+        self.priority = priority
+        self.max_attempts = max_attempts
+
+
+def task(name=None, priority=0, max_attempts=None):
+    """Register the decorated function as a task, by default by its name."""
+    def register(func):
+        task_name = name or func.__name__
+        registry[task_name] = Task(func, task_name, priority, max_attempts)
+        return func
+    return register
+
+
+def enqueue(name, *args, priority=None, delay=0):
+    """Queue a call of task ``name``; the Job, or None when run inline."""
+    task = registry[name]
+    if not settings.JOBS_ASYNC:
+        task.func(*args)
+        return None
+    return run_serialized_write(
+        Job.objects.create, task=name, args=json.dumps(args),
+        priority=task.priority if priority is None else priority,
+        run_after=timezone.now() + timedelta(seconds=delay),
+        max_attempts=task.max_attempts or settings.JOBS_MAX_ATTEMPTS)
+
+
+def _due():
+    return Job.objects.filter(status=Job.QUEUED,
+                              run_after__lte=timezone.now()) \
+        .order_by('-priority', 'run_after', 'pk')
+
+
+def _lock(pk, worker):
+    return Job.objects.filter(pk=pk, status=Job.QUEUED).update(
+        status=Job.RUNNING, locked_by=worker, locked_at=timezone.now(),
+        attempts=F('attempts') + 1)
+
+
+def claim(worker):
+    """Claim the next due job for ``worker``; None if there is none."""
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            pk = _due().select_for_update(skip_locked=True) \
+                .values_list('pk', flat=True).first()
+            if pk is None or not _lock(pk, worker):
+                return None
+    else:
+        for pk in _due().values_list('pk', flat=True)[:CLAIM_CANDIDATES]:
+            if _lock(pk, worker):
+                break
+        else:
+            return None
+    return Job.objects.get(pk=pk)
+
+
+def backoff(attempts):
+    """Seconds until the next attempt after ``attempts`` failed ones."""
+    delay = min(settings.JOBS_BACKOFF * 2 ** (attempts - 1),
+                settings.JOBS_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1)
+
+
+def run(job):
+    """Run a claimed job and record its outcome."""
+    try:
+        registry[job.task].func(*json.loads(job.args))
+    except Exception:
+        logger.exception('Job %s failed (attempt %s of %s)', job,
+                         job.attempts, job.max_attempts)
+        done = job.attempts >= job.max_attempts
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.FAILED if done else Job.QUEUED,
+            run_after=timezone.now() + timedelta(
+                seconds=0 if done else backoff(job.attempts)),
+            locked_by='', locked_at=None,
+            last_error=traceback.format_exc())
+        return False
+    Job.objects.filter(pk=job.pk).delete()
+    return True
+
+
+def requeue_stale():
+    """
+    Queue the jobs of workers that died running them again, unless they
+    had their attempts; the number of jobs queued.
+    """
+    limit = timezone.now() - timedelta(seconds=settings.JOBS_LOCK_TIMEOUT)
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=limit)
+    # a job killing its worker must not be retried forever
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, locked_by='', locked_at=None,
+        last_error='The worker running the job was lost.')
+    return stale.update(status=Job.QUEUED, locked_by='', locked_at=None)
+
+
+def work(worker=None, stop=None, once=False):
+    """
+    Run due jobs until ``stop`` (an event) is set, polling every
+    ``JOBS_POLL_INTERVAL`` seconds; with ``once``, until none is due.
+    """
+    worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+    stop = stop or threading.Event()
+    requeue_stale()
+    while not stop.is_set():
+        job = claim(worker)
+        if job is not None:
+            run(job)
+        elif once:
+            return
+        else:
+            requeue_stale()
+            close_old_connections()
+            stop.wait(settings.JOBS_POLL_INTERVAL)
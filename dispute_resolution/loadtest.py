@@ -0,0 +1,271 @@
+"""
+Load generator for ``manage.py loadtest``.
+
+Worker threads play existing users (authenticated with bearer tokens) and
+an admin, picking requests from a weighted mix of ``users/self`` polling,
+contract reads, event ingestion and marking events seen, either against a
+running server or in-process through the WSGI application. Latencies are
+reported per scenario as throughput, error rate and p50/p95/p99.
+"""
+import http.client
+import io
+import json
+import random
+import sys
+import threading
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from django.core.wsgi import get_wsgi_application
+
+from dispute_resolution import feeds
+from dispute_resolution.authentication import issue_token
+from dispute_resolution.models import User
+
+
+# scenario: relative weight
+DEFAULT_MIX = {
+    'users-self': 40,
+    'contracts-list': 10,
+    'contracts-detail': 20,
+    'events-create': 10,
+    'events-seen': 20,
+}
+PERCENTILES = (50, 95, 99)
+
+
+class Actor:
+    """A user requests are sent for, with the ids they can use."""
+
+    def __init__(self, user, events_limit=100):
+        self.token = issue_token(user)
+        info = getattr(user, 'info', None)
+        self.eth_account = info.eth_account if info else None
+        self.contracts = list(user.contracts.order_by('pk')
+                              .values_list('pk', flat=True))
+        self.events = list(feeds.unseen(user)
+                           .values_list('pk', flat=True)[:events_limit])
+
+
+def load_actors(num_users):
+    """Actors for up to ``num_users`` active users taking part in cases."""
+    users = User.objects.filter(active=True, info__isnull=False,
+                                contracts__isnull=False) \
+        .select_related('info').distinct().order_by('pk')[:num_users]
+    return [Actor(user) for user in users]
+
+
+def parse_mix(spec):
+    """``"users-self=3,events-seen=1"`` -> ``{'users-self': 3, ...}``."""
+    mix = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError('Unknown scenario: {}'.format(name))
+        mix[name] = int(weight) if weight else 1
+    return mix
+
+
+class WSGITransport:
+    """Calls the WSGI application of this process directly."""
+
+    def __init__(self, application=None):
+        self.application = application or get_wsgi_application()
+
+    def request(self, method, path, headers, body=b''):
+        path, _, query = path.partition('?')
+        environ = {
+            'REQUEST_METHOD': method, 'PATH_INFO': path,
+            'QUERY_STRING': query, 'SERVER_NAME': 'loadtest',
+            'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        status = []
+        result = self.application(
+            environ, lambda line, headers, exc_info=None: status.append(line))
+        try:
+            for _ in result:
+                pass
+        finally:
+            result.close()
+        return int(status[0].split()[0])
+
+
+class HTTPTransport:
+    """Sends requests to ``base_url``, one keep-alive connection a thread."""
+
+    def __init__(self, base_url):
+        url = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection \
+            if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self._local = threading.local()
+
+    def request(self, method, path, headers, body=b''):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = \
+                self.connection_class(self.netloc, timeout=30)
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+        try:
+            connection.request(method, self.prefix + path, body=body,
+                               headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+        return response.status
+
+
+def _scenario_request(name, actor, admin, rnd):
+    """The ``(method, path, actor, body)`` of one request of ``name``."""
+    if name == 'users-self':
+        return 'GET', '/users/self/', actor, None
+    if name == 'contracts-list':
+        return 'GET', '/contracts/', actor, None
+    if name == 'contracts-detail':
+        return 'GET', '/contracts/{}/'.format(
+            rnd.choice(actor.contracts)), actor, None
+    if name == 'events-create':
+        return 'POST', '/events/', admin, {
+            'contract': rnd.choice(actor.contracts), 'stage_num': 0,
+            'event_type': 'open', 'address_by': actor.eth_account}
+    if name == 'events-seen':
+        if not actor.events:
+            # nothing left to mark: the user looks for new events instead
+            return 'GET', '/events/unseen/', actor, None
+        return 'PATCH', '/events/{}/'.format(
+            rnd.choice(actor.events)), actor, {'seen': True}
+    raise ValueError(name)
+
+
+class _Budget:
+    """Thread-safe countdown of the requests left; unlimited with None."""
+
+    def __init__(self, requests):
+        self.left = requests
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.left is None:
+            return 1
+        with self._lock:
+            self.left -= 1
+            return self.left + 1
+
+
+def _work(transport, actors, admin, mix, deadline, budget, samples, seed):
+    rnd = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    while perf_counter() < deadline and next(budget) > 0:
+        name = rnd.choices(names, weights)[0]
+        method, path, sender, body = _scenario_request(
+            name, rnd.choice(actors), admin, rnd)
+        headers = {'Authorization': 'Bearer ' + sender.token,
+                   'Accept': 'application/json'}
+        body = json.dumps(body).encode() if body is not None else b''
+        start = perf_counter()
+        try:
+            ok = transport.request(method, path, headers, body) < 400
+        except Exception:
+            ok = False
+        samples.append((name, perf_counter() - start, ok))
+
+
+def run(transport, actors, admin=None, mix=None, workers=8, duration=10.0,
+        requests=None, seed=None):
+    """
+    Send requests from ``workers`` threads (inline with 0) until
+    ``duration`` seconds have passed or ``requests`` were sent; return the
+    ``summarize``d samples.
+    """
+    mix = dict(mix or DEFAULT_MIX)
+    if admin is None:
+        mix.pop('events-create', None)
+    if not actors or not mix:
+        raise ValueError('Nothing to request.')
+    budget = _Budget(requests)
+    deadline = perf_counter() + duration
+    started = perf_counter()
+    if workers == 0:
+        samples = []
+        _work(transport, actors, admin, mix, deadline, budget, samples, seed)
+    else:
+        per_worker = [[] for _ in range(workers)]
+        threads = [threading.Thread(
+            target=_work, args=(transport, actors, admin, mix, deadline,
+                                budget, per_worker[num],
+                                None if seed is None else seed + num))
+            for num in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        samples = [sample for worker in per_worker for sample in worker]
+    return summarize(samples, perf_counter() - started)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return None
+    rank = max(1, -(-pct * len(values) // 100))
+    return values[int(rank) - 1]
+
+
+def _stats(samples, elapsed):
+    latencies = sorted(latency for _, latency, _ in samples)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    stats = {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+        'throughput': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+    }
+    for pct in PERCENTILES:
+        value = percentile(latencies, pct)
+        stats['p{}_ms'.format(pct)] = None if value is None \
+            else round(value * 1000, 2)
+    return stats
+
+
+def summarize(samples, elapsed):
+    by_name = {}
+    for sample in samples:
+        by_name.setdefault(sample[0], []).append(sample)
+    return {
+        'elapsed': round(elapsed, 3),
+        'total': _stats(samples, elapsed),
+        'endpoints': {name: _stats(by_name[name], elapsed)
+                      for name in sorted(by_name)},
+    }
+
+
+def format_report(summary):
+    columns = ('requests', 'errors', 'error_rate', 'throughput') + tuple(
+        'p{}_ms'.format(pct) for pct in PERCENTILES)
+    header = '{:<18}'.format('scenario') + ''.join(
+        '{:>12}'.format(column) for column in columns)
+    lines = [header, '-' * len(header)]
+    rows = list(summary['endpoints'].items()) + [('total',
+                                                  summary['total'])]
+    for name, stats in rows:
+        lines.append('{:<18}'.format(name) + ''.join(
+            '{:>12}'.format('-' if stats[column] is None else stats[column])
+            for column in columns))
+    lines.append('elapsed: {}s'.format(summary['elapsed']))
+    return '\n'.join(lines)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from dispute_resolution.schema import AUDIENCES, build_schema, code_version
+
+
+class Command(BaseCommand):
+    help = 'Precompute the API schema of the current code version.'
+
+    def handle(self, *args, **options):
+        for audience in AUDIENCES:
+            build_schema(audience)
+        self.stdout.write('Schema {} built'.format(code_version()))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from dispute_resolution.sharding import rebalance, shard_stats
+
+
+ROW = '{:<20} {receipts:>10} receipts {watermarks:>10} watermarks'
+
+
+class Command(BaseCommand):
+    help = 'Show the receipts and watermarks per event shard.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebalance', action='store_true',
+                            help='First move rows kept on a shard other '
+                                 'than their user\'s, e.g. after adding '
+                                 'shards.')
+
+    def handle(self, *args, **options):
+        if options['rebalance']:
+            self.stdout.write('{} row(s) moved'.format(rebalance()))
+        totals = {'receipts': 0, 'watermarks': 0}
+        for alias, counts in shard_stats().items():
+            self.stdout.write(ROW.format(alias, **counts))
+            for name in totals:
+                totals[name] += counts[name]
+        self.stdout.write(ROW.format('total', **totals))
@@ -0,0 +1,53 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from dispute_resolution.export import CHUNK_SIZE, FORMATS, \
+    changes_until, encode, export_until, iter_cases
+
+
+class Command(BaseCommand):
+    help = ('Export cases with their stages, party accounts and events as '
+            'JSON lines or CSV.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-',
+                            help='Output file, "-" for stdout (default).')
+        parser.add_argument('--format', choices=sorted(FORMATS),
+                            default='jsonl', help='Output format.')
+        parser.add_argument('--since', type=int, default=0,
+                            help='Only export cases with a greater id.')
+        parser.add_argument('--stages-since', type=int, default=None,
+                            help='Also export older cases with a stage '
+                                 'of a greater id.')
+        parser.add_argument('--events-since', type=int, default=None,
+                            help='Also export older cases with an event '
+                                 'of a greater id.')
+        parser.add_argument('--gzip', action='store_true',
+                            help='Compress the output.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Cases read from the database at a time.')
+
+    def handle(self, *args, **options):
+        until = export_until()
+        stages_until, events_until = changes_until()
+        blocks = encode(iter_cases(options['since'], until,
+                                   options['chunk_size'],
+                                   options['stages_since'],
+                                   options['events_since']),
+                        options['format'], options['gzip'])
+        if options['path'] == '-':
+            self._write(sys.stdout.buffer, blocks)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options['path'], 'wb') as output:
+                self._write(output, blocks)
+        # the --since, --stages-since and --events-since of the next
+        # incremental export
+        self.stderr.write(
+            'exported cases up to id {}, stages up to id {}, events up to '
+            'id {}'.format(until, stages_until, events_until))
+
+    def _write(self, output, blocks):
+        for block in blocks:
+            output.write(block)
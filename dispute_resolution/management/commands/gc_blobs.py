@@ -0,0 +1,58 @@
+import datetime
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dispute_resolution.blobstore import count_refs, get_store, \
+    recount_refs
+from dispute_resolution.models import Blob
+
+
+class Command(BaseCommand):
+    help = 'Delete blobs no case, user info or stage references any more.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='Keep unreferenced blobs younger than this, '
+                                 'they may be about to be referenced.')
+        parser.add_argument('--recount', action='store_true',
+                            help='Recompute reference counts first.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        store = get_store()
+        if options['recount']:
+            recount_refs()
+        grace = datetime.timedelta(hours=options['grace_hours'])
+        candidates = Blob.objects.filter(refcount=0,
+                                         created__lt=timezone.now() - grace)
+        deleted = 0
+        for digest in candidates.values_list('sha256', flat=True).iterator():
+            if options['dry_run']:
+                self.stdout.write(digest)
+                deleted += 1
+                continue
+            # a reference may have been added meanwhile, or be missing from
+            # the count, e.g. one saved before the blob was uploaded
+            refs = count_refs(digest)
+            if refs:
+                Blob.objects.filter(pk=digest).update(refcount=refs)
+                continue
+            if Blob.objects.filter(pk=digest, refcount=0).delete()[0]:
+                store.delete(digest)
+                deleted += 1
+        self._remove_stale_uploads(store, grace, options['dry_run'])
+        self.stdout.write('{} blob(s) {}'.format(
+            deleted, 'would be deleted' if options['dry_run'] else 'deleted'))
+
+    def _remove_stale_uploads(self, store, grace, dry_run):
+        tmp_dir = os.path.join(store.root, 'tmp')
+        if dry_run or not os.path.isdir(tmp_dir):
+            return
+        cutoff = time.time() - grace.total_seconds()
+        for name in os.listdir(tmp_dir):
+            path = os.path.join(tmp_dir, name)
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
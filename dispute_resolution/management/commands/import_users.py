@@ -0,0 +1,43 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from dispute_resolution.importers import CHUNK_SIZE, import_users, \
+    read_rows
+
+
+class Command(BaseCommand):
+    help = 'Import users with their info from a CSV or JSON lines file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Input file, "-" for stdin.')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            default=None,
+                            help='Input format (default: from extension).')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Password hashing processes '
+                                 '(default: all cores, 0: inline).')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Rows validated and inserted at a time.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.endswith('.csv')
+                                    else 'jsonl')
+        if path == '-':
+            report = self._import(sys.stdin, fmt, options)
+        else:
+            with open(path, encoding='utf-8', newline='') as stream:
+                report = self._import(stream, fmt, options)
+        for error in report['errors']:
+            self.stderr.write('line {line} ({email}): {errors}'.format(
+                line=error['line'], email=error['email'],
+                errors=json.dumps(error['errors'])))
+        self.stdout.write('created: {created}, failed: {failed}'.format(
+            **report))
+
+    def _import(self, stream, fmt, options):
+        return import_users(read_rows(stream, fmt),
+                            processes=options['processes'],
+                            chunk_size=options['chunk_size'])
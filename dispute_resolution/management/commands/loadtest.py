@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dispute_resolution.loadtest import Actor, DEFAULT_MIX, HTTPTransport, \
+    WSGITransport, format_report, load_actors, parse_mix, run
+from dispute_resolution.models import User
+
+
+class Command(BaseCommand):
+    help = ('Send a mix of API requests from concurrent workers and report '
+            'throughput, error rate and latency percentiles per scenario.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None,
+                            help='Base URL of a running server sharing this '
+                                 'database and SECRET_KEY (default: '
+                                 'in-process through the WSGI application).')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Concurrent worker threads (0: inline).')
+        parser.add_argument('--duration', type=float, default=10.0,
+                            help='Seconds to run.')
+        parser.add_argument('--requests', type=int, default=None,
+                            help='Stop after this many requests.')
+        parser.add_argument('--users', type=int, default=50,
+                            help='Number of users taking part in cases to '
+                                 'send requests as.')
+        parser.add_argument('--admin', default=None,
+                            help='Email of the admin ingesting events '
+                                 '(default: the first admin).')
+        parser.add_argument('--mix', default=None,
+                            help='Weighted scenarios, e.g. '
+                                 '"users-self=4,events-seen=1" (default: '
+                                 '{}).'.format(','.join(
+                                     '{}={}'.format(*item)
+                                     for item in DEFAULT_MIX.items())))
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for a reproducible request '
+                                 'sequence per worker.')
+        parser.add_argument('--json', dest='json_path', default=None,
+                            help='Also write the report as JSON to this '
+                                 'file, "-" for stdout.')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix']) if options['mix'] else None
+        except ValueError as error:
+            raise CommandError(error)
+        actors = load_actors(options['users'])
+        if not actors:
+            raise CommandError('No users taking part in cases; create some '
+                               'with manage.py seed_load.')
+        admins = User.objects.filter(admin=True, active=True)
+        if options['admin']:
+            admins = admins.filter(email=options['admin'])
+        admin = admins.order_by('pk').first()
+        if admin is None:
+            self.stderr.write('No admin user, leaving out events-create.')
+        transport = HTTPTransport(options['url']) if options['url'] \
+            else WSGITransport()
+
+        summary = run(transport, actors,
+                      admin=Actor(admin, events_limit=0) if admin else None,
+                      mix=mix, workers=options['workers'],
+                      duration=options['duration'],
+                      requests=options['requests'], seed=options['seed'])
+        report = json.dumps(summary, indent=2)
+        if options['json_path'] == '-':
+            self.stdout.write(report)
+            return
+        self.stdout.write(format_report(summary))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                output.write(report + '\n')
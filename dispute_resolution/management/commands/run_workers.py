@@ -0,0 +1,55 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from dispute_resolution import jobs
+
+
+def _worker(stop, once):
+    # the parent process turns Ctrl-C and SIGTERM into ``stop``, so a
+    # running job is finished
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    jobs.work(stop=stop, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs in worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Worker processes (default: JOBS_WORKERS, '
+                                 '0: work in this process).')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no job is due.')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        if processes is None:
+            processes = settings.JOBS_WORKERS
+        if processes == 0:
+            jobs.work(once=options['once'])
+            return
+
+        # forked workers must open connections of their own
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        workers = [context.Process(target=_worker,
+                                   args=(stop, options['once']),
+                                   name='drm-worker-{}'.format(num))
+                   for num in range(processes)]
+        for worker in workers:
+            worker.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        self.stdout.write('Started {} workers.'.format(processes))
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from dispute_resolution.seed import seed
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users, cases, stages and events for load runs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Number of (non-judge) users.')
+        parser.add_argument('--cases', type=int, default=1000,
+                            help='Number of contract cases.')
+        parser.add_argument('--judges', type=int, default=3,
+                            help='Number of judges.')
+        parser.add_argument('--parties', type=int, default=2,
+                            help='Party members per case.')
+        parser.add_argument('--stages', type=int, default=3,
+                            help='Stages per case.')
+        parser.add_argument('--password', default='password',
+                            help='Password set for every generated user.')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for reproducible data.')
+
+    def handle(self, *args, **options):
+        counts = seed(users=options['users'], cases=options['cases'],
+                      judges=options['judges'], parties=options['parties'],
+                      stages=options['stages'],
+                      password=options['password'],
+                      random_seed=options['seed'])
+        for model, count in counts.items():
+            self.stdout.write('{}: {}'.format(model, count))
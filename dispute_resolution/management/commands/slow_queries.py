@@ -0,0 +1,39 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dispute_resolution.slowlog import aggregate, read_entries
+
+
+class Command(BaseCommand):
+    help = 'List the statements of the slow-query log with most total time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=None,
+                            help='Log file (default: SLOW_QUERY_LOG).')
+        parser.add_argument('--top', type=int, default=20,
+                            help='Number of statements to list.')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the aggregates as JSON.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.SLOW_QUERY_LOG
+        try:
+            groups = aggregate(read_entries(path))[:options['top']]
+        except FileNotFoundError:
+            raise CommandError('No slow-query log at {}'.format(path))
+        if options['json']:
+            self.stdout.write(json.dumps(groups, indent=2))
+            return
+        for group in groups:
+            views = ', '.join('{} ({})'.format(view, count) for view, count
+                              in sorted(group['views'].items(),
+                                        key=lambda item: -item[1]))
+            self.stdout.write(
+                '{total_ms:>10.1f} ms total  {count:>6}x  mean {mean_ms:.1f}'
+                '  max {max_ms:.1f}  [{fingerprint}]'.format(**group))
+            self.stdout.write('    ' + group['sql'][:300])
+            self.stdout.write('    views: ' + views)
+            for frame in group['stack']:
+                self.stdout.write('    at ' + frame)
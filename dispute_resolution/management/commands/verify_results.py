@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from dispute_resolution.models import ContractStage
+from dispute_resolution.verification import verify_stage
+
+
+class Command(BaseCommand):
+    help = ('Verify dispute result files against their recorded hash, '
+            'e.g. stages left pending by a restart.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Re-verify every stage with a result hash, '
+                                 'not only pending ones.')
+
+    def handle(self, *args, **options):
+        stages = ContractStage.objects.exclude(result_hash='')
+        if not options['all']:
+            stages = stages.filter(result_verification='pending')
+        for stage_id in stages.values_list('pk', flat=True).iterator():
+            self.stdout.write('{}: {}'.format(stage_id,
+                                              verify_stage(stage_id)))
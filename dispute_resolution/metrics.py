@@ -0,0 +1,168 @@
+"""
+Per-request timing and SQL statistics.
+
+``MetricsMiddleware`` opens a ``RequestStats`` for every request, the
+database execute wrapper and ``SerializerTimingMixin`` feed it, and the
+finished request is folded into the process-wide histograms that the
+``/metrics`` view renders in the Prometheus text format. Histograms are
+kept per process; with several gunicorn workers every worker is scraped
+independently.
+"""
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+
+_local = threading.local()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class RequestStats:
+    """Counters collected while a single request is being served."""
+    __slots__ = ('view', 'queries', 'db_time', 'serializer_time',
+                 'serializing', 'started')
+
+    def __init__(self):
+        self.view = 'unresolved'
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+        self.started = perf_counter()
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += perf_counter() - start
+            self.queries += 1
+
+    @property
+    def latency(self):
+        return perf_counter() - self.started
+
+
+def start_request(stats=None):
+    """Make ``stats`` (a fresh one by default) current in this thread."""
+    if stats is None:
+        stats = RequestStats()
+    _local.stats = stats
+    return stats
+
+
+def finish_request():
+    _local.stats = None
+
+
+def current():
+    """Return the stats of the request served by this thread, if any."""
+    return getattr(_local, 'stats', None)
+
+
+def view_label(view_func, request):
+    """
+    Name the view as ``ViewSet.action`` for DRF viewsets, and by its
+    qualified name otherwise (e.g. ``ModelAdmin.changelist_view``).
+    """
+    cls = getattr(view_func, 'cls', None)
+    if cls is not None:
+        actions = getattr(view_func, 'actions', None) or {}
+        method = request.method.lower()
+        return '{}.{}'.format(cls.__name__, actions.get(method, method))
+    return getattr(view_func, '__qualname__', view_func.__name__)
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((label, list(counts), total, count)
+                            for label, (counts, total, count)
+                            in self._series.items())
+        for label, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{view="{}",le="{}"}} {}'.format(
+                    self.name, label, bound, cumulative))
+            lines.append('{}_bucket{{view="{}",le="+Inf"}} {}'.format(
+                self.name, label, count))
+            lines.append('{}_sum{{view="{}"}} {}'.format(
+                self.name, label, total))
+            lines.append('{}_count{{view="{}"}} {}'.format(
+                self.name, label, count))
+        return lines
+
+
+REQUEST_LATENCY = Histogram('drm_request_duration_seconds',
+                            'Overall request latency.', LATENCY_BUCKETS)
+REQUEST_DB_TIME = Histogram('drm_request_db_seconds',
+                            'Time spent executing SQL per request.',
+                            LATENCY_BUCKETS)
+REQUEST_SERIALIZER_TIME = Histogram('drm_request_serializer_seconds',
+                                    'Time spent in serializers per request.',
+                                    LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram('drm_request_queries',
+                            'Number of SQL queries per request.',
+                            QUERY_BUCKETS)
+
+HISTOGRAMS = (REQUEST_LATENCY, REQUEST_DB_TIME, REQUEST_SERIALIZER_TIME,
+              REQUEST_QUERIES)
+
+
+def record(stats, latency):
+    REQUEST_LATENCY.observe(stats.view, latency)
+    REQUEST_DB_TIME.observe(stats.view, stats.db_time)
+    REQUEST_SERIALIZER_TIME.observe(stats.view, stats.serializer_time)
+    REQUEST_QUERIES.observe(stats.view, stats.queries)
+
+
+def render_prometheus():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+class SerializerTimingMixin:
+    """
+    Adds the time spent in ``to_representation`` to the current request.
+
+    Only the outermost serializer is timed, so nested serializers are not
+    counted twice.
+    """
+
+    def to_representation(self, instance):
+        stats = current()
+        if stats is None or stats.serializing:
+            return super().to_representation(instance)
+        stats.serializing = True
+        start = perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            stats.serializer_time += perf_counter() - start
+            stats.serializing = False
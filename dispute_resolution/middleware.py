@@ -0,0 +1,164 @@
+import copy
+import cProfile
+import random
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+from dispute_resolution import metrics, profiling
+from dispute_resolution.authentication import session_user_cache
+
+
+def add_debug_headers(response, stats, latency):
+    response['X-View'] = stats.view
+    response['X-DB-Queries'] = str(stats.queries)
+    response['X-DB-Time'] = '{:.6f}'.format(stats.db_time)
+    response['X-Serializer-Time'] = '{:.6f}'.format(stats.serializer_time)
+    response['X-Response-Time'] = '{:.6f}'.format(latency)
+
+
+class MetricsMiddleware:
+    """
+    Records query count, DB time, serializer time and latency per request,
+    tagged by ``ViewSet.action``, and exposes them as ``X-*`` response
+    headers when ``METRICS_DEBUG_HEADERS`` is on.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.debug_headers = getattr(settings, 'METRICS_DEBUG_HEADERS',
+                                     settings.DEBUG)
+
+    def __call__(self, request):
+        stats = metrics.start_request()
+        try:
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(
+                        conn.execute_wrapper(stats.execute_wrapper))
+                response = self.get_response(request)
+            latency = stats.latency
+            metrics.record(stats, latency)
+        finally:
+            metrics.finish_request()
+
+        if self.debug_headers:
+            add_debug_headers(response, stats, latency)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = metrics.current()
+        if stats is not None:
+            stats.view = metrics.view_label(view_func, request)
+
+
+class ProfilerMiddleware:
+    """
+    Profiles requests carrying ``PROFILER_SECRET`` and a sample of
+    ``PROFILER_SAMPLE_RATE`` of all requests, see
+    ``dispute_resolution.profiling``. Unless ``PROFILER_ENABLED`` is on it
+    removes itself from the middleware chain.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILER_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def trigger(self, request):
+        secret = settings.PROFILER_SECRET
+        if secret:
+            given = request.META.get('HTTP_X_PROFILE') or \
+                request.GET.get('_profile')
+            if given and constant_time_compare(given, secret):
+                return 'secret'
+        rate = settings.PROFILER_SAMPLE_RATE
+        if rate and random.random() < rate:
+            return 'sample'
+        return None
+
+    def __call__(self, request):
+        trigger = self.trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+
+        queries = []
+
+        def record_sql(execute, sql, params, many, context):
+            start = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                if len(queries) < settings.PROFILER_MAX_QUERIES:
+                    queries.append({
+                        'sql': sql, 'many': many,
+                        'ms': round((perf_counter() - start) * 1000, 3)})
+
+        profiler = cProfile.Profile()
+        start = perf_counter()
+        with ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(record_sql))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        duration = perf_counter() - start
+
+        stats = metrics.current()
+        profile_id = profiling.new_profile_id()
+        profiling.save_profile(profile_id, profiler, {
+            'method': request.method,
+            'path': request.path,
+            'view': stats.view if stats is not None else None,
+            'status': response.status_code,
+            'trigger': trigger,
+            'duration_ms': round(duration * 1000, 3),
+            'queries': len(queries),
+            'db_ms': round(sum(query['ms'] for query in queries), 3),
+            'sql': queries,
+        })
+        response['X-Profile-Id'] = profile_id
+        return response
+
+
+def get_session_user(request):
+    """
+    ``auth.get_user`` memoized by session key: a hit costs no query, but
+    still needs the session to name the user and carry their current
+    session auth hash, so a password change logs the session out. Every
+    request gets its own copy of a cached user.
+    """
+    session = request.session
+    key = session.session_key
+    if key is not None:
+        user = session_user_cache.get(key)
+        if user is not None and \
+                session.get(auth.SESSION_KEY) == str(user.pk) and \
+                constant_time_compare(session.get(auth.HASH_SESSION_KEY, ''),
+                                      user.get_session_auth_hash()):
+            return copy.deepcopy(user)
+    user = auth.get_user(request)
+    if key is not None and user.is_authenticated:
+        session_user_cache.put(key, copy.deepcopy(user))
+    return user
+
+
+class SessionUserMiddleware(AuthenticationMiddleware):
+    """
+    ``AuthenticationMiddleware`` taking the user from
+    ``session_user_cache``, which drops a user's entries when the user or
+    their info changes.
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_session_user(request))
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0008_auto_20180804_1127'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.PositiveIntegerField(db_index=True, default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0009_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contractstage',
+            name='result_hash',
+            field=models.CharField(blank=True, max_length=250),
+        ),
+        migrations.AddField(
+            model_name='contractstage',
+            name='result_verification',
+            field=models.CharField(choices=[('none', 'No result'), ('pending', 'Pending'), ('verified', 'Verified'), ('mismatch', 'Hash mismatch'), ('missing', 'File missing')], default='none', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='contractstage',
+            name='result_verified_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0010_stage_result_verification'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contractstage',
+            index=models.Index(fields=['contract', 'start', 'id'], name='stage_timeline_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notifyevent',
+            index=models.Index(fields=['contract', 'user_to', 'creation_date', 'id'], name='event_timeline_idx'),
+        ),
+    ]
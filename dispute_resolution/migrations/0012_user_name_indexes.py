@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0011_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='family_name',
+            field=models.CharField(db_index=True, max_length=150, verbose_name='Family'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='name',
+            field=models.CharField(db_index=True, max_length=150, verbose_name='Name'),
+        ),
+    ]
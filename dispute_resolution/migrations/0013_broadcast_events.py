@@ -0,0 +1,100 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:31
+
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def convert_seen_flags(apps, schema_editor):
+    """
+    Existing events keep their recipient as an explicit one; their seen
+    flags become a watermark per user below the first unseen event and
+    receipts for the seen events above it.
+    """
+    NotifyEvent = apps.get_model('dispute_resolution', 'NotifyEvent')
+    EventReceipt = apps.get_model('dispute_resolution', 'EventReceipt')
+    EventWatermark = apps.get_model('dispute_resolution', 'EventWatermark')
+    rows = NotifyEvent.objects.order_by('user_to_id', 'id') \
+        .values_list('user_to_id', 'id', 'seen').iterator()
+    for user_id, events in groupby(rows, key=itemgetter(0)):
+        events = [(pk, seen) for _, pk, seen in events]
+        unseen = [pk for pk, seen in events if not seen]
+        mark = unseen[0] - 1 if unseen else events[-1][0]
+        if mark > 0:
+            EventWatermark.objects.create(user_id=user_id, event_id=mark)
+        EventReceipt.objects.bulk_create(
+            [EventReceipt(user_id=user_id, event_id=pk)
+             for pk, seen in events if seen and pk > mark],
+            batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0012_user_name_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventReceipt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EventWatermark',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='event_watermark', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('event_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='notifyevent',
+            name='event_timeline_idx',
+        ),
+        migrations.AddField(
+            model_name='notifyevent',
+            name='audience',
+            field=models.CharField(choices=[('parties', 'Parties of the case'), ('user', 'Explicit recipient')], default='user', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='notifyevent',
+            name='notify_judges',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='notifyevent',
+            name='user_to',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='events_received', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='eventreceipt',
+            name='event',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipts', to='dispute_resolution.NotifyEvent'),
+        ),
+        migrations.AddField(
+            model_name='eventreceipt',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='event_receipts', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventreceipt',
+            unique_together={('user', 'event')},
+        ),
+        migrations.RunPython(convert_seen_flags, elidable=True),
+        migrations.RemoveField(
+            model_name='notifyevent',
+            name='seen',
+        ),
+        migrations.AddIndex(
+            model_name='notifyevent',
+            index=models.Index(fields=['contract', 'creation_date', 'id'], name='event_timeline_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notifyevent',
+            index=models.Index(fields=['notify_judges', 'id'], name='event_judges_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0013_broadcast_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contractcase',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='contractstage',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:47
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def count_cases(apps, schema_editor):
+    User = apps.get_model('dispute_resolution', 'User')
+    CaseCounters = apps.get_model('dispute_resolution', 'CaseCounters')
+    counts = {name: Count('contracts', filter=Q(contracts__finished=state),
+                          distinct=True)
+              for name, state in (('open', 0), ('pending', 1),
+                                  ('finished', 2))}
+    counts['disputes'] = Count(
+        'contracts__stages', distinct=True,
+        filter=Q(contracts__stages__dispute_started__isnull=False,
+                 contracts__stages__dispute_finished__isnull=True))
+    rows = User.objects.filter(contracts__isnull=False).order_by() \
+        .values('pk').annotate(**counts).iterator()
+    CaseCounters.objects.bulk_create(
+        (CaseCounters(user_id=row.pop('pk'), **row) for row in rows),
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0014_versioned_cases'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='case_counters', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('open', models.PositiveIntegerField(default=0)),
+                ('pending', models.PositiveIntegerField(default=0)),
+                ('finished', models.PositiveIntegerField(default=0)),
+                ('disputes', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        # a user's cases straight from the index, newest first
+        migrations.RunSQL(
+            'CREATE INDEX "contractcase_party_user_case_idx" ON '
+            '"dispute_resolution_contractcase_party" ("user_id", '
+            '"contractcase_id")',
+            'DROP INDEX "contractcase_party_user_case_idx"'),
+        migrations.RunPython(count_cases, migrations.RunPython.noop),
+    ]
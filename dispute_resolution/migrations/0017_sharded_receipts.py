@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0016_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='eventreceipt',
+            name='event',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='receipts', to='dispute_resolution.NotifyEvent'),
+        ),
+        migrations.AlterField(
+            model_name='eventreceipt',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='event_receipts', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='eventwatermark',
+            name='user',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='event_watermark', serialize=False, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispute_resolution', '0017_sharded_receipts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='contractstage',
+            name='result_verification',
+            field=models.CharField(choices=[('none', 'No result'), ('pending', 'Pending'), ('verified', 'Verified'), ('mismatch', 'Hash mismatch'), ('missing', 'File missing'), ('unverifiable', 'No keccak-256 to check with')], default='none', max_length=12),
+        ),
+    ]
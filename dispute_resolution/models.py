@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
-from django.db import models
+from django.db import DatabaseError, connections, models, router, \
+    transaction
 from django.contrib.auth.models import (
     AbstractBaseUser
 )
-from django.db.models import PROTECT, CASCADE
+from django.db.models import PROTECT, CASCADE, DO_NOTHING, Q
+
+from dispute_resolution.sharding import ShardedManager
 
 
 class UserManager(BaseUserManager):
@@ -57,9 +61,9 @@ class User(AbstractBaseUser):
         unique=True,
     )
     name = models.CharField(max_length=150, verbose_name='Name',
-                            null=False, blank=False)
+                            null=False, blank=False, db_index=True)
     family_name = models.CharField(max_length=150, verbose_name='Family',
-                                   null=False, blank=False)
+                                   null=False, blank=False, db_index=True)
 
     active = models.BooleanField(default=True)
     judge = models.BooleanField(default=False)
@@ -130,7 +134,75 @@ class UserInfo(models.Model):
                                            user=self.user)
 
 
-class ContractCase(models.Model):
+class ConcurrentUpdateError(DatabaseError):
+    """The row was changed by someone else since it was loaded."""
+
+
+class VersionedModel(models.Model):
+    """
+    Optimistic concurrency control: every save of a loaded row is an
+    ``UPDATE ... WHERE version = <loaded version>`` that also increments
+    the version, and raises ``ConcurrentUpdateError`` instead of
+    overwriting a newer version. Queryset ``update()`` calls must bump
+    ``version`` themselves.
+    """
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | \
+                {'version'}
+        using = kwargs.get('using') or \
+            router.db_for_write(type(self), instance=self)
+        self.version += 1
+        try:
+            if connections[using].in_atomic_block:
+                # a conflict must not break the enclosing transaction
+                with transaction.atomic(using=using):
+                    super().save(*args, **kwargs)
+            else:
+                super().save(*args, **kwargs)
+        except BaseException:
+            self.version -= 1
+            raise
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        # save() has already incremented the version
+        updated = super()._do_update(
+            base_qs.filter(version=self.version - 1), using, pk_val, values,
+            update_fields, forced_update)
+        if not updated and base_qs.filter(pk=pk_val).exists():
+            raise ConcurrentUpdateError(
+                '{} {} was changed concurrently.'.format(
+                    self._meta.object_name, pk_val))
+        return updated
+
+
+def save_with_retry(instance, change, attempts=None):
+    """
+    Apply ``change(instance)`` and save it; when the row was changed
+    meanwhile, reload it and apply the change again, at most ``attempts``
+    (``CONCURRENT_UPDATE_ATTEMPTS``) times.
+    """
+    attempts = attempts or settings.CONCURRENT_UPDATE_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        change(instance)
+        try:
+            instance.save()
+            return instance
+        except ConcurrentUpdateError:
+            if attempt == attempts:
+                raise
+            instance.refresh_from_db()
+
+
+class ContractCase(VersionedModel):
     party = models.ManyToManyField(User, related_name='contracts')
     files = models.TextField(blank=True, null=True)
     finished = models.PositiveSmallIntegerField(default=0,
@@ -145,7 +217,7 @@ class ContractCase(models.Model):
                                                 state=self.finished)
 
 
-class ContractStage(models.Model):
+class ContractStage(VersionedModel):
     start = models.DateField(auto_now_add=False, null=False, blank=False)
     owner = models.ForeignKey(User, related_name='own_stages',
                               on_delete=PROTECT)
@@ -161,16 +233,60 @@ class ContractStage(models.Model):
     contract = models.ForeignKey(ContractCase, related_name='stages',
                                  on_delete=CASCADE)
     result_file = models.CharField(max_length=100, blank=True)
+    result_hash = models.CharField(max_length=250, blank=True)
+    result_verification = models.CharField(
+        max_length=12, default='none',
+        choices=[('none', 'No result'),
+                 ('pending', 'Pending'),
+                 ('verified', 'Verified'),
+                 ('mismatch', 'Hash mismatch'),
+                 ('missing', 'File missing'),
+                 ('unverifiable', 'No keccak-256 to check with')])
+    result_verified_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return 'Stage of {}'.format(self.contract)
 
+    class Meta:
+        indexes = [
+            # case timeline scans
+            models.Index(fields=['contract', 'start', 'id'],
+                         name='stage_timeline_idx'),
+        ]
+
     @property
     def dispute_has_started(self):
         return bool(self.dispute_started)
 
 
+class NotifyEventQuerySet(models.QuerySet):
+    def feed(self, user):
+        """
+        Events received by ``user``: each audience rule is an indexed
+        lookup, so the cost does not depend on the number of recipients.
+        """
+        cases = ContractCase.party.through.objects.filter(
+            user_id=user.pk).values('contractcase_id')
+        rules = Q(audience=NotifyEvent.TO_USER, user_to=user) | \
+            Q(audience=NotifyEvent.TO_PARTIES, contract__in=cases) & \
+            ~Q(user_by=user)
+        if user.judge:
+            rules |= Q(notify_judges=True)
+        return self.filter(rules)
+
+
 class NotifyEvent(models.Model):
+    """
+    A notification, stored once for all of its recipients: the parties of
+    the case but the sender, or ``user_to``; with ``notify_judges`` also
+    every judge. Whether a recipient has seen it is kept per user by
+    ``EventWatermark`` and ``EventReceipt``.
+    """
+    TO_PARTIES = 'parties'
+    TO_USER = 'user'
+
+    objects = NotifyEventQuerySet.as_manager()
+
     creation_date = models.DateTimeField(auto_now_add=True)
     contract = models.ForeignKey(ContractCase, related_name='events',
                                  on_delete=CASCADE)
@@ -178,9 +294,12 @@ class NotifyEvent(models.Model):
                               on_delete=CASCADE)
     user_by = models.ForeignKey(User, related_name='events_emitted',
                                 on_delete=CASCADE)
+    audience = models.CharField(max_length=10, default=TO_USER,
+                                choices=[(TO_PARTIES, 'Parties of the case'),
+                                         (TO_USER, 'Explicit recipient')])
     user_to = models.ForeignKey(User, related_name='events_received',
-                                on_delete=CASCADE)
-    seen = models.BooleanField(default=False)
+                                null=True, blank=True, on_delete=CASCADE)
+    notify_judges = models.BooleanField(default=False)
     event_type = models.CharField(max_length=10,
                                   default='open',
                                   choices=[('open', 'Case Opened'),
@@ -189,10 +308,108 @@ class NotifyEvent(models.Model):
                                            ('disp_close', 'Dispute Closed')])
 
     def __str__(self):
-        return '{} by {} to {} for {}'.format(self.event_type,
-                                              self.user_by,
-                                              self.user_to,
-                                              self.contract)
+        return '{} by {} to {} for {}'.format(
+            self.event_type, self.user_by,
+            self.user_to if self.audience == self.TO_USER else 'parties',
+            self.contract)
 
     class Meta:
         ordering = ('-id',)
+        indexes = [
+            # case timeline scans
+            models.Index(fields=['contract', 'creation_date', 'id'],
+                         name='event_timeline_idx'),
+            models.Index(fields=['notify_judges', 'id'],
+                         name='event_judges_idx'),
+        ]
+
+
+class CaseCounters(models.Model):
+    """
+    Numbers of open, pending and finished cases of ``user`` and of active
+    disputes in them, kept up to date by ``counters``.
+    """
+    user = models.OneToOneField(User, primary_key=True,
+                                related_name='case_counters',
+                                on_delete=CASCADE)
+    open = models.PositiveIntegerField(default=0)
+    pending = models.PositiveIntegerField(default=0)
+    finished = models.PositiveIntegerField(default=0)
+    disputes = models.PositiveIntegerField(default=0)
+
+
+class EventWatermark(models.Model):
+    """
+    ``user`` has seen every event of their feed up to ``event_id``; kept on
+    the shard of the user (see ``sharding``).
+    """
+    objects = ShardedManager()
+
+    user = models.OneToOneField(User, primary_key=True,
+                                related_name='event_watermark',
+                                db_constraint=False, on_delete=DO_NOTHING)
+    event_id = models.BigIntegerField(default=0)
+
+
+class EventReceipt(models.Model):
+    """
+    ``user`` has seen ``event``, which is above their watermark; kept on
+    the shard of the user (see ``sharding``).
+    """
+    objects = ShardedManager()
+
+    event = models.ForeignKey(NotifyEvent, related_name='receipts',
+                              db_constraint=False, on_delete=DO_NOTHING)
+    user = models.ForeignKey(User, related_name='event_receipts',
+                             db_constraint=False, on_delete=DO_NOTHING)
+
+    class Meta:
+        unique_together = ('user', 'event')
+
+
+class Blob(models.Model):
+    """
+    A file in the content-addressed blob store, keyed by its sha256.
+    ``refcount`` counts the case, user-info and stage fields referencing it;
+    unreferenced blobs are removed by ``manage.py gc_blobs``.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{} ({} bytes)'.format(self.sha256, self.size)
+
+
+class Job(models.Model):
+    """A call of a registered task, run by ``manage.py run_workers``."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+
+    task = models.CharField(max_length=100)
+    args = models.TextField(default='[]')
+    # higher runs first
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=10, default=QUEUED,
+                              choices=[(QUEUED, 'Queued'),
+                                       (RUNNING, 'Running'),
+                                       (FAILED, 'Failed')])
+    run_after = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # claiming: the due jobs of the highest priority, oldest first
+            models.Index(fields=['status', '-priority', 'run_after', 'id'],
+                         name='job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return '{} #{} ({})'.format(self.task, self.pk, self.status)
@@ -0,0 +1,97 @@
+"""
+Versioned cache of serialized objects.
+
+Representations are stored in the ``OBJECT_CACHE_ALIAS`` cache under
+``<kind>:<pk>:<version>``, where the version of an object is a counter
+kept under ``<kind>:v:<pk>``. Invalidating an object bumps its counter,
+so stale entries are never read again and simply expire; with a cache
+shared between processes (file based, memcached) every process sees the
+invalidation at once.
+
+Versions are read before objects are loaded from the database, so a write
+that commits meanwhile bumps the version past the one a stale
+representation gets stored under.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class VersionedCache:
+    def __init__(self, kind, get_queryset, serializer_class):
+        self.kind = kind
+        self.get_queryset = get_queryset
+        self.serializer_class = serializer_class
+
+    @property
+    def cache(self):
+        return caches[settings.OBJECT_CACHE_ALIAS]
+
+    def _version_key(self, pk):
+        return '{}:v:{}'.format(self.kind, pk)
+
+    def _entry_key(self, pk, version):
+        return '{}:{}:{}'.format(self.kind, pk, version)
+
+    def _versions(self, pks):
+        keys = {self._version_key(pk): pk for pk in pks}
+        found = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            # a counter that was evicted must not restart at a value an
+            # older entry may still be stored under
+            start = time.time_ns()
+            for key in missing:
+                self.cache.add(key, start, timeout=None)
+            found.update(self.cache.get_many(missing))
+        return {keys[key]: version for key, version in found.items()}
+
+    def get_many(self, pks):
+        """
+        Representations of the objects with the given primary keys, from
+        the cache or else loaded in one query and cached; missing objects
+        are left out.
+        """
+        pks = set(pks)
+        if not pks:
+            return {}
+        versions = self._versions(pks)
+        keys = {self._entry_key(pk, version): pk
+                for pk, version in versions.items()}
+        found = {keys[key]: data
+                 for key, data in self.cache.get_many(keys).items()}
+        missing = pks - found.keys()
+        if missing:
+            loaded = {obj.pk: dict(self.serializer_class(obj).data)
+                      for obj in self.get_queryset().filter(pk__in=missing)}
+            self.cache.set_many(
+                {self._entry_key(pk, versions[pk]): data
+                 for pk, data in loaded.items() if pk in versions},
+                timeout=settings.OBJECT_CACHE_TIMEOUT)
+            found.update(loaded)
+        return found
+
+    def get(self, pk):
+        return self.get_many([pk]).get(pk)
+
+    def invalidate(self, pk):
+        self._bump(pk)
+        # again once the change is visible to other connections, in case
+        # one of them cached the old state in between
+        transaction.on_commit(lambda: self._bump(pk))
+
+    def invalidate_many(self, pks):
+        """Invalidate many objects at once, e.g. after a bulk insert."""
+        # a counter that is gone restarts past every version used so far
+        keys = [self._version_key(pk) for pk in pks]
+        self.cache.delete_many(keys)
+        transaction.on_commit(lambda: self.cache.delete_many(keys))
+
+    def _bump(self, pk):
+        key = self._version_key(pk)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, time.time_ns(), timeout=None)
@@ -1,13 +1,90 @@
+from django.db.models import BooleanField, Exists, OuterRef, Q, Value
 from rest_framework import permissions
 from rest_framework.permissions import BasePermission
 
+from dispute_resolution.models import ContractCase, ContractStage, \
+    NotifyEvent, UserInfo
+
+
+def sees_all_cases(user):
+    """Judges and admins may see every case, others only their own."""
+    return getattr(user, 'is_judge', False) or \
+        getattr(user, 'is_admin', False) or user.is_staff
+
+
+def annotate_party(queryset, user, case_ref='pk'):
+    """
+    Annotate ``is_party``: whether ``user`` is a party of the case referenced
+    by ``case_ref``, as an EXISTS on the (case, user) membership index.
+    """
+    membership = ContractCase.party.through.objects.filter(
+        contractcase_id=OuterRef(case_ref), user_id=user.pk)
+    return queryset.annotate(is_party=Exists(membership))
+
+
+def scope_cases(queryset, user, case_ref='pk'):
+    """
+    Restrict ``queryset`` to the cases ``user`` may see. Non-privileged users
+    are resolved through the membership index on ``user_id`` so only their
+    own rows are touched; everybody gets the ``is_party`` flag.
+    """
+    if sees_all_cases(user):
+        return annotate_party(queryset, user, case_ref)
+    own_cases = ContractCase.party.through.objects.filter(
+        user_id=user.pk).values('contractcase_id')
+    return queryset.filter(**{case_ref + '__in': own_cases}) \
+        .annotate(is_party=Value(True, output_field=BooleanField()))
+
+
+def is_party(user, case):
+    if hasattr(case, 'is_party'):
+        return case.is_party
+    return case.party.filter(pk=user.pk).exists()
+
+
+class AdminPermission(BasePermission):
+    message = 'Only admins are allowed to do this.'
+
+    def has_permission(self, request, view):
+        return request.user.is_authenticated and \
+            getattr(request.user, 'is_admin', False)
+
+
+class BlobPermission(BasePermission):
+    """
+    A blob may be read by those who may see a case whose files or stage
+    result reference it, the owner of such a stage, and the user whose
+    info references it.
+    """
+    message = 'Reading files of others is not allowed.'
+
+    def has_permission(self, request, view):
+        user = request.user
+        if not user.is_authenticated:
+            return False
+        if sees_all_cases(user):
+            return True
+        digest = view.kwargs.get('digest')
+        if digest is None:
+            # the schema lists the endpoint without a particular blob
+            return True
+        own_cases = ContractCase.party.through.objects.filter(
+            user_id=user.pk).values('contractcase_id')
+        return ContractCase.objects.filter(
+            pk__in=own_cases, files__contains=digest).exists() or \
+            ContractStage.objects.filter(
+                Q(contract__in=own_cases) | Q(owner=user),
+                result_file__contains=digest).exists() or \
+            UserInfo.objects.filter(user=user,
+                                    files__contains=digest).exists()
+
 
 class CasePermission(BasePermission):
     message = 'Changing other\'s cases is not allowed.'
 
     def has_object_permission(self, request, view, obj):
         if request.method in permissions.SAFE_METHODS or \
-                request.method != 'DELETE' and request.user in obj.in_party:
+                request.method != 'DELETE' and is_party(request.user, obj):
             return True
         return False
 
@@ -27,13 +104,20 @@ class NotificationPermission(BasePermission):
     message = 'Manipulations with others notifications is not allowed.'
 
     def has_permission(self, request, view):
-        if request.method == 'POST':
+        if request.method == 'POST' and view.action == 'create':
             # only admin is allowed to create notifications
             return request.user.is_admin
         return True
 
     def has_object_permission(self, request, view, obj):
-        return request.user == obj.user_to
+        # the queryset only holds the user's own events; events shared
+        # with other recipients may only be marked seen
+        if request.method in permissions.SAFE_METHODS or \
+                request.user.is_admin:
+            return True
+        if obj.audience == NotifyEvent.TO_USER and not obj.notify_judges:
+            return request.user.pk == obj.user_to_id
+        return request.method == 'PATCH' and set(request.data) <= {'seen'}
 
 
 class UserPermission(BasePermission):
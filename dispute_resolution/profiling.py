@@ -0,0 +1,97 @@
+"""
+Profiles of single requests, kept in a bounded ring on disk.
+
+``ProfilerMiddleware`` profiles a request with cProfile and records its
+SQL statements when the request carries the ``PROFILER_SECRET`` (as
+``X-Profile`` header or ``_profile`` query parameter) or is picked by
+``PROFILER_SAMPLE_RATE``. Every profile is a ``<id>.prof`` file (pstats
+format, e.g. for snakeviz) and a ``<id>.json`` file with the request, its
+timings and SQL; only the newest ``PROFILER_MAX_PROFILES`` are kept.
+"""
+import io
+import json
+import os
+import pstats
+import re
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+
+PROFILE_ID_RE = re.compile(r'^\d{20}-[0-9a-f]{8}$')
+STATS_SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+
+def new_profile_id():
+    # sorts by creation time
+    return '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+
+
+def _path(profile_id, ext):
+    if not PROFILE_ID_RE.match(profile_id):
+        raise ValueError(profile_id)
+    return os.path.join(settings.PROFILER_DIR,
+                        '{}.{}'.format(profile_id, ext))
+
+
+def _profile_ids():
+    try:
+        names = os.listdir(settings.PROFILER_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-5] for name in names
+                  if name.endswith('.json') and PROFILE_ID_RE.match(name[:-5]))
+
+
+def save_profile(profile_id, profiler, meta):
+    """Store a finished ``cProfile.Profile`` and drop the oldest profiles."""
+    os.makedirs(settings.PROFILER_DIR, exist_ok=True)
+    profiler.dump_stats(_path(profile_id, 'prof'))
+    meta = dict(meta, id=profile_id, created=timezone.now().isoformat())
+    fd, tmp_path = tempfile.mkstemp(dir=settings.PROFILER_DIR)
+    with os.fdopen(fd, 'w') as tmp:
+        json.dump(meta, tmp)
+    # the JSON file makes the profile visible, so it comes last
+    os.replace(tmp_path, _path(profile_id, 'json'))
+
+    ids = _profile_ids()
+    for old_id in ids[:max(0, len(ids) - settings.PROFILER_MAX_PROFILES)]:
+        for ext in ('json', 'prof'):
+            try:
+                os.remove(_path(old_id, ext))
+            except FileNotFoundError:
+                pass
+
+
+def load_profile(profile_id):
+    """The metadata and SQL of a profile; FileNotFoundError if gone."""
+    with open(_path(profile_id, 'json')) as meta:
+        return json.load(meta)
+
+
+def list_profiles():
+    """Metadata of the stored profiles without their SQL, newest first."""
+    profiles = []
+    for profile_id in reversed(_profile_ids()):
+        try:
+            meta = load_profile(profile_id)
+        except FileNotFoundError:
+            continue
+        meta.pop('sql', None)
+        profiles.append(meta)
+    return profiles
+
+
+def profile_path(profile_id):
+    return _path(profile_id, 'prof')
+
+
+def render_stats(profile_id, sort='cumulative', limit=50):
+    """The ``limit`` top functions of a profile as pstats prints them."""
+    out = io.StringIO()
+    stats = pstats.Stats(profile_path(profile_id), stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
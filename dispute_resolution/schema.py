@@ -0,0 +1,135 @@
+"""
+API schema generated once per code version.
+
+Introspecting every viewset and serializer is slow, so the schema behind
+the root URL is built once per code version and audience, kept in memory
+and, with ``SCHEMA_CACHE_DIR`` set, on disk, where ``manage.py
+build_schema`` can precompute it at deploy time. The code version is
+``SCHEMA_VERSION`` when set (e.g. the deployed revision), otherwise a hash
+of the project's source files.
+
+The schema only lists the endpoints a user may call; outside of object
+permissions our permission classes only depend on whether the user is
+authenticated and an admin, so there are three audiences.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+import rest_framework
+from coreapi.codecs import CoreJSONCodec
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpRequest
+from rest_framework.request import Request
+from rest_framework.schemas import SchemaGenerator
+
+from dispute_resolution.models import User
+
+
+SCHEMA_TITLE = 'Dispute Resolution API'
+AUDIENCES = ('anonymous', 'user', 'admin')
+SOURCE_PACKAGES = ('dispute_resolution', 'drm_server')
+
+_schemas = {}
+_source_version = None
+_lock = threading.Lock()
+
+
+def schema_audience(user):
+    if not user.is_authenticated:
+        return 'anonymous'
+    return 'admin' if getattr(user, 'is_admin', False) else 'user'
+
+
+def code_version():
+    global _source_version
+    if settings.SCHEMA_VERSION:
+        return settings.SCHEMA_VERSION
+    if _source_version is None:
+        digest = hashlib.sha256(rest_framework.VERSION.encode())
+        for package in SOURCE_PACKAGES:
+            root = os.path.join(settings.BASE_DIR, package)
+            for directory, dirs, files in os.walk(root):
+                dirs.sort()
+                for name in sorted(files):
+                    if not name.endswith('.py'):
+                        continue
+                    path = os.path.join(directory, name)
+                    digest.update(os.path.relpath(path, root).encode())
+                    with open(path, 'rb') as source:
+                        digest.update(source.read())
+        _source_version = digest.hexdigest()[:16]
+    return _source_version
+
+
+def generate_schema(audience):
+    """Introspect the URL conf as seen by a user of ``audience``."""
+    request = Request(HttpRequest())
+    request.method = 'GET'
+    if audience == 'anonymous':
+        request.user = AnonymousUser()
+    else:
+        request.user = User(email='schema@localhost',
+                            admin=audience == 'admin')
+    # the URL is filled in per request
+    return SchemaGenerator(title=SCHEMA_TITLE, url='/').get_schema(
+        request=request)
+
+
+def _cache_path(version, audience):
+    return os.path.join(settings.SCHEMA_CACHE_DIR,
+                        'schema-{}-{}.json'.format(version, audience))
+
+
+def _load(version, audience):
+    if not settings.SCHEMA_CACHE_DIR:
+        return None
+    try:
+        with open(_cache_path(version, audience), 'rb') as cached:
+            return CoreJSONCodec().decode(cached.read())
+    except FileNotFoundError:
+        return None
+
+
+def _store(version, audience, schema):
+    if not settings.SCHEMA_CACHE_DIR:
+        return
+    os.makedirs(settings.SCHEMA_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.SCHEMA_CACHE_DIR)
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(CoreJSONCodec().encode(schema))
+    os.replace(tmp_path, _cache_path(version, audience))
+
+
+def build_schema(audience):
+    """(Re)generate the schema of the current code version and store it."""
+    key = (code_version(), audience)
+    schema = generate_schema(audience)
+    if schema is not None:
+        _store(*key, schema)
+    with _lock:
+        _schemas[key] = schema
+    return schema
+
+
+def get_schema(audience):
+    """The schema for ``audience``: from memory, disk or built on first use."""
+    key = (code_version(), audience)
+    if key in _schemas:
+        return _schemas[key]
+    with _lock:
+        if key not in _schemas:
+            schema = _load(*key)
+            if schema is None:
+                schema = generate_schema(audience)
+                if schema is not None:
+                    _store(*key, schema)
+            _schemas[key] = schema
+        return _schemas[key]
+
+
+def clear_cache():
+    with _lock:
+        _schemas.clear()
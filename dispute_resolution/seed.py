@@ -0,0 +1,148 @@
+"""
+Synthetic data for load and benchmark runs.
+
+Everything is written with ``bulk_create``; rows of one run share a random
+tag in their emails and case names so they can be read back (and told apart
+from real data) without relying on the backend returning inserted ids.
+Events are written with ``bulk_insert``, their receipts need the ids; the
+receipts go to the shards of their users in one batch per shard.
+"""
+import datetime
+import hashlib
+import random
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from dispute_resolution.bulk import bulk_insert
+from dispute_resolution.counters import refresh_counters
+from dispute_resolution.models import User, UserInfo, ContractCase, \
+    ContractStage, NotifyEvent, EventReceipt
+from dispute_resolution.serializers import user_cache, user_info_cache
+
+
+BATCH_SIZE = 500
+
+
+def _eth_account(tag, num):
+    digest = hashlib.sha1('{}-{}'.format(tag, num).encode()).hexdigest()
+    return '0x' + digest
+
+
+def _fan_out(case_party, sender, judges):
+    return [user_id for user_id in case_party if user_id != sender] + judges
+
+
+def seed(users=100, cases=100, judges=3, parties=2, stages=3,
+         password='password', random_seed=None):
+    """
+    Create ``users`` parties plus ``judges`` judges (all with ``UserInfo``),
+    ``cases`` contract cases with ``parties`` members and ``stages`` stages
+    each, and the events the ingestion endpoint would have produced for
+    their lifecycle, about half of them seen by each recipient. Returns
+    the number of rows per model.
+    """
+    rnd = random.Random(random_seed)
+    tag = uuid.uuid4().hex[:8]
+    pwd_hash = make_password(password)
+    today = datetime.date.today()
+
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [User(email='seed-{}-{}@example.com'.format(tag, num),
+                  name='Seed{}'.format(num), family_name=tag,
+                  password=pwd_hash, judge=num >= users)
+             for num in range(users + judges)],
+            batch_size=BATCH_SIZE)
+        user_ids = dict(User.objects.filter(family_name=tag)
+                        .values_list('email', 'id'))
+        user_ids = [user_ids['seed-{}-{}@example.com'.format(tag, num)]
+                    for num in range(users + judges)]
+        party_ids, judge_ids = user_ids[:users], user_ids[users:]
+
+        UserInfo.objects.bulk_create(
+            [UserInfo(user_id=user_id, eth_account=_eth_account(tag, num),
+                      organization_name='Org {}'.format(num % 50),
+                      payment_num=str(num).zfill(16))
+             for num, user_id in enumerate(user_ids)],
+            batch_size=BATCH_SIZE)
+        # ids of rolled back rows may be handed out again
+        user_cache.invalidate_many(user_ids)
+        user_info_cache.invalidate_many(UserInfo.objects.filter(
+            user__family_name=tag).values_list('id', flat=True))
+
+        ContractCase.objects.bulk_create(
+            [ContractCase(name='seed-{} #{}'.format(tag, num),
+                          finished=rnd.choice((0, 0, 1, 2)))
+             for num in range(cases)],
+            batch_size=BATCH_SIZE)
+        case_rows = list(ContractCase.objects
+                         .filter(name__startswith='seed-{} #'.format(tag))
+                         .order_by('id').values_list('id', 'finished'))
+
+        Membership = ContractCase.party.through
+        members = {}
+        memberships = []
+        for case_id, _ in case_rows:
+            members[case_id] = rnd.sample(party_ids,
+                                          min(parties, len(party_ids)))
+            memberships.extend(Membership(contractcase_id=case_id,
+                                          user_id=user_id)
+                               for user_id in members[case_id])
+        Membership.objects.bulk_create(memberships, batch_size=BATCH_SIZE)
+
+        stage_objs = []
+        for case_id, _ in case_rows:
+            for num in range(stages):
+                start = today - datetime.timedelta(days=30 * (stages - num))
+                disputed = rnd.random() < 0.2
+                stage_objs.append(ContractStage(
+                    contract_id=case_id,
+                    owner_id=rnd.choice(members[case_id]),
+                    start=start,
+                    dispute_start_allowed=start + datetime.timedelta(days=7),
+                    dispute_started=(start + datetime.timedelta(days=10)
+                                     if disputed else None),
+                    dispute_starter_id=(rnd.choice(members[case_id])
+                                        if disputed else None)))
+        ContractStage.objects.bulk_create(stage_objs, batch_size=BATCH_SIZE)
+        stage_ids = {}
+        for stage_id, case_id in ContractStage.objects.filter(
+                contract__name__startswith='seed-{} #'.format(tag)
+        ).order_by('id').values_list('id', 'contract_id'):
+            stage_ids.setdefault(case_id, []).append(stage_id)
+
+        events, recipients = [], []
+        for case_id, finished in case_rows:
+            party = members[case_id]
+            lifecycle = [('open', stage_ids[case_id][0])]
+            for stage_id in stage_ids[case_id]:
+                if rnd.random() < 0.2:
+                    lifecycle.append(('disp_open', stage_id))
+                    lifecycle.append(('disp_close', stage_id))
+            if finished:
+                lifecycle.append(('fin', stage_ids[case_id][-1]))
+            for event_type, stage_id in lifecycle:
+                sender = rnd.choice(party)
+                events.append(NotifyEvent(
+                    contract_id=case_id, stage_id=stage_id,
+                    user_by_id=sender, audience=NotifyEvent.TO_PARTIES,
+                    notify_judges=True, event_type=event_type))
+                recipients.append(_fan_out(party, sender, judge_ids))
+        events = bulk_insert(NotifyEvent, events, batch_size=BATCH_SIZE)
+        receipts = [EventReceipt(event_id=event.pk, user_id=user_id)
+                    for event, users in zip(events, recipients)
+                    for user_id in users if rnd.random() < 0.5]
+        EventReceipt.objects.bulk_create(receipts, batch_size=BATCH_SIZE)
+        refresh_counters(party_ids)
+
+    return {
+        'users': len(user_ids),
+        'judges': len(judge_ids),
+        'cases': len(case_rows),
+        'memberships': len(memberships),
+        'stages': len(stage_objs),
+        'events': len(events),
+        'receipts': len(receipts),
+    }
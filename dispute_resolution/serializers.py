@@ -1,23 +1,69 @@
 import logging
 
+from django.contrib.auth import authenticate
+from django.db import models, transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from django.utils import timezone
 from rest_framework import serializers
 
+from dispute_resolution import feeds
+from dispute_resolution.blobstore import adjust_refcounts, blob_refs
+from dispute_resolution.bulk import bulk_insert
+from dispute_resolution.counters import schedule_refresh
+from dispute_resolution.db import run_serialized_write
+from dispute_resolution.metrics import SerializerTimingMixin
+from dispute_resolution.objectcache import VersionedCache
+from dispute_resolution.verification import schedule_verification
 from dispute_resolution.models import UserInfo, User, ContractCase, \
-    ContractStage, NotifyEvent
+    ContractStage, NotifyEvent, Blob, save_with_retry
 
 
 logger = logging.getLogger(__name__)
 
 
-class UserInfoSerializer(serializers.ModelSerializer):
+class TokenObtainSerializer(serializers.Serializer):
+    email = serializers.EmailField()
+    password = serializers.CharField(style={'input_type': 'password'},
+                                     trim_whitespace=False)
+
+    def validate(self, attrs):
+        user = authenticate(request=self.context.get('request'),
+                            username=attrs['email'],
+                            password=attrs['password'])
+        if user is None:
+            raise serializers.ValidationError(
+                'Unable to log in with provided credentials.',
+                code='authorization')
+        attrs['user'] = user
+        return attrs
+
+
+class UserImportSerializer(serializers.Serializer):
+    """
+    One row of a bulk user import. Uniqueness is checked by the importer
+    for a whole chunk at once, so there are no per-row unique validators.
+    """
+    email = serializers.EmailField(max_length=255)
+    name = serializers.CharField(max_length=150)
+    family_name = serializers.CharField(max_length=150)
+    password = serializers.CharField(required=False, allow_blank=True,
+                                     trim_whitespace=False)
+    eth_account = serializers.CharField(max_length=70)
+    organization_name = serializers.CharField(max_length=150,
+                                              required=False)
+    tax_num = serializers.CharField(max_length=15, required=False,
+                                    allow_blank=True, allow_null=True)
+    payment_num = serializers.CharField(max_length=40, required=False)
+
+
+class UserInfoSerializer(SerializerTimingMixin, serializers.ModelSerializer):
     class Meta:
         model = UserInfo
         extra_kwargs = {'user': {'required': False}}
         fields = '__all__'
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SerializerTimingMixin, serializers.ModelSerializer):
     info = UserInfoSerializer()
 
     class Meta:
@@ -49,33 +95,189 @@ class UserSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
-class ContractStageSerializer(serializers.ModelSerializer):
+user_info_cache = VersionedCache('userinfo', UserInfo.objects.all,
+                                 UserInfoSerializer)
+user_cache = VersionedCache('user', User.objects.select_related('info').all,
+                            UserSerializer)
+
+
+class CachedUsersField(serializers.Field):
+    """
+    Read-only list of users rendered by ``UserSerializer`` through
+    ``user_cache``. Only the primary keys of the related users are used;
+    a list serializer may put the representations of all users it needs
+    into ``context['users']`` beforehand.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, users):
+        pks = [user.pk for user in users.all()]
+        rendered = self.context.get('users', {})
+        if not rendered.keys() >= set(pks):
+            rendered = user_cache.get_many(pks)
+        return [rendered[pk] for pk in pks if pk in rendered]
+
+
+def party_prefetch():
+    """Prefetch of case parties for ``CachedUsersField``: just the ids."""
+    return Prefetch('party', queryset=User.objects.only('id'))
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Resolves primary keys from ``context['preloaded'][model]`` when a bulk
+    serializer has loaded the referenced rows up front, instead of running
+    one query per value.
+    """
+
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        preloaded = self.context.get('preloaded', {}).get(model)
+        if preloaded is None:
+            return super().to_internal_value(data)
+        try:
+            return preloaded[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class ContractStageSerializer(SerializerTimingMixin,
+                              serializers.ModelSerializer):
+    owner = PreloadedPrimaryKeyRelatedField(queryset=User.objects.all())
+    dispute_starter = PreloadedPrimaryKeyRelatedField(
+        queryset=User.objects.all(), allow_null=True, required=False)
+
     class Meta:
         model = ContractStage
         exclude = ('contract',)
+        read_only_fields = ('result_hash', 'result_verification',
+                            'result_verified_at', 'version')
+
+
+def _pk_values(values):
+    for value in values:
+        try:
+            yield int(value)
+        except (TypeError, ValueError):
+            pass
+
 
+def create_cases(items):
+    """
+    Create cases from validated data together with their party memberships
+    and stages: one atomic block and a fixed number of statements however
+    many cases there are.
+    """
+    Membership = ContractCase.party.through
+    with transaction.atomic():
+        cases = bulk_insert(ContractCase, [
+            ContractCase(**{name: value for name, value in item.items()
+                            if name not in ('party', 'stages')})
+            for item in items])
+        Membership.objects.bulk_create([
+            Membership(contractcase_id=case.pk, user_id=user_id)
+            for case, item in zip(cases, items)
+            for user_id in {user.pk for user in item['party']}])
+        stages = bulk_insert(ContractStage, [
+            ContractStage(contract=case, **stage)
+            for case, item in zip(cases, items)
+            for stage in item['stages']])
+        # bulk inserts bypass the signals keeping blob refcounts and case
+        # counters
+        adjust_refcounts(
+            [digest for case in cases for digest in blob_refs(case.files)] +
+            [digest for stage in stages
+             for digest in blob_refs(stage.result_file)])
+        schedule_refresh(user.pk for item in items for user in item['party'])
+    prefetch_related_objects(cases, 'stages', party_prefetch())
+    return cases
 
-class ContractCaseSerializer(serializers.ModelSerializer):
+
+class ContractCaseListSerializer(serializers.ListSerializer):
+    """
+    Validates a list of cases with all referenced users loaded in one query
+    and creates them through ``create_cases``.
+    """
+    max_items = 10000
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            if len(data) > self.max_items:
+                raise serializers.ValidationError({
+                    'non_field_errors': ['At most {} cases per request.'
+                                         .format(self.max_items)]})
+            self._preload_users(data)
+        return super().to_internal_value(data)
+
+    def _preload_users(self, data):
+        pks = set()
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            party = item.get('party')
+            if isinstance(party, list):
+                pks.update(_pk_values(party))
+            stages = item.get('stages')
+            for stage in stages if isinstance(stages, list) else ():
+                if isinstance(stage, dict):
+                    pks.update(_pk_values((stage.get('owner'),
+                                           stage.get('dispute_starter'))))
+        self.context.setdefault('preloaded', {})[User] = \
+            User.objects.in_bulk(pks)
+
+    def create(self, validated_data):
+        return create_cases(validated_data)
+
+    def to_representation(self, data):
+        cases = data.all() if isinstance(data, models.Manager) else data
+        # all parties of the page in one cache round trip
+        self._context['users'] = user_cache.get_many(
+            user.pk for case in cases for user in case.party.all())
+        return super().to_representation(cases)
+
+
+class ContractCaseSerializer(SerializerTimingMixin,
+                             serializers.ModelSerializer):
     stages = ContractStageSerializer(many=True)
-    in_party = UserSerializer(many=True, read_only=True, source='party')
-    party = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(),
-                                               many=True, write_only=True,
-                                               allow_empty=False)
+    in_party = CachedUsersField(source='party')
+    party = PreloadedPrimaryKeyRelatedField(queryset=User.objects.all(),
+                                            many=True, write_only=True,
+                                            allow_empty=False)
 
     class Meta:
         model = ContractCase
         fields = '__all__'
         depth = 1
+        list_serializer_class = ContractCaseListSerializer
+        read_only_fields = ('version',)
 
     def create(self, validated_data):
-        stages_data = validated_data.pop('stages')
-        contract = super().create(validated_data)
-        for data in stages_data:
-            ContractStage.objects.create(contract=contract, **data)
-        return contract
+        return create_cases([validated_data])[0]
+
+
+class NotifyEventListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        events = list(data.all() if isinstance(data, models.Manager)
+                      else data)
+        recipient = self.context.get('recipient')
+        if recipient is not None and 'seen' not in self.context:
+            # the seen state of the whole page in one lookup
+            self._context['seen'] = feeds.seen_ids(
+                recipient, [event.pk for event in events])
+        return super().to_representation(events)
 
 
-class NotifyEventSerializer(serializers.ModelSerializer):
+class NotifyEventSerializer(SerializerTimingMixin,
+                            serializers.ModelSerializer):
+    """
+    Events as seen by ``context['recipient']``: ``user_to`` is the
+    recipient for events addressed to several users, ``seen`` is theirs.
+    """
     stage_num = serializers.IntegerField(required=False)
     address_to = serializers.CharField(max_length=44, allow_blank=True,
                                        allow_null=True, required=False)
@@ -84,10 +286,13 @@ class NotifyEventSerializer(serializers.ModelSerializer):
     filehash = serializers.CharField(max_length=250, allow_blank=True,
                                      allow_null=True, required=False)
     finished = serializers.BooleanField(default=False)
+    seen = serializers.BooleanField(required=False)
 
     class Meta:
         model = NotifyEvent
         fields = '__all__'
+        list_serializer_class = NotifyEventListSerializer
+        read_only_fields = ('audience', 'notify_judges')
         extra_kwargs = {
             'user_to': {
                 'required': False
@@ -107,14 +312,49 @@ class NotifyEventSerializer(serializers.ModelSerializer):
             }
         }
 
+    def to_representation(self, event):
+        data = super().to_representation(event)
+        recipient = self.context.get('recipient')
+        if recipient is None:
+            data['seen'] = False
+            return data
+        seen = self.context.get('seen')
+        if seen is None:
+            seen = feeds.seen_ids(recipient, [event.pk])
+        data['seen'] = event.pk in seen
+        if data['user_to'] is None:
+            data['user_to'] = recipient.pk
+        return data
+
+    def update(self, instance, validated_data):
+        seen = validated_data.pop('seen', None)
+        recipient = self.context.get('recipient')
+        if seen is not None and recipient is not None:
+            if seen:
+                run_serialized_write(feeds.mark_seen, recipient,
+                                     [instance.pk])
+            else:
+                run_serialized_write(feeds.mark_unseen, recipient,
+                                     instance.pk)
+        if not validated_data:
+            # the seen state is no part of the event row
+            return instance
+        return super().update(instance, validated_data)
+
     def create(self, validated_data):
+        return run_serialized_write(self._create, validated_data)
+
+    def _create(self, validated_data):
         stage_num = validated_data.pop('stage_num')
         case = validated_data.pop('contract')
         case_stages = case.stages.all()
-        stage_id = case_stages[stage_num].id
+        event_stage = case_stages[stage_num]
         address_to = validated_data.pop('address_to', None)
         address = validated_data.pop('address_by', None)
         finished = validated_data.pop('finished', None)
+        filehash = validated_data.pop('filehash', None)
+        validated_data.pop('seen', None)
+        validated_data.pop('user_to', None)
 
         if address:
             user_by = UserInfo.objects.get(eth_account=address).user
@@ -122,37 +362,49 @@ class NotifyEventSerializer(serializers.ModelSerializer):
             user_by = User.objects.get(id=1)
 
         if address_to:
-            user_to = [UserInfo.objects.get(eth_account=address_to).user]
+            recipient = {'audience': NotifyEvent.TO_USER,
+                         'user_to': UserInfo.objects.get(
+                             eth_account=address_to).user}
         else:
-            user_to = list(set(case.party.all()) - {user_by})
-        user_to.extend(User.objects.filter(judge=True).all())
-
-        event = {}
-        for uid in user_to:
-            user = User.objects.get(pk=uid) if type(uid) is not User else uid
-            event = NotifyEvent.objects.create(contract=case,
-                                               stage=ContractStage.objects.get(pk=stage_id),
-                                               user_by=user_by,
-                                               user_to=user,
-                                               **validated_data)
-
-        # update cases
-        if validated_data.get('event_type') == 'fin':
-            if finished:
-                case.finished = 2  # TODO: use proper ENUM
-            else:
-                case.finished = 1
-            case.save()
-        elif validated_data.get('event_type') == 'disp_open':
-            stage = case_stages[stage_num]
-            stage.disputed = True
-            stage.dispute_starter = user_by
-            stage.dispute_started = timezone.now().date()
-            stage.save()
-        elif validated_data.get('event_type') == 'disp_close':
-            stage = case_stages[stage_num]
-            stage.dispute_finished = timezone.now().date()
-            stage.result_files = validated_data.get('filehash')
-            stage.save()
+            recipient = {'audience': NotifyEvent.TO_PARTIES}
+        event = NotifyEvent.objects.create(contract=case,
+                                           stage=event_stage,
+                                           user_by=user_by,
+                                           notify_judges=True,
+                                           **recipient,
+                                           **validated_data)
+
+        # update cases; the case and stage may have changed since they
+        # were loaded, so changes are reapplied to the current rows
+        event_type = validated_data.get('event_type')
+        if event_type == 'fin':
+            def change(case):
+                case.finished = 2 if finished else 1  # TODO: use proper ENUM
+            save_with_retry(case, change)
+        elif event_type == 'disp_open':
+            def change(stage):
+                stage.disputed = True
+                stage.dispute_starter = user_by
+                stage.dispute_started = timezone.now().date()
+            save_with_retry(event_stage, change)
+        elif event_type == 'disp_close':
+            # the hash names the result file only when it is the sha256 of
+            # a stored blob; a keccak-256 hash from the chain is not
+            stored = Blob.objects.filter(
+                sha256__in=blob_refs(filehash)
+            ).values_list('sha256', flat=True).first() if filehash else None
+
+            def change(stage):
+                stage.dispute_finished = timezone.now().date()
+                if filehash:
+                    stage.result_hash = filehash
+                    stage.result_verification = 'pending'
+                    if not stage.result_file and stored:
+                        stage.result_file = stored
+            save_with_retry(event_stage, change)
+            if filehash:
+                # hashing a large file must not hold up the request
+                transaction.on_commit(
+                    lambda: schedule_verification(event_stage.pk))
 
         return event
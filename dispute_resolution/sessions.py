@@ -0,0 +1,95 @@
+"""
+Session engine keeping sessions in a local cache with write-behind to the
+database (``SESSION_ENGINE = 'dispute_resolution.sessions'``).
+
+Sessions are read from the ``SESSION_CACHE_ALIAS`` cache and only fall
+back to the database on a miss. New sessions are created in the database
+at once, which keeps session keys unique, but later changes only go to
+the cache and are written to the database by a background thread at most
+``SESSION_WRITE_BEHIND_DELAY`` seconds later (inline with 0), repeated
+saves of a session in between being written once. A crash loses the
+session changes of the last delay; another process without the session
+in its cache may read the older state from the database meanwhile.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.models import Session
+from django.db import close_old_connections, transaction
+
+from dispute_resolution.db import run_serialized_write
+
+
+logger = logging.getLogger(__name__)
+
+
+def _write_sessions(sessions):
+    with transaction.atomic():
+        for session in sessions:
+            # a session deleted meanwhile stays deleted
+            Session.objects.filter(session_key=session.session_key).update(
+                session_data=session.session_data,
+                expire_date=session.expire_date)
+
+
+class SessionWriter:
+    """Collects changed sessions and writes them in batches."""
+
+    def __init__(self):
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def schedule(self, session):
+        delay = settings.SESSION_WRITE_BEHIND_DELAY
+        if not delay:
+            run_serialized_write(_write_sessions, [session])
+            return
+        with self._lock:
+            self._pending[session.session_key] = session
+            if self._timer is None:
+                self._timer = threading.Timer(delay, self._flush_in_thread)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def discard(self, session_key):
+        with self._lock:
+            self._pending.pop(session_key, None)
+
+    def flush(self):
+        with self._lock:
+            sessions = list(self._pending.values())
+            self._pending.clear()
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        if sessions:
+            run_serialized_write(_write_sessions, sessions)
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Writing sessions failed')
+        finally:
+            close_old_connections()
+
+
+writer = SessionWriter()
+atexit.register(writer.flush)
+
+
+class SessionStore(cached_db.SessionStore):
+    def save(self, must_create=False):
+        if must_create or self.session_key is None:
+            return super().save(must_create=must_create)
+        data = self._get_session(no_load=False)
+        self._cache.set(self.cache_key, data, self.get_expiry_age())
+        writer.schedule(self.create_model_instance(data))
+
+    def delete(self, session_key=None):
+        writer.discard(session_key or self.session_key)
+        super().delete(session_key)
@@ -0,0 +1,134 @@
+"""
+Per-user "seen" state of notifications spread over the databases of
+``EVENT_SHARDS`` by recipient.
+
+``EventReceipt`` and ``EventWatermark`` rows are written on every event
+seen and are only ever read for one user, so all rows of a user live in
+the shard ``shard_for`` picks by a stable hash of the user id. Queries for
+a user go through ``objects.for_user``; ``objects.bulk_create`` groups the
+rows of many users per shard and ``objects.scatter`` gives a queryset per
+shard for queries over all users, whose results the caller gathers.
+``EventShardRouter`` sends saves and deletes of single rows, and related
+lookups from a user, to their shard and keeps the tables off the
+migrations of the other databases.
+
+Receipts and watermarks reference events and users by id only, without
+constraints: deleting a user drops their rows (see ``signals``), receipts
+of deleted events are left behind, which is harmless as ids are not
+reused and watermarks moving past them drop them.
+"""
+import zlib
+
+from django.conf import settings
+from django.db import models
+
+
+SHARDED_MODELS = {'eventreceipt', 'eventwatermark'}
+
+
+def shard_for(user_id):
+    """The database alias of the shard keeping the rows of ``user_id``."""
+    shards = settings.EVENT_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    return shards[zlib.crc32(str(user_id).encode()) % len(shards)]
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'dispute_resolution' and \
+        model._meta.model_name in SHARDED_MODELS
+
+
+class ShardedManager(models.Manager):
+    def for_user(self, user_id):
+        """The rows of ``user_id``, on their shard."""
+        return self.using(shard_for(user_id)).filter(user_id=user_id)
+
+    def scatter(self):
+        """One queryset of all rows per shard."""
+        return [self.using(alias) for alias in settings.EVENT_SHARDS]
+
+    def bulk_create(self, objs, **kwargs):
+        """Insert ``objs`` with one ``bulk_create`` per shard."""
+        objs = list(objs)
+        per_shard = {}
+        for obj in objs:
+            per_shard.setdefault(shard_for(obj.user_id), []).append(obj)
+        for alias, shard_objs in per_shard.items():
+            self.get_queryset().using(alias).bulk_create(shard_objs, **kwargs)
+        return objs
+
+
+def _user_id(instance):
+    if instance is None:
+        return None
+    if is_sharded(type(instance)):
+        return instance.user_id
+    if instance._meta.label_lower == settings.AUTH_USER_MODEL.lower():
+        return instance.pk
+    return None
+
+
+class EventShardRouter:
+    """Routes receipts and watermarks to the shard of their user."""
+
+    def _db_for(self, model, **hints):
+        if not is_sharded(model):
+            return None
+        user_id = _user_id(hints.get('instance'))
+        return None if user_id is None else shard_for(user_id)
+
+    db_for_read = _db_for
+    db_for_write = _db_for
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'dispute_resolution' and \
+                model_name in SHARDED_MODELS:
+            return db in settings.EVENT_SHARDS
+        if db != 'default' and db in settings.EVENT_SHARDS:
+            return False
+        return None
+
+
+def shard_stats():
+    """Numbers of receipts and watermarks per shard."""
+    from dispute_resolution.models import EventReceipt, EventWatermark
+
+    stats = {alias: {} for alias in settings.EVENT_SHARDS}
+    for name, model in (('receipts', EventReceipt),
+                        ('watermarks', EventWatermark)):
+        for queryset in model.objects.scatter():
+            stats[queryset.db][name] = queryset.count()
+    return stats
+
+
+def rebalance(batch_size=1000):
+    """
+    Move the rows kept on a shard other than their user's, e.g. after
+    shards were added; the number of rows moved.
+    """
+    from dispute_resolution.models import EventReceipt, EventWatermark
+
+    moved = 0
+    for model in (EventWatermark, EventReceipt):
+        for queryset in model.objects.scatter():
+            alias = queryset.db
+            misplaced = [user_id for user_id in queryset.order_by()
+                         .values_list('user_id', flat=True).distinct()
+                         if shard_for(user_id) != alias]
+            for start in range(0, len(misplaced), batch_size):
+                user_ids = misplaced[start:start + batch_size]
+                rows = list(queryset.filter(user_id__in=user_ids))
+                if model is EventReceipt:
+                    # ids are per shard
+                    for row in rows:
+                        row.pk = None
+                model.objects.bulk_create(rows, ignore_conflicts=True)
+                queryset.filter(user_id__in=user_ids).delete()
+                moved += len(rows)
+    return moved
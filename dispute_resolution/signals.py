@@ -0,0 +1,146 @@
+from django.db.models.signals import m2m_changed, post_save, \
+    post_delete, pre_delete, pre_save
+from django.dispatch import receiver
+
+from dispute_resolution.authentication import session_user_cache, \
+    token_cache
+from dispute_resolution.blobstore import BLOB_REF_FIELDS, adjust_refcounts, \
+    blob_refs
+from dispute_resolution.counters import active_dispute, case_users, \
+    schedule_refresh
+from dispute_resolution.models import User, UserInfo, ContractCase, \
+    ContractStage, EventReceipt, EventWatermark
+from dispute_resolution.serializers import user_cache, user_info_cache
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def revoke_cached_tokens(sender, instance, **kwargs):
+    """Deactivation or a password change must not outlive a cached token."""
+    token_cache.revoke_user(instance.pk)
+    session_user_cache.revoke_user(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def delete_event_state(sender, instance, **kwargs):
+    # kept on the shard of the user, out of reach of cascades
+    EventWatermark.objects.for_user(instance.pk).delete()
+    EventReceipt.objects.for_user(instance.pk).delete()
+
+
+@receiver(post_save, sender=UserInfo)
+@receiver(post_delete, sender=UserInfo)
+def invalidate_cached_user_info(sender, instance, **kwargs):
+    user_info_cache.invalidate(instance.pk)
+    # users are rendered with their info, and session users may hold it
+    user_cache.invalidate(instance.user_id)
+    session_user_cache.revoke_user(instance.user_id)
+
+
+def remember_blob_refs(sender, instance, update_fields=None, raw=False,
+                       **kwargs):
+    field = BLOB_REF_FIELDS[sender]
+    if raw or update_fields is not None and field not in update_fields:
+        return
+    old_value = None
+    if not instance._state.adding:
+        old_value = sender.objects.filter(pk=instance.pk) \
+            .values_list(field, flat=True).first()
+    instance._old_blob_refs = blob_refs(old_value)
+
+
+def update_blob_refcounts(sender, instance, raw=False, **kwargs):
+    old_refs = instance.__dict__.pop('_old_blob_refs', None)
+    if raw or old_refs is None:
+        return
+    adjust_refcounts(blob_refs(getattr(instance, BLOB_REF_FIELDS[sender])),
+                     old_refs)
+
+
+def release_blob_refs(sender, instance, **kwargs):
+    adjust_refcounts(
+        removed=blob_refs(getattr(instance, BLOB_REF_FIELDS[sender])))
+
+
+for model in BLOB_REF_FIELDS:
+    pre_save.connect(remember_blob_refs, sender=model,
+                     dispatch_uid='blob_refs_pre_save')
+    post_save.connect(update_blob_refcounts, sender=model,
+                      dispatch_uid='blob_refs_post_save')
+    post_delete.connect(release_blob_refs, sender=model,
+                        dispatch_uid='blob_refs_post_delete')
+
+
+@receiver(m2m_changed, sender=ContractCase.party.through)
+def refresh_party_counters(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    # reverse: the parties were changed through ``user.contracts``
+    if action == 'pre_clear':
+        instance._counter_users = {instance.pk} if reverse \
+            else case_users([instance.pk])
+    elif action == 'post_clear':
+        schedule_refresh(instance.__dict__.pop('_counter_users', ()))
+    elif action in ('post_add', 'post_remove'):
+        schedule_refresh({instance.pk} if reverse else pk_set)
+
+
+@receiver(pre_save, sender=ContractCase)
+def remember_case_state(sender, instance, update_fields=None, raw=False,
+                        **kwargs):
+    if raw or instance._state.adding or \
+            update_fields is not None and 'finished' not in update_fields:
+        return
+    instance._old_state = sender.objects.filter(pk=instance.pk) \
+        .values_list('finished', flat=True).first()
+
+
+@receiver(post_save, sender=ContractCase)
+def refresh_case_counters(sender, instance, **kwargs):
+    old_state = instance.__dict__.pop('_old_state', None)
+    if old_state is not None and old_state != instance.finished:
+        schedule_refresh(case_users([instance.pk]))
+
+
+@receiver(pre_save, sender=ContractStage)
+def remember_dispute_state(sender, instance, update_fields=None, raw=False,
+                           **kwargs):
+    if raw or update_fields is not None and not \
+            {'dispute_started', 'dispute_finished'} & set(update_fields):
+        return
+    if instance._state.adding:
+        instance._old_dispute = False
+        return
+    old = sender.objects.filter(pk=instance.pk) \
+        .values('dispute_started', 'dispute_finished').first() or {}
+    instance._old_dispute = old.get('dispute_started') is not None and \
+        old.get('dispute_finished') is None
+
+
+@receiver(post_save, sender=ContractStage)
+def refresh_dispute_counters(sender, instance, **kwargs):
+    old_dispute = instance.__dict__.pop('_old_dispute', None)
+    if old_dispute is not None and old_dispute != active_dispute(instance):
+        schedule_refresh(case_users([instance.contract_id]))
+
+
+@receiver(pre_delete, sender=ContractCase)
+def remember_case_parties(sender, instance, **kwargs):
+    # the memberships are gone by post_delete
+    instance._counter_users = case_users([instance.pk])
+
+
+@receiver(post_delete, sender=ContractCase)
+def refresh_deleted_case_counters(sender, instance, **kwargs):
+    schedule_refresh(instance.__dict__.pop('_counter_users', ()))
+
+
+@receiver(post_delete, sender=ContractStage)
+def refresh_deleted_stage_counters(sender, instance, **kwargs):
+    if active_dispute(instance):
+        schedule_refresh(case_users([instance.contract_id]))
@@ -0,0 +1,144 @@
+"""
+Slow-query log with attribution to the code that issued the statement.
+
+``install`` is connected to ``connection_created`` and adds an execute
+wrapper to every connection. Statements taking at least ``SLOW_QUERY_MS``
+milliseconds are appended to ``SLOW_QUERY_LOG`` as JSON lines with their
+normalized SQL and its fingerprint, duration, the view of the current
+request and the innermost ``dispute_resolution`` frames of the stack.
+Only ``INSERT``, ``UPDATE`` and ``DELETE`` statements have the number of
+rows they changed recorded: for reads the driver reports -1 until all
+rows were fetched, which happens after the statement returned. ``manage.py
+slow_queries`` aggregates the log by fingerprint.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import traceback
+from time import perf_counter
+
+from django.conf import settings
+from django.utils import timezone
+
+from dispute_resolution import metrics
+
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# frames of the instrumentation itself say nothing about the caller
+SKIPPED_FILES = {os.path.join(PACKAGE_DIR, name) for name in (
+    'slowlog.py', 'metrics.py', 'middleware.py', 'profiling.py')}
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST_RE = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+_DML_RE = re.compile(r'\s*(?:INSERT|UPDATE|DELETE|REPLACE)\b', re.I)
+
+_write_lock = threading.Lock()
+
+
+def normalize(sql):
+    """``sql`` with literals and placeholder lists replaced by ``?``."""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql).replace('%s', '?')
+    sql = _LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def project_stack():
+    """The innermost ``SLOW_QUERY_STACK_DEPTH`` frames of our package."""
+    frames = []
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(PACKAGE_DIR) and \
+                frame.filename not in SKIPPED_FILES:
+            frames.append('{}:{} in {}'.format(
+                os.path.relpath(frame.filename, settings.BASE_DIR),
+                frame.lineno, frame.name))
+            if len(frames) == settings.SLOW_QUERY_STACK_DEPTH:
+                break
+    return frames
+
+
+def write_entry(entry):
+    line = json.dumps(entry) + '\n'
+    with _write_lock:
+        with open(settings.SLOW_QUERY_LOG, 'a') as log:
+            log.write(line)
+
+
+def slow_query_wrapper(execute, sql, params, many, context):
+    threshold = settings.SLOW_QUERY_MS
+    if threshold is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = (perf_counter() - start) * 1000
+        if duration >= threshold:
+            normalized = normalize(sql)
+            stats = metrics.current()
+            entry = {
+                'time': timezone.now().isoformat(),
+                'fingerprint': fingerprint(normalized),
+                'sql': normalized,
+                'ms': round(duration, 3),
+                'many': many,
+                'view': stats.view if stats is not None else None,
+                'stack': project_stack(),
+            }
+            if _DML_RE.match(sql):
+                entry['rows'] = getattr(context['cursor'], 'rowcount', -1)
+            try:
+                write_entry(entry)
+            except OSError:
+                logger.exception('Cannot write the slow query log')
+
+
+def install(sender, connection, **kwargs):
+    if slow_query_wrapper not in connection.execute_wrappers:
+        # connections open within the execute_wrapper() blocks of requests,
+        # which pop the last wrapper on exit: keep ours out of their way
+        connection.execute_wrappers.insert(0, slow_query_wrapper)
+
+
+def read_entries(path):
+    with open(path) as log:
+        for line in log:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                continue
+
+
+def aggregate(entries):
+    """Per fingerprint totals, the statements with most total time first."""
+    groups = {}
+    for entry in entries:
+        group = groups.get(entry['fingerprint'])
+        if group is None:
+            group = groups[entry['fingerprint']] = {
+                'fingerprint': entry['fingerprint'], 'sql': entry['sql'],
+                'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'views': {},
+                'stack': entry['stack']}
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        if entry['ms'] >= group['max_ms']:
+            group['max_ms'] = entry['ms']
+            group['stack'] = entry['stack']
+        view = entry['view'] or '-'
+        group['views'][view] = group['views'].get(view, 0) + 1
+    for group in groups.values():
+        group['total_ms'] = round(group['total_ms'], 3)
+        group['mean_ms'] = round(group['total_ms'] / group['count'], 3)
+    return sorted(groups.values(), key=lambda group: -group['total_ms'])
@@ -1,3 +1,1669 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import ExitStack, contextmanager
+from time import perf_counter
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import close_old_connections, connection, connections, \
+    transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.test import RequestFactory, TestCase, TransactionTestCase, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from dispute_resolution.authentication import BearerTokenAuthentication, \
+    token_cache
+from dispute_resolution.importers import import_users
+from dispute_resolution.middleware import get_session_user
+from dispute_resolution.db import configure_sqlite_connection, \
+    run_serialized_write
+from dispute_resolution.models import User, UserInfo, ContractCase, \
+    ContractStage, NotifyEvent, Blob, EventReceipt, EventWatermark, \
+    ConcurrentUpdateError, Job, save_with_retry
+from dispute_resolution import counters, db, feeds, filters, jobs, \
+    loadtest, schema, sessions, sharding, slowlog
+from dispute_resolution.seed import seed
+from dispute_resolution.verification import verify_stage, keccak_256
+from drm_server.asgi import application
+
+
+class CaptureAllQueries:
+    """``CaptureQueriesContext`` over every database, shards included."""
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        self._contexts = [
+            self._stack.enter_context(
+                CaptureQueriesContext(connections[alias]))
+            for alias in connections]
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._stack.__exit__(*exc_info)
+
+    @property
+    def captured_queries(self):
+        return [query for context in self._contexts
+                for query in context.captured_queries]
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def __getitem__(self, index):
+        return self.captured_queries[index]
+
+
+class ShardedTestCase(TestCase):
+    # event receipts and watermarks live on every shard of EVENT_SHARDS
+    databases = '__all__'
+
+    @contextmanager
+    def assertNumQueries(self, num):
+        with CaptureAllQueries() as queries:
+            yield
+        self.assertEqual(len(queries), num, '{} queries executed, {} '
+                         'expected\n{}'.format(len(queries), num, '\n'.join(
+                             query['sql'] for query in queries)))
+
+
+class SqliteProfileTests(ShardedTestCase):
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -2000,
+                                       'busy_timeout': 1234})
+    def test_pragmas_applied_on_connection(self):
+        configure_sqlite_connection(sender=None, connection=connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -2000)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1234)
+
+    @override_settings(SQLITE_SERIALIZED_WRITER=True)
+    def test_writer_runs_inline_inside_transaction(self):
+        self.assertEqual(run_serialized_write(lambda a, b: a + b, 1, b=2), 3)
+
+
+@override_settings(METRICS_DEBUG_HEADERS=True)
+class MetricsTests(ShardedTestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='user@example.com',
+                                        name='Some', family_name='User')
+        UserInfo.objects.create(user=self.user, eth_account='0x01')
+        self.client.force_login(self.user)
+
+    def test_debug_headers_tagged_by_viewset_action(self):
+        response = self.client.get('/users/self/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-View'], 'UserViewSet.self')
+        self.assertGreater(int(response['X-DB-Queries']), 0)
+        self.assertIn('X-Serializer-Time', response)
+
+    def test_metrics_endpoint_renders_histograms(self):
+        self.client.get('/users/self/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'drm_request_queries_count{view="UserViewSet.self"}',
+                      response.content)
+
+
+class TokenAuthenticationTests(ShardedTestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user('token@example.com', 'secret')
+        UserInfo.objects.create(user=self.user, eth_account='0x02')
+
+    def _obtain(self, password='secret'):
+        return self.client.post('/auth/token/',
+                                {'email': 'token@example.com',
+                                 'password': password})
+
+    def _get_self(self, token):
+        return self.client.get('/users/self/',
+                               HTTP_AUTHORIZATION='Bearer ' + token)
+
+    def test_login_issues_token(self):
+        self.assertEqual(self._obtain('wrong').status_code, 400)
+        token = self._obtain().data['token']
+        self.assertEqual(self._get_self(token).status_code, 200)
+
+    def test_cached_token_needs_no_auth_queries(self):
+        token = self._obtain().data['token']
+        self._get_self(token)
+        # only the unseen events queries (watermark, receipts, feed) are left
+        with self.assertNumQueries(3):
+            self._get_self(token)
+
+    def test_requests_get_their_own_copy_of_the_user(self):
+        token = self._obtain().data['token']
+        request = RequestFactory().get(
+            '/users/self/', HTTP_AUTHORIZATION='Bearer ' + token)
+        authentication = BearerTokenAuthentication()
+        first, _ = authentication.authenticate(request)
+        with self.assertNumQueries(0):
+            second, _ = authentication.authenticate(request)
+        self.assertEqual(second.pk, self.user.pk)
+        second.name = 'Mallory'
+        third, _ = authentication.authenticate_cached(request)
+        self.assertEqual(third.name, first.name)
+        self.assertIsNot(third, second)
+
+    def test_password_change_and_deactivation_revoke_token(self):
+        token = self._obtain().data['token']
+        self._get_self(token)
+        self.user.set_password('other')
+        self.user.save()
+        self.assertEqual(self._get_self(token).status_code, 401)
+
+        self.user.set_password('secret')
+        self.user.save()
+        token = self._obtain().data['token']
+        self._get_self(token)
+        self.user.active = False
+        self.user.save()
+        self.assertEqual(self._get_self(token).status_code, 401)
+        self.assertEqual(self._get_self('garbage').status_code, 401)
+
+
+def make_case(party, name='case', stages=1):
+    case = ContractCase.objects.create(name=name)
+    case.party.set(party)
+    today = datetime.date.today()
+    for _ in range(stages):
+        ContractStage.objects.create(contract=case, owner=party[0],
+                                     start=today,
+                                     dispute_start_allowed=today)
+    return case
+
+
+class CaseScopingTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.carol = User.objects.create(email='carol@example.com')
+        self.judge = User.objects.create(email='judge@example.com',
+                                         judge=True)
+        self.own = make_case([self.alice, self.bob], 'own')
+        self.other = make_case([self.bob, self.carol], 'other')
+
+    def test_party_sees_only_own_cases_and_stages(self):
+        self.client.force_login(self.alice)
+        cases = self.client.get('/contracts/').data
+        self.assertEqual([case['id'] for case in cases], [self.own.id])
+        stages = self.client.get('/stages/').data
+        self.assertEqual([stage['id'] for stage in stages],
+                         [self.own.stages.get().id])
+        response = self.client.get('/contracts/{}/'.format(self.other.id))
+        self.assertEqual(response.status_code, 404)
+
+    def test_judge_sees_everything_but_cannot_edit(self):
+        self.client.force_login(self.judge)
+        self.assertEqual(len(self.client.get('/contracts/').data), 2)
+        response = self.client.patch('/contracts/{}/'.format(self.own.id),
+                                     {'name': 'renamed'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_party_can_edit_own_case(self):
+        self.client.force_login(self.alice)
+        response = self.client.patch('/contracts/{}/'.format(self.own.id),
+                                     {'name': 'renamed'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+
+class BulkContractCreationTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.client.force_login(self.alice)
+
+    def _payload(self, num, party=None):
+        today = datetime.date.today().isoformat()
+        return [{'name': 'bulk {}'.format(i),
+                 'party': party or [self.alice.pk, self.bob.pk],
+                 'stages': [{'owner': self.alice.pk, 'start': today,
+                             'dispute_start_allowed': today}] * 2}
+                for i in range(num)]
+
+    def test_list_payload_creates_cases_with_fixed_statement_count(self):
+        with CaptureAllQueries() as queries:
+            response = self.client.post('/contracts/', self._payload(300),
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        # the inserts are batched by SQLite's limit of 999 parameters;
+        # the parties' case counters are refreshed inline without jobs
+        self.assertLessEqual(len(queries), 25)
+        self.assertEqual(len(response.data), 300)
+        self.assertEqual(ContractCase.objects.count(), 300)
+        self.assertEqual(ContractStage.objects.count(), 600)
+        case = ContractCase.objects.get(name='bulk 299')
+        self.assertEqual(response.data[-1]['id'], case.pk)
+        self.assertEqual(set(case.party.values_list('pk', flat=True)),
+                         {self.alice.pk, self.bob.pk})
+        self.assertEqual(case.stages.count(), 2)
+
+    def test_invalid_item_rejects_whole_batch(self):
+        payload = self._payload(3)
+        payload[2]['party'] = [self.alice.pk, 999999]
+        response = self.client.post('/contracts/', payload,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ContractCase.objects.exists())
+
+    def test_single_case_still_supported(self):
+        response = self.client.post('/contracts/', self._payload(1)[0],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['stages']), 2)
+        self.assertEqual(len(response.data['in_party']), 2)
+
+
+@override_settings(USER_IMPORT_PROCESSES=0)
+class UserImportTests(ShardedTestCase):
+    CSV = ('email,name,family_name,password,eth_account,tax_num\n'
+           'a@example.com,A,Aa,secret-a,0xa,\n'
+           'b@example.com,B,Bb,secret-b,0xb,123\n'
+           'a@example.com,A,Again,secret,0xc,\n'
+           'c@example.com,C,Cc,secret-c,0xb,\n'
+           'not-an-email,D,Dd,secret,0xd,\n')
+
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com',
+                                         admin=True)
+        UserInfo.objects.create(user=self.admin, eth_account='0xadmin')
+
+    def test_csv_import_reports_duplicates_without_aborting(self):
+        self.client.force_login(self.admin)
+        response = self.client.post('/users/bulk/', self.CSV,
+                                    content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([error['line'] for error in response.data['errors']],
+                         [3, 4, 5])
+        user = User.objects.get(email='b@example.com')
+        self.assertTrue(user.check_password('secret-b'))
+        self.assertEqual(user.info.tax_num, '123')
+
+    def test_jsonl_import_and_admin_only(self):
+        body = '\n'.join([
+            json.dumps({'email': 'j@example.com', 'name': 'J',
+                        'family_name': 'J', 'eth_account': '0xj'}),
+            '{broken',
+            json.dumps({'email': 'admin@example.com', 'name': 'X',
+                        'family_name': 'X', 'eth_account': '0xadmin'}),
+        ])
+        self.client.force_login(User.objects.create(email='u@example.com'))
+        response = self.client.post('/users/bulk/', body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.admin)
+        response = self.client.post('/users/bulk/', body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['errors'][1]['errors'],
+                         {'email': ['Duplicate email.'],
+                          'eth_account': ['Duplicate eth account.']})
+
+    def test_passwords_hashed_in_process_pool(self):
+        rows = [{'email': 'p{}@example.com'.format(num), 'name': 'P',
+                 'family_name': 'P', 'password': 'pwd{}'.format(num),
+                 'eth_account': '0xp{}'.format(num)} for num in range(4)]
+        report = import_users(rows, processes=2, chunk_size=3)
+        self.assertEqual(report['created'], 4)
+        self.assertTrue(User.objects.get(email='p3@example.com')
+                        .check_password('pwd3'))
+
+
+class BlobStoreTests(ShardedTestCase):
+    CONTENT = b'evidence ' * 20000
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(BLOB_STORE_ROOT=self.root,
+                                              BLOB_CHUNK_SIZE=4096)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create(email='files@example.com')
+        self.client.force_login(self.user)
+        self.digest = hashlib.sha256(self.CONTENT).hexdigest()
+
+    def _upload(self, content=None, **extra):
+        return self.client.post('/blobs/', content or self.CONTENT,
+                                content_type='application/octet-stream',
+                                **extra)
+
+    def _download(self, **extra):
+        response = self.client.get('/blobs/{}/'.format(self.digest), **extra)
+        body = b''.join(response.streaming_content) \
+            if response.streaming else response.content
+        return response, body
+
+    def test_upload_is_deduplicated(self):
+        response = self._upload()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['sha256'], self.digest)
+        self.assertEqual(self._upload().status_code, 200)
+        self.assertEqual(Blob.objects.get().size, len(self.CONTENT))
+        response = self._upload(b'other', HTTP_X_CONTENT_SHA256=self.digest)
+        self.assertEqual(response.status_code, 400)
+        # the unreferenced content is left to the garbage collection
+        other = Blob.objects.exclude(pk=self.digest).get()
+        self.assertEqual(other.refcount, 0)
+        call_command('gc_blobs', grace_hours=0, stdout=io.StringIO())
+        self.assertFalse(Blob.objects.filter(pk=other.pk).exists())
+
+    def test_download_ranges_and_conditional_requests(self):
+        self._upload()
+        case = make_case([self.user])
+        case.files = self.digest
+        case.save()
+        response, body = self._download()
+        self.assertEqual(body, self.CONTENT)
+        self.assertEqual(response['ETag'], '"{}"'.format(self.digest))
+
+        response, body = self._download(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.CONTENT[10:20])
+        self.assertEqual(response['Content-Range'],
+                         'bytes 10-19/{}'.format(len(self.CONTENT)))
+        response, body = self._download(HTTP_RANGE='bytes=-5')
+        self.assertEqual(body, self.CONTENT[-5:])
+        response, _ = self._download(HTTP_RANGE='bytes=10-19',
+                                     HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response, _ = self._download(HTTP_RANGE='bytes=999999999-')
+        self.assertEqual(response.status_code, 416)
+        response, _ = self._download(
+            HTTP_IF_NONE_MATCH='"{}"'.format(self.digest))
+        self.assertEqual(response.status_code, 304)
+
+    def test_references_are_counted_and_unreferenced_blobs_collected(self):
+        self._upload()
+        case = make_case([self.user])
+        case.files = 'contract.pdf:{}'.format(self.digest)
+        case.save()
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        stage = case.stages.get()
+        stage.result_file = self.digest
+        stage.save()
+        self.assertEqual(Blob.objects.get().refcount, 2)
+
+        call_command('gc_blobs', grace_hours=0, stdout=io.StringIO())
+        self.assertTrue(Blob.objects.exists())
+        case.delete()
+        self.assertEqual(Blob.objects.get().refcount, 0)
+        call_command('gc_blobs', grace_hours=0, stdout=io.StringIO())
+        self.assertFalse(Blob.objects.exists())
+        self.client.force_login(User.objects.create(email='a@example.com',
+                                                    admin=True))
+        self.assertEqual(self._download()[0].status_code, 404)
+
+    def test_references_made_before_the_upload_are_counted(self):
+        case = make_case([self.user])
+        case.files = 'contract.pdf:{}'.format(self.digest)
+        case.save()
+        self._upload()
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        # a count missing a reference does not get the blob collected
+        Blob.objects.update(refcount=0)
+        call_command('gc_blobs', grace_hours=0, stdout=io.StringIO())
+        self.assertEqual(Blob.objects.get().refcount, 1)
+
+    def test_only_those_seeing_a_reference_may_download(self):
+        self._upload()
+        self.assertEqual(self._download()[0].status_code, 403)
+        stage = make_case([User.objects.create(email='owner@example.com')]) \
+            .stages.get()
+        stage.result_file = self.digest
+        stage.save()
+        self.assertEqual(self._download()[0].status_code, 403)
+        stage.contract.party.add(self.user)
+        self.assertEqual(self._download()[0].status_code, 200)
+
+        self.client.force_login(User.objects.create(
+            email='judge@example.com', judge=True))
+        self.assertEqual(self._download()[0].status_code, 200)
+        self.client.force_login(User.objects.create(email='x@example.com'))
+        self.assertEqual(self._download()[0].status_code, 403)
+
+
+class ResultVerificationTests(ShardedTestCase):
+    CONTENT = b'dispute resolution ' * 10000
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(BLOB_STORE_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.admin = User.objects.create(email='admin@example.com',
+                                         admin=True)
+        UserInfo.objects.create(user=self.admin, eth_account='0xadmin')
+        self.client.force_login(self.admin)
+        self.digest = self.client.post(
+            '/blobs/', self.CONTENT,
+            content_type='application/octet-stream').data['sha256']
+        self.case = make_case([self.admin, User.objects.create(
+            email='party@example.com')])
+        self.stage = self.case.stages.get()
+
+    def _close_dispute(self, filehash):
+        return self.client.post('/events/', {
+            'contract': self.case.pk, 'stage_num': 0,
+            'event_type': 'disp_close', 'address_by': '0xadmin',
+            'filehash': filehash}, content_type='application/json')
+
+    def test_closing_dispute_records_hash_as_pending(self):
+        self.assertEqual(self._close_dispute(self.digest).status_code, 201)
+        self.stage.refresh_from_db()
+        self.assertEqual(self.stage.result_hash, self.digest)
+        self.assertEqual(self.stage.result_file, self.digest)
+        self.assertEqual(self.stage.result_verification, 'pending')
+        self.assertEqual(verify_stage(self.stage.pk), 'verified')
+        self.stage.refresh_from_db()
+        self.assertEqual(self.stage.result_verification, 'verified')
+        self.assertIsNotNone(self.stage.result_verified_at)
+
+    def test_hashes_of_no_stored_blob_are_not_taken_for_files(self):
+        keccak_hash = 'cd' * 32
+        self.assertEqual(self._close_dispute(keccak_hash).status_code, 201)
+        self.stage.refresh_from_db()
+        self.assertEqual((self.stage.result_hash, self.stage.result_file),
+                         (keccak_hash, ''))
+
+    def test_mismatch_and_missing_file(self):
+        ContractStage.objects.filter(pk=self.stage.pk).update(
+            result_file=self.digest, result_hash='0x' + 'ab' * 32)
+        self.assertEqual(verify_stage(self.stage.pk), 'mismatch')
+        # without keccak-256 the hash might still be the file's
+        with mock.patch('dispute_resolution.verification.keccak_256', None):
+            self.assertEqual(verify_stage(self.stage.pk), 'unverifiable')
+        ContractStage.objects.filter(pk=self.stage.pk).update(
+            result_file='')
+        self.assertEqual(verify_stage(self.stage.pk), 'missing')
+
+    @skipIf(keccak_256 is None, 'no keccak implementation installed')
+    def test_keccak_hash_from_chain(self):
+        keccak = keccak_256()
+        keccak.update(self.CONTENT)
+        ContractStage.objects.filter(pk=self.stage.pk).update(
+            result_file=self.digest, result_hash='0x' + keccak.hexdigest())
+        self.assertEqual(verify_stage(self.stage.pk), 'verified')
+
+
+@override_settings(SQLITE_SERIALIZED_WRITER=True, JOBS_ASYNC=True,
+                   VERIFICATION_ASYNC=True)
+class SerializedWriterTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(BLOB_STORE_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(db.writer.stop)
+        self.admin = User.objects.create(email='admin@example.com',
+                                         admin=True)
+        UserInfo.objects.create(user=self.admin, eth_account='0xadmin')
+        self.case = make_case([self.admin, User.objects.create(
+            email='party@example.com')])
+        self.client.force_login(self.admin)
+
+    def test_job_queued_after_commit_on_writer_thread(self):
+        responses = []
+
+        def close_dispute():
+            responses.append(self.client.post('/events/', {
+                'contract': self.case.pk, 'stage_num': 0,
+                'event_type': 'disp_close', 'address_by': '0xadmin',
+                'filehash': '0x' + 'ab' * 32},
+                content_type='application/json'))
+            close_old_connections()
+
+        # the on_commit callback of the write runs on the writer thread
+        request = threading.Thread(target=close_dispute, daemon=True)
+        request.start()
+        request.join(10)
+        self.assertFalse(request.is_alive(), 'the writer waits on itself')
+        self.assertEqual(responses[0].status_code, 201)
+        job = Job.objects.get(task='verify_stage')
+        self.assertEqual(json.loads(job.args), [self.case.stages.get().pk])
+
+
+def asgi_request(path, method='GET', query=b'', headers=(), body=b''):
+    """Run one request through the ASGI application."""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query,
+             'headers': [(name.encode(), value.encode())
+                         for name, value in headers]}
+    asyncio.run(application(scope, receive, send))
+    return (messages[0]['status'], dict(messages[0]['headers']),
+            b''.join(message.get('body', b'') for message in messages[1:]))
+
+
+@override_settings(ASGI_THREADS=0)
+class AsgiTests(ShardedTestCase):
+    def setUp(self):
+        # like the test client: the WSGI fallback must not close the
+        # connection holding the test transaction
+        request_started.disconnect(close_old_connections)
+        self.addCleanup(request_started.connect, close_old_connections)
+        token_cache.clear()
+        self.alice = User.objects.create_user('alice@example.com', 'secret')
+        UserInfo.objects.create(user=self.alice, eth_account='0x0a')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.own = make_case([self.alice, self.bob], 'own')
+        self.other = make_case([self.bob], 'other')
+        NotifyEvent.objects.create(contract=self.own,
+                                   stage=self.own.stages.get(),
+                                   user_by=self.bob, user_to=self.alice)
+        status, _, body = asgi_request(
+            '/auth/token/', 'POST', body=b'email=alice%40example.com'
+                                         b'&password=secret',
+            headers=[('content-type',
+                      'application/x-www-form-urlencoded')])
+        self.assertEqual(status, 200)
+        self.auth = ('authorization', 'Bearer ' + json.loads(body)['token'])
+
+    def test_native_views_match_wsgi(self):
+        self.client.force_login(self.alice)
+        for path in ('/users/self/', '/events/',
+                     '/contracts/{}/'.format(self.own.pk)):
+            self.assertIsNotNone(application.match(
+                {'method': 'GET', 'path': path}))
+            status, headers, body = asgi_request(path, headers=[self.auth])
+            self.assertEqual(status, 200)
+            self.assertEqual(headers[b'content-type'], b'application/json')
+            self.assertEqual(json.loads(body),
+                             json.loads(self.client.get(path).content))
+
+    def test_native_views_use_the_memoized_session_user(self):
+        self.client.force_login(self.alice)
+        cookie = ('cookie', '{}={}'.format(
+            settings.SESSION_COOKIE_NAME,
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value))
+        self.assertEqual(asgi_request('/users/self/',
+                                      headers=[cookie])[0], 200)
+        # the session and the feed (watermark, receipts, events); no user
+        with self.assertNumQueries(4):
+            status, _, body = asgi_request('/users/self/', headers=[cookie])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['self']['id'], self.alice.pk)
+
+    def test_native_views_report_errors(self):
+        status, headers, _ = asgi_request('/events/')
+        self.assertEqual(status, 401)
+        self.assertEqual(headers[b'www-authenticate'], b'Bearer')
+        status, _, _ = asgi_request('/contracts/{}/'.format(self.other.pk),
+                                    headers=[self.auth])
+        self.assertEqual(status, 404)
+
+    def test_other_requests_fall_back_to_wsgi(self):
+        self.assertIsNone(application.match(
+            {'method': 'GET', 'path': '/events/', 'query_string': b'seen=1'}))
+        status, _, body = asgi_request('/contracts/', headers=[self.auth])
+        self.assertEqual(status, 200)
+        self.assertEqual([case['id'] for case in json.loads(body)],
+                         [self.own.pk])
+
+
+class SchemaCacheTests(ShardedTestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings_override = override_settings(SCHEMA_CACHE_DIR=cache_dir,
+                                              SCHEMA_VERSION='v1')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        schema.clear_cache()
+        self.addCleanup(schema.clear_cache)
+
+    def test_schema_generated_once_and_revalidated_by_etag(self):
+        with mock.patch.object(schema, 'generate_schema',
+                               wraps=schema.generate_schema) as generate:
+            first = self.client.get('/?format=openapi')
+            second = self.client.get('/?format=openapi')
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], '"v1-anonymous-openapi"')
+        response = self.client.get('/?format=openapi',
+                                   HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        with override_settings(SCHEMA_VERSION='v2'):
+            response = self.client.get('/?format=openapi',
+                                       HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_precomputed_schema_served_from_disk_per_audience(self):
+        call_command('build_schema', stdout=io.StringIO())
+        schema.clear_cache()
+        admin = User.objects.create(email='admin@example.com', admin=True)
+        with mock.patch.object(schema, 'generate_schema') as generate:
+            anonymous = self.client.get('/?format=openapi')
+            self.client.force_login(admin)
+            full = self.client.get('/?format=openapi')
+        generate.assert_not_called()
+        self.assertIn(b'/users/bulk/', full.content)
+        self.assertNotIn(b'/users/bulk/', anonymous.content)
+        self.assertEqual(self.client.get(
+            '/', HTTP_ACCEPT='text/html').status_code, 200)
+
+
+class CaseTimelineTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.case = make_case([self.alice, self.bob], stages=3)
+        today = datetime.date.today()
+        stages = list(self.case.stages.order_by('pk'))
+        for offset, stage in enumerate(stages):
+            stage.start = today + datetime.timedelta(days=offset)
+            stage.save()
+        noon = datetime.datetime.combine(today, datetime.time(12),
+                                         tzinfo=datetime.timezone.utc)
+        self.events = []
+        for offset, user in ((0, self.alice), (0, self.alice),
+                             (1, self.bob), (2, self.alice)):
+            event = NotifyEvent.objects.create(
+                contract=self.case, stage=stages[offset], user_by=self.bob,
+                user_to=user)
+            NotifyEvent.objects.filter(pk=event.pk).update(
+                creation_date=noon + datetime.timedelta(days=offset))
+            self.events.append(event)
+        # stages sort at midnight, alice's events at noon; same-time events
+        # by id; bob's event is not on alice's timeline
+        self.expected = [('stage', stages[0].pk),
+                         ('event', self.events[0].pk),
+                         ('event', self.events[1].pk),
+                         ('stage', stages[1].pk), ('stage', stages[2].pk),
+                         ('event', self.events[3].pk)]
+        self.url = '/contracts/{}/timeline/'.format(self.case.pk)
+
+    def test_pages_follow_cursor_with_constant_queries(self):
+        self.client.force_login(self.alice)
+        # the session user is memoized from the first request on
+        self.client.get(self.url, {'limit': 1})
+        seen, params = [], {'limit': 2}
+        while True:
+            # session, case, stages, events, watermark and receipts
+            with self.assertNumQueries(6):
+                response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            seen += [(entry['type'], entry['data']['id'])
+                     for entry in response.data['results']]
+            if response.data['next'] is None:
+                break
+            params['cursor'] = response.data['next']
+        self.assertEqual(seen, self.expected)
+
+    def test_invalid_parameters_and_foreign_case(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(
+            self.url, {'cursor': 'garbage'}).status_code, 400)
+        self.assertEqual(self.client.get(
+            self.url, {'limit': 0}).status_code, 400)
+        other = make_case([self.bob])
+        self.assertEqual(self.client.get(
+            '/contracts/{}/timeline/'.format(other.pk)).status_code, 404)
+
+
+class BroadcastEventTests(ShardedTestCase):
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com',
+                                         admin=True)
+        self.alice = User.objects.create(email='alice@example.com')
+        UserInfo.objects.create(user=self.alice, eth_account='0x0a')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.judges = [User.objects.create(email='judge{}@example.com'
+                                           .format(num), judge=True)
+                       for num in range(3)]
+        self.case = make_case([self.alice, self.bob])
+
+    def _emit(self, num=1):
+        self.client.force_login(self.admin)
+        for _ in range(num):
+            response = self.client.post('/events/', {
+                'contract': self.case.pk, 'stage_num': 0,
+                'address_by': '0x0a'}, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        return list(NotifyEvent.objects.order_by('pk'))
+
+    def _unseen(self, user):
+        self.client.force_login(user)
+        return [(event['id'], event['user_to'], event['seen'])
+                for event in self.client.get('/users/self/').data['events']]
+
+    def test_event_is_stored_once_for_all_recipients(self):
+        event, = self._emit()
+        self.assertEqual(self._unseen(self.bob),
+                         [(event.pk, self.bob.pk, False)])
+        self.assertEqual(self._unseen(self.judges[0]),
+                         [(event.pk, self.judges[0].pk, False)])
+        # the sender is not notified
+        self.assertEqual(self._unseen(self.alice), [])
+
+    def test_user_to_filter_matches_the_shown_recipient(self):
+        event, = self._emit()
+        self.client.force_login(self.bob)
+        for params in ({'user_to': self.bob.pk},
+                       {'user_to__in': '{},{}'.format(self.alice.pk,
+                                                      self.bob.pk)}):
+            self.assertEqual([row['id'] for row in self.client.get(
+                '/events/', params).data], [event.pk])
+        self.assertEqual(self.client.get(
+            '/events/', {'user_to': self.alice.pk}).data, [])
+        self.assertEqual(self.client.get(
+            '/events/', {'user_to': 'x'}).status_code, 400)
+
+    def test_seen_state_is_per_recipient(self):
+        first, second = self._emit(2)
+        self.client.force_login(self.bob)
+        response = self.client.patch('/events/{}/'.format(second.pk),
+                                     {'seen': True},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['seen'])
+        self.assertEqual(EventReceipt.objects.for_user(self.bob.pk).get()
+                         .event_id, second.pk)
+        self.assertEqual(self._unseen(self.bob),
+                         [(first.pk, self.bob.pk, False)])
+
+        # seeing the first event moves the watermark past both
+        self.client.patch('/events/{}/'.format(first.pk), {'seen': True},
+                          content_type='application/json')
+        self.assertEqual(self._unseen(self.bob), [])
+        self.assertFalse(EventReceipt.objects.for_user(self.bob.pk).exists())
+        self.assertEqual(feeds.watermark(self.bob), second.pk)
+        self.assertEqual(len(self._unseen(self.judges[1])), 2)
+
+        self.client.force_login(self.bob)
+        self.client.patch('/events/{}/'.format(first.pk), {'seen': False},
+                          content_type='application/json')
+        self.assertEqual(self._unseen(self.bob),
+                         [(first.pk, self.bob.pk, False)])
+
+    def test_seen_state_is_written_without_touching_the_event(self):
+        event, = self._emit()
+        self.client.force_login(self.bob)
+        with mock.patch('dispute_resolution.serializers.'
+                        'run_serialized_write',
+                        wraps=run_serialized_write) as write, \
+                CaptureAllQueries() as queries:
+            response = self.client.patch('/events/{}/'.format(event.pk),
+                                         {'seen': True},
+                                         content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # receipts are written by the serialized writer, like ingestion
+        write.assert_called_once_with(feeds.mark_seen, self.bob, [event.pk])
+        self.assertFalse([query for query in queries
+                          if query['sql'].startswith('UPDATE') and
+                          'notifyevent' in query['sql']])
+        with mock.patch('dispute_resolution.viewsets.run_serialized_write',
+                        wraps=run_serialized_write) as write:
+            self.client.post('/events/seen/')
+        write.assert_called_once_with(feeds.mark_all_seen, mock.ANY)
+
+    def test_recipients_cannot_change_shared_events(self):
+        event, = self._emit()
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.patch(
+            '/events/{}/'.format(event.pk), {'event_type': 'fin'},
+            content_type='application/json').status_code, 403)
+        self.assertEqual(self.client.delete(
+            '/events/{}/'.format(event.pk)).status_code, 403)
+        self.assertEqual(self.client.post('/events/seen/').status_code, 204)
+        self.assertEqual(self._unseen(self.bob), [])
+
+    def test_digest_groups_unseen_events(self):
+        self._emit(3)
+        other = make_case([self.alice, self.bob], 'other')
+        self.client.post('/events/', {
+            'contract': other.pk, 'stage_num': 0, 'event_type': 'fin',
+            'address_by': '0x0a'}, content_type='application/json')
+        events = list(NotifyEvent.objects.order_by('pk'))
+        self.client.force_login(self.bob)
+        self.client.get('/users/self/', {'digest': 1})
+        # session, watermark, receipts and the grouped events
+        with self.assertNumQueries(4):
+            digest = self.client.get('/users/self/',
+                                     {'digest': 1}).data['digest']
+        self.assertEqual(
+            [(group['contract'], group['event_type'], group['count'],
+              group['last_event']) for group in digest],
+            [(other.pk, 'fin', 1, events[3].pk),
+             (self.case.pk, 'open', 3, events[2].pk)])
+        self.assertEqual(digest[0]['latest'], events[3].creation_date)
+        for flag in ('0', 'false'):
+            response = self.client.get('/users/self/', {'digest': flag})
+            self.assertEqual(len(response.data['events']), 4)
+
+        response = self.client.get('/events/unseen/', {
+            'contract': self.case.pk, 'event_type': 'open'})
+        self.assertEqual([event['id'] for event in response.data],
+                         [event.pk for event in events[2::-1]])
+        self.assertEqual(self.client.get(
+            '/events/unseen/', {'contract': 'x'}).status_code, 400)
+
+
+class CaseExportTests(ShardedTestCase):
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com',
+                                         admin=True)
+        self.alice = User.objects.create(email='alice@example.com')
+        UserInfo.objects.create(user=self.alice, eth_account='0x0a')
+        self.bob = User.objects.create(email='bob@example.com')
+        UserInfo.objects.create(user=self.bob, eth_account='0x0b')
+        self.cases = [make_case([self.alice, self.bob], 'case {}'.format(num),
+                                stages=2) for num in range(3)]
+        for case in self.cases:
+            NotifyEvent.objects.create(contract=case,
+                                       stage=case.stages.first(),
+                                       user_by=self.alice,
+                                       audience=NotifyEvent.TO_PARTIES)
+
+    def _export(self, params):
+        response = self.client.get('/export/cases/', params)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in
+                b''.join(response.streaming_content).splitlines()]
+
+    def test_streams_jsonl_csv_and_gzip(self):
+        self.client.force_login(self.admin)
+        response = self.client.get('/export/cases/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Export-Until'], str(self.cases[-1].pk))
+        cases = [json.loads(line) for line in
+                 b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([case['id'] for case in cases],
+                         [case.pk for case in self.cases])
+        self.assertEqual(cases[0]['parties'], ['0x0a', '0x0b'])
+        self.assertEqual(len(cases[0]['stages']), 2)
+        self.assertEqual(cases[0]['events'][0]['audience'], 'parties')
+
+        response = self.client.get('/export/cases/', {
+            'type': 'csv', 'gzip': 1, 'since': self.cases[0].pk})
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(
+            b''.join(response.streaming_content)).decode())))
+        self.assertEqual([int(row['id']) for row in rows],
+                         [case.pk for case in self.cases[1:]])
+        self.assertEqual(rows[0]['parties'], '0x0a 0x0b')
+        response = self.client.get('/export/cases/', {'gzip': 0})
+        self.assertEqual([json.loads(line)['id'] for line in b''.join(
+            response.streaming_content).splitlines()],
+            [case.pk for case in self.cases])
+
+        self.assertEqual(self.client.get(
+            '/export/cases/', {'type': 'xml'}).status_code, 400)
+
+    def test_incremental_export_includes_changed_cases(self):
+        self.client.force_login(self.admin)
+        response = self.client.get('/export/cases/')
+        marks = {'since': response['X-Export-Until'],
+                 'stages_since': response['X-Export-Stages-Until'],
+                 'events_since': response['X-Export-Events-Until']}
+        self.assertEqual(self._export(marks), [])
+
+        ContractStage.objects.create(
+            contract=self.cases[1], owner=self.alice,
+            start=datetime.date.today(),
+            dispute_start_allowed=datetime.date.today())
+        NotifyEvent.objects.create(contract=self.cases[0],
+                                   stage=self.cases[0].stages.first(),
+                                   user_by=self.bob, user_to=self.alice)
+        new = make_case([self.alice], 'new')
+        cases = self._export(marks)
+        self.assertEqual([case['id'] for case in cases],
+                         [self.cases[0].pk, self.cases[1].pk, new.pk])
+        self.assertEqual(len(cases[0]['events']), 2)
+        self.assertEqual(len(cases[1]['stages']), 3)
+        # without the change marks only new cases are exported
+        self.assertEqual([case['id'] for case in self._export(
+            {'since': marks['since']})], [new.pk])
+
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get('/export/cases/').status_code, 403)
+
+    def test_command_reads_fixed_size_chunks(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cases.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        # the upper bounds, then cases, parties, stages and events per
+        # chunk of two cases and the empty chunk closing the export
+        with self.assertNumQueries(3 + 4 + 4 + 1):
+            call_command('export_cases', path, chunk_size=2,
+                         stderr=io.StringIO())
+        with open(path) as export:
+            self.assertEqual(len(export.readlines()), 3)
+
+
+class LoadTestTests(ShardedTestCase):
+    def setUp(self):
+        request_started.disconnect(close_old_connections)
+        self.addCleanup(request_started.connect, close_old_connections)
+        User.objects.create(email='admin@example.com', admin=True)
+        alice = User.objects.create(email='alice@example.com')
+        UserInfo.objects.create(user=alice, eth_account='0x0a')
+        bob = User.objects.create(email='bob@example.com')
+        UserInfo.objects.create(user=bob, eth_account='0x0b')
+        case = make_case([alice, bob])
+        NotifyEvent.objects.create(contract=case, stage=case.stages.get(),
+                                   user_by=alice, user_to=bob)
+
+    def test_report_per_scenario(self):
+        out = io.StringIO()
+        call_command('loadtest', workers=0, requests=60, seed=1,
+                     json_path='-', stdout=out)
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['total']['requests'], 60)
+        self.assertEqual(summary['total']['errors'], 0)
+        self.assertEqual(set(summary['endpoints']), set(loadtest.DEFAULT_MIX))
+        stats = summary['endpoints']['users-self']
+        self.assertLessEqual(stats['p50_ms'], stats['p95_ms'])
+        self.assertLessEqual(stats['p95_ms'], stats['p99_ms'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([loadtest.percentile(values, pct)
+                          for pct in (50, 95, 99)], [50, 95, 99])
+        self.assertEqual(loadtest.percentile([7], 99), 7)
+
+
+class ProfilerTests(ShardedTestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(
+            PROFILER_ENABLED=True, PROFILER_SECRET='s3cret',
+            PROFILER_SAMPLE_RATE=0, PROFILER_DIR=root,
+            PROFILER_MAX_PROFILES=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.admin = User.objects.create(email='admin@example.com',
+                                         admin=True)
+        UserInfo.objects.create(user=self.admin, eth_account='0x01')
+        self.client.force_login(self.admin)
+
+    def test_profiles_requests_with_secret_into_ring(self):
+        self.assertNotIn('X-Profile-Id', self.client.get('/users/self/'))
+        self.assertNotIn('X-Profile-Id', self.client.get(
+            '/users/self/', HTTP_X_PROFILE='wrong'))
+        ids = [self.client.get('/users/self/', HTTP_X_PROFILE='s3cret')
+               ['X-Profile-Id'] for _ in range(2)]
+        ids.append(self.client.get('/contracts/', {'_profile': 's3cret'})
+                   ['X-Profile-Id'])
+
+        profiles = self.client.get('/profiles/').data
+        self.assertEqual([profile['id'] for profile in profiles],
+                         ids[:0:-1])
+        self.assertEqual(profiles[0]['view'], 'ContractCaseViewSet.list')
+        detail = self.client.get('/profiles/{}/'.format(ids[1])).data
+        self.assertEqual(detail['path'], '/users/self/')
+        self.assertEqual(detail['queries'], len(detail['sql']))
+        self.assertGreater(detail['queries'], 0)
+        self.assertIn('function calls', detail['stats'])
+        path = '/profiles/{}/'.format(ids[1])
+        self.assertEqual(self.client.get(path, {'raw': 0}).data['path'],
+                         '/users/self/')
+        raw = self.client.get(path, {'raw': 1})
+        self.assertTrue(raw.streaming)
+        raw.close()
+        self.assertEqual(self.client.get(
+            '/profiles/{}/'.format(ids[0])).status_code, 404)
+
+        self.client.force_login(User.objects.create(email='x@example.com'))
+        self.assertEqual(self.client.get('/profiles/').status_code, 403)
+
+    def test_middleware_unused_when_disabled(self):
+        with override_settings(PROFILER_ENABLED=False):
+            self.client = self.client_class()
+            self.client.force_login(self.admin)
+            self.assertNotIn('X-Profile-Id', self.client.get(
+                '/users/self/', HTTP_X_PROFILE='s3cret'))
+
+
+class SlowQueryTests(ShardedTestCase):
+    def setUp(self):
+        fd, self.log = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, self.log)
+        self.alice = User.objects.create(email='alice@example.com')
+        UserInfo.objects.create(user=self.alice, eth_account='0x0a')
+        make_case([self.alice])
+        self.client.force_login(self.alice)
+
+    def test_normalize(self):
+        self.assertEqual(
+            slowlog.normalize('SELECT  "a" FROM "t1" WHERE "b" IN '
+                              '(%s, %s,%s) AND "c" = \'it\'\'s\' LIMIT 21'),
+            'SELECT "a" FROM "t1" WHERE "b" IN (...) AND "c" = ? LIMIT ?')
+
+    def test_logs_attributed_queries_and_reports_by_total_time(self):
+        with override_settings(SLOW_QUERY_MS=0, SLOW_QUERY_LOG=self.log):
+            self.client.get('/contracts/')
+            self.client.get('/contracts/')
+        with override_settings(SLOW_QUERY_MS=None, SLOW_QUERY_LOG=self.log):
+            self.client.get('/users/self/')
+        entries = list(slowlog.read_entries(self.log))
+        views = {entry['view'] for entry in entries}
+        self.assertEqual(views, {'ContractCaseViewSet.list'})
+        listing = [entry for entry in entries
+                   if 'dispute_resolution_contractcase' in entry['sql']
+                   and entry['sql'].startswith('SELECT')]
+        self.assertTrue(listing)
+        # reads do not know their row count when they return
+        self.assertFalse([entry for entry in listing if 'rows' in entry])
+        self.assertTrue(all(frame.startswith('dispute_resolution/')
+                            for entry in entries for frame in entry['stack']))
+        self.assertTrue(any(entry['stack'] for entry in entries))
+
+        out = io.StringIO()
+        call_command('slow_queries', self.log, json=True, stdout=out)
+        groups = json.loads(out.getvalue())
+        self.assertEqual(sum(group['count'] for group in groups),
+                         len(entries))
+        self.assertEqual([group['total_ms'] for group in groups],
+                         sorted((group['total_ms'] for group in groups),
+                                reverse=True))
+        listing_group, = [group for group in groups if group['fingerprint']
+                          == listing[0]['fingerprint']]
+        self.assertEqual(listing_group['count'], 2)
+
+        open(self.log, 'w').close()
+        with override_settings(SLOW_QUERY_MS=0, SLOW_QUERY_LOG=self.log):
+            ContractCase.objects.update(name='renamed')
+        update, = slowlog.read_entries(self.log)
+        self.assertEqual(update['rows'], 1)
+
+
+class SlowQueryConnectionTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        alice = User.objects.create(email='alice@example.com')
+        make_case([alice])
+        self.client.force_login(alice)
+
+    def test_reconnecting_within_requests_leaves_no_wrappers(self):
+        wrappers = []
+
+        def serve():
+            conn = connections['default']
+            for _ in range(3):
+                self.client.get('/contracts/')
+                wrappers.append(list(conn.execute_wrappers))
+                # a real close, as after every request with CONN_MAX_AGE=0;
+                # that of the in-memory test database does nothing
+                BaseDatabaseWrapper.close(conn)
+
+        # the connection of a new thread opens within the request
+        thread = threading.Thread(target=serve)
+        thread.start()
+        thread.join()
+        self.assertEqual(wrappers, [[slowlog.slow_query_wrapper]] * 3)
+
+
+class OptimisticConcurrencyTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com')
+        self.case = make_case([self.alice])
+        self.stage = self.case.stages.get()
+        self.client.force_login(self.alice)
+
+    def test_stale_save_raises_instead_of_overwriting(self):
+        stale = ContractCase.objects.get(pk=self.case.pk)
+        self.case.name = 'first'
+        self.case.save()
+        self.assertEqual(self.case.version, 2)
+        stale.finished = 2
+        with self.assertRaises(ConcurrentUpdateError):
+            stale.save()
+        self.assertEqual(stale.version, 1)
+        self.case.refresh_from_db()
+        self.assertEqual((self.case.name, self.case.finished), ('first', 0))
+
+        save_with_retry(stale, lambda case: setattr(case, 'finished', 2))
+        self.case.refresh_from_db()
+        self.assertEqual(
+            (self.case.name, self.case.finished, self.case.version),
+            ('first', 2, 3))
+
+    def test_if_match_and_conflicts_on_stage_updates(self):
+        path = '/stages/{}/'.format(self.stage.pk)
+        self.assertEqual(self.client.get(path)['ETag'], '"1"')
+        today = datetime.date.today().isoformat()
+        response = self.client.patch(path, {'dispute_started': today},
+                                     content_type='application/json',
+                                     HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"2"')
+        response = self.client.patch(path, {'dispute_finished': today},
+                                     content_type='application/json',
+                                     HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 412)
+
+        stale = ContractStage.objects.get(pk=self.stage.pk)
+        ContractStage.objects.get(pk=self.stage.pk).save()
+        with mock.patch('dispute_resolution.viewsets.ContractStageViewSet'
+                        '.get_object', return_value=stale):
+            response = self.client.patch(path, {'dispute_finished': today},
+                                         content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.stage.refresh_from_db()
+        self.assertEqual((self.stage.dispute_finished, self.stage.version),
+                         (None, 3))
+
+    def test_admin_conflicts_show_the_form_again_with_the_edits(self):
+        staff = User.objects.create(email='staff@example.com', staff=True)
+        self.client.force_login(staff)
+        path = '/admin/dispute_resolution/contractcase/{}/change/'.format(
+            self.case.pk)
+        response = self.client.get(path)
+        data = {}
+        forms = [response.context['adminform'].form]
+        for inline in response.context['inline_admin_formsets']:
+            forms += [inline.formset.management_form] + inline.formset.forms
+        for form in forms:
+            for name in form.fields:
+                value = form[name].value()
+                if value is not None:
+                    data[form.add_prefix(name)] = value
+
+        self.case.name = 'theirs'
+        self.case.save()
+        data['name'] = 'mine'
+        response = self.client.post(path, data)
+        self.assertEqual(response.status_code, 200)
+        form = response.context['adminform'].form
+        self.assertEqual(form['name'].value(), 'mine')
+        self.assertIn('changed by someone else', str(form.non_field_errors()))
+        self.case.refresh_from_db()
+        self.assertEqual((self.case.name, self.case.version), ('theirs', 2))
+
+        data['version'] = 2
+        response = self.client.post(path, data)
+        self.assertEqual(response.status_code, 302)
+        self.case.refresh_from_db()
+        self.assertEqual((self.case.name, self.case.version), ('mine', 3))
+
+
+@override_settings(JOBS_ASYNC=False)
+class CaseCountersTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.cases = [make_case([self.alice, self.bob], 'case {}'.format(i))
+                      for i in range(3)]
+        self.client.force_login(self.alice)
+
+    def test_counters_follow_parties_states_and_disputes(self):
+        self.assertEqual(counters.counters(self.alice), {
+            'open': 3, 'pending': 0, 'finished': 0, 'disputes': 0})
+        case = self.cases[0]
+        case.finished = 1
+        case.save()
+        stage = self.cases[1].stages.get()
+        stage.dispute_started = datetime.date.today()
+        stage.save()
+        self.assertEqual(counters.counters(self.bob), {
+            'open': 2, 'pending': 1, 'finished': 0, 'disputes': 1})
+        stage.dispute_finished = datetime.date.today()
+        stage.save()
+        self.cases[2].party.remove(self.bob)
+        self.assertEqual(counters.counters(self.bob), {
+            'open': 1, 'pending': 1, 'finished': 0, 'disputes': 0})
+        self.bob.contracts.clear()
+        self.cases[0].delete()
+        self.assertEqual(counters.counters(self.bob)['open'], 0)
+        self.assertEqual(counters.counters(self.alice), {
+            'open': 2, 'pending': 0, 'finished': 0, 'disputes': 0})
+
+    def test_overview_in_two_indexed_queries(self):
+        self.client.get('/users/self/overview/')
+        with CaptureAllQueries() as queries:
+            data = self.client.get('/users/self/overview/').data
+        self.assertEqual(data['counters']['open'], 3)
+        self.assertEqual([case['id'] for case in data['recent']],
+                         [case.pk for case in reversed(self.cases)])
+        # the session, then the counters and recent cases
+        self.assertEqual(len(queries), 3)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries[-1]['sql'])
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('contractcase_party_user_case_idx', plan)
+
+
+class SessionTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com')
+        self.alice.set_password('secret')
+        self.alice.save()
+        self.path = '/users/{}/'.format(self.alice.pk)
+
+    def _login(self):
+        self.client = self.client_class()
+        self.client.force_login(self.alice)
+        self.client.get(self.path)
+
+    @override_settings(SESSION_ENGINE='dispute_resolution.sessions',
+                       SESSION_WRITE_BEHIND_DELAY=60)
+    def test_cached_sessions_are_written_behind(self):
+        self._login()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.path).status_code, 200)
+
+        session = self.client.session
+        session['theme'] = 'dark'
+        session.save()
+        stored = Session.objects.get(session_key=session.session_key)
+        self.assertNotIn('theme', stored.get_decoded())
+        sessions.writer.flush()
+        stored = Session.objects.get(session_key=session.session_key)
+        self.assertEqual(stored.get_decoded()['theme'], 'dark')
+
+        self.alice.set_password('changed')
+        self.alice.save()
+        self.assertEqual(self.client.get('/users/self/').status_code, 401)
+
+    def test_requests_get_their_own_copy_of_the_user(self):
+        self._login()
+        request = RequestFactory().get(self.path)
+        request.session = self.client.session
+        first = get_session_user(request)
+        with self.assertNumQueries(0):
+            second = get_session_user(request)
+        self.assertEqual(second.pk, self.alice.pk)
+        second.name = 'Mallory'
+        self.assertEqual(get_session_user(request).name, first.name)
+
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions_need_no_queries(self):
+        self._login()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.path).status_code, 200)
+        self.assertFalse(Session.objects.exists())
+
+
+job_calls = []
+
+
+@jobs.task(name='tests.record')
+def record_job(value):
+    job_calls.append(value)
+
+
+@jobs.task(name='tests.fail', max_attempts=2)
+def failing_job():
+    raise RuntimeError('boom')
+
+
+@override_settings(JOBS_ASYNC=True)
+class JobQueueTests(ShardedTestCase):
+    def setUp(self):
+        job_calls.clear()
+
+    def test_due_jobs_run_by_priority(self):
+        jobs.enqueue('tests.record', 'low')
+        jobs.enqueue('tests.record', 'high', priority=5)
+        later = jobs.enqueue('tests.record', 'later', delay=60)
+        jobs.work(once=True)
+        self.assertEqual(job_calls, ['high', 'low'])
+        self.assertEqual(list(Job.objects.values_list('pk', flat=True)),
+                         [later.pk])
+        self.assertIsNone(jobs.claim('w1'))
+
+    def test_failed_jobs_back_off_then_stay_failed(self):
+        job = jobs.enqueue('tests.fail')
+        with self.assertLogs('dispute_resolution.jobs', 'ERROR'):
+            jobs.work(once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('boom', job.last_error)
+        Job.objects.update(run_after=timezone.now())
+        with self.assertLogs('dispute_resolution.jobs', 'ERROR'):
+            jobs.work(once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+
+    def test_jobs_are_claimed_once_and_stale_ones_requeued(self):
+        job = jobs.enqueue('tests.record', 1)
+        self.assertEqual(jobs.claim('w1').pk, job.pk)
+        self.assertIsNone(jobs.claim('w2'))
+        self.assertEqual(jobs.requeue_stale(), 0)
+        Job.objects.update(locked_at=timezone.now() - datetime.timedelta(
+            seconds=settings.JOBS_LOCK_TIMEOUT + 1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.claim('w2').locked_by, 'w2')
+
+        # the second attempt was the last one
+        Job.objects.update(max_attempts=2, locked_at=timezone.now() -
+                           datetime.timedelta(
+                               seconds=settings.JOBS_LOCK_TIMEOUT + 1))
+        self.assertEqual(jobs.requeue_stale(), 0)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIn('lost', job.last_error)
+
+    def test_counters_are_refreshed_by_workers(self):
+        alice = User.objects.create(email='alice@example.com')
+        make_case([alice])
+        self.assertEqual(counters.counters(alice)['open'], 0)
+        call_command('run_workers', processes=0, once=True)
+        self.assertEqual(counters.counters(alice)['open'], 1)
+        self.assertFalse(Job.objects.exists())
+
+
+class EventShardingTests(ShardedTestCase):
+    # the sharded test needs shard databases: DRM_EVENT_SHARDS=3
+    shards = ['default', 'events_1', 'events_2']
+
+    @override_settings(EVENT_SHARDS=shards)
+    def test_users_are_spread_over_shards(self):
+        placed = [sharding.shard_for(user_id) for user_id in range(1, 601)]
+        for alias in self.shards:
+            self.assertGreater(placed.count(alias), 150)
+        self.assertEqual(placed, [sharding.shard_for(user_id)
+                                  for user_id in range(1, 601)])
+        with self.settings(EVENT_SHARDS=['default']):
+            self.assertEqual(sharding.shard_for(7), 'default')
+
+    @override_settings(EVENT_SHARDS=shards)
+    def test_router(self):
+        router = sharding.EventShardRouter()
+        shard = sharding.shard_for(7)
+        self.assertEqual(router.db_for_write(
+            EventReceipt, instance=EventReceipt(user_id=7)), shard)
+        self.assertEqual(router.db_for_read(
+            EventWatermark, instance=User(pk=7)), shard)
+        self.assertIsNone(router.db_for_read(EventReceipt))
+        self.assertIsNone(router.db_for_read(ContractCase,
+                                             instance=User(pk=7)))
+        self.assertTrue(router.allow_migrate(
+            'events_1', 'dispute_resolution', 'eventreceipt'))
+        self.assertFalse(router.allow_migrate(
+            'events_1', 'dispute_resolution', 'contractcase'))
+        self.assertFalse(router.allow_migrate('events_1', 'auth'))
+        self.assertFalse(router.allow_migrate(
+            'other', 'dispute_resolution', 'eventwatermark'))
+        self.assertIsNone(router.allow_migrate(
+            'default', 'dispute_resolution', 'contractcase'))
+
+    @skipIf(len(settings.EVENT_SHARDS) < 2, 'needs DRM_EVENT_SHARDS > 1')
+    def test_seen_state_is_kept_on_the_shard_of_the_user(self):
+        users, placed = [], set()
+        while len(placed) < 2:
+            user = User.objects.create(
+                email='user{}@example.com'.format(len(users)))
+            users.append(user)
+            placed.add(sharding.shard_for(user.pk))
+        admin = User.objects.create(email='admin@example.com', admin=True)
+        case = make_case(users)
+        first, second = [NotifyEvent.objects.create(
+            contract=case, stage=case.stages.get(), user_by=admin,
+            audience=NotifyEvent.TO_PARTIES) for _ in range(2)]
+
+        for user in users:
+            feeds.mark_seen(user, [second.pk])
+        for user in users:
+            for alias in settings.EVENT_SHARDS:
+                self.assertEqual(EventReceipt.objects.using(alias).filter(
+                    user_id=user.pk).exists(),
+                    alias == sharding.shard_for(user.pk))
+            self.assertEqual(list(feeds.unseen(user)), [first])
+        stats = sharding.shard_stats()
+        self.assertEqual(sum(counts['receipts']
+                             for counts in stats.values()), len(users))
+
+        for user in users:
+            feeds.mark_seen(user, [first.pk])
+            self.assertEqual(feeds.watermark(user), second.pk)
+        self.assertEqual(sum(queryset.count() for queryset
+                             in EventReceipt.objects.scatter()), 0)
+
+        # rows left on another shard, e.g. after adding one, are moved
+        user = users[0]
+        home = sharding.shard_for(user.pk)
+        other = next(alias for alias in settings.EVENT_SHARDS
+                     if alias != home)
+        EventWatermark.objects.for_user(user.pk).delete()
+        EventWatermark.objects.using(other).create(user_id=user.pk,
+                                                   event_id=first.pk)
+        self.assertEqual(sharding.rebalance(), 1)
+        self.assertEqual(feeds.watermark(user), first.pk)
+
+        # users[0] owns the stage
+        user = users[-1]
+        user_id = user.pk
+        user.delete()
+        self.assertFalse(EventWatermark.objects.for_user(user_id).exists())
+
+
+class UserCacheTests(ShardedTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com',
+                                         name='Alice')
+        self.info = UserInfo.objects.create(user=self.alice,
+                                            eth_account='0x0a')
+        self.bob = User.objects.create(email='bob@example.com')
+        self.case = make_case([self.alice, self.bob])
+        self.client.force_login(self.alice)
+        # warm up, then only the session is loaded
+        for path in self._paths() + ('/contracts/',):
+            self.client.get(path)
+
+    def _paths(self):
+        return ('/users/{}/'.format(self.alice.pk),
+                '/userinfo/{}/'.format(self.info.pk))
+
+    def test_repeated_renders_do_not_hit_the_database(self):
+        for path in self._paths():
+            with CaptureAllQueries() as queries:
+                self.assertEqual(self.client.get(path).status_code, 200)
+            self.assertEqual(len(queries), 1, path)
+        # the session, cases, stages and party ids; no users
+        with self.assertNumQueries(4):
+            response = self.client.get('/contracts/')
+        self.assertEqual([user['name'] for user in response.data[0][
+            'in_party']], ['Alice', ''])
+        self.assertEqual(self.client.get('/users/0/').status_code, 404)
+
+    def test_saves_and_deletes_invalidate(self):
+        self.info.organization_name = 'ACME'
+        self.info.save()
+        for path in self._paths():
+            data = self.client.get(path).data
+            self.assertEqual(data.get('organization_name') or
+                             data['info']['organization_name'], 'ACME')
+        carol = User.objects.create(email='carol@example.com')
+        path = '/users/{}/'.format(carol.pk)
+        self.assertEqual(self.client.get(path).status_code, 200)
+        carol.delete()
+        self.assertEqual(self.client.get(path).status_code, 404)
+
+
+@override_settings(FILTER_PLAN_CHECK=False)
+class FilterPolicyTests(ShardedTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        filters.PolicyFilterBackend.checked_shapes.clear()
+        self.user = User.objects.create(email='user@example.com',
+                                        name='Some', judge=True)
+        UserInfo.objects.create(user=self.user, eth_account='0x01')
+        self.client.force_login(self.user)
+
+    def test_only_declared_lookups_are_accepted(self):
+        self.assertEqual(len(self.client.get(
+            '/userinfo/', {'eth_account': '0x01'}).data), 1)
+        self.assertEqual(len(self.client.get(
+            '/users/', {'email__in': 'user@example.com'}).data), 1)
+        for path, params in (('/users/', {'name__icontains': 'o'}),
+                             ('/contracts/', {'party__email': 'x'}),
+                             ('/userinfo/', {'files__contains': 'ab'})):
+            response = self.client.get(path, params)
+            self.assertEqual(response.status_code, 400, params)
+        # parameters that are no filters are left alone
+        self.assertEqual(self.client.get(
+            '/users/', {'format': 'json'}).status_code, 200)
+
+    def test_cost_limits(self):
+        response = self.client.get('/events/', {'contract__in': ','.join(
+            str(pk) for pk in range(101))})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/events/', {
+            'contract': 1, 'stage': 1, 'user_by': 1, 'user_to': 1,
+            'contract!': 2})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(FILTER_EXPENSIVE_RATE='2/min')
+    def test_expensive_filters_are_rate_limited(self):
+        for _ in range(2):
+            self.assertEqual(self.client.get(
+                '/users/', {'judge': 'true'}).status_code, 200)
+        self.assertEqual(self.client.get(
+            '/users/', {'judge': 'true'}).status_code, 429)
+        self.assertEqual(self.client.get(
+            '/users/', {'name': 'Some'}).status_code, 200)
+
+    @override_settings(FILTER_PLAN_CHECK=True)
+    def test_full_scans_are_logged_once_per_shape(self):
+        with mock.patch.object(filters.logger, 'warning') as warning:
+            self.client.get('/users/', {'name': 'Some'})
+            warning.assert_not_called()
+            self.client.get('/users/', {'judge': 'true'})
+            self.client.get('/users/', {'judge': 'false'})
+        self.assertEqual(warning.call_count, 1)
+        self.assertIn('judge', warning.call_args[0][2])
+
+
+# Data scales (number of cases and users) the endpoint budgets are checked
+# at; override with e.g. DRM_BENCH_SCALES=1000,10000 for a full run.
+BENCH_SCALES = [int(scale) for scale in
+                os.environ.get('DRM_BENCH_SCALES', '10,50').split(',')]
+BENCH_LATENCY_FACTOR = float(os.environ.get('DRM_BENCH_LATENCY_FACTOR', '1'))
+BENCH_REPORT = os.environ.get('DRM_BENCH_REPORT')
+BENCH_REPEAT = int(os.environ.get('DRM_BENCH_REPEAT', '3'))
+
+
+class EndpointBudgetTests(ShardedTestCase):
+    """
+    Times every router endpoint and admin changelist at several data scales
+    and fails when a scenario exceeds its query or latency budget. Query
+    budgets must not depend on the scale; latency budgets are a fixed part
+    plus a per-case part for the unpaginated list endpoints.
+    """
+    # name, method, path, max queries, base ms, ms per case; queries are
+    # counted on the first request, i.e. with a cold user cache
+    SCENARIOS = (
+        ('users-list', 'get', '/users/', 1, 200, 5),
+        ('users-detail', 'get', '/users/{user}/', 1, 100, 0),
+        ('users-self', 'get', '/users/self/', 4, 100, 0),
+        ('users-contracts', 'get', '/users/{user}/contracts/', 5, 100, 0),
+        ('contracts-list', 'get', '/contracts/', 4, 200, 10),
+        ('contracts-detail', 'get', '/contracts/{case}/', 4, 100, 0),
+        ('stages-list', 'get', '/stages/', 1, 200, 5),
+        ('stages-detail', 'get', '/stages/{stage}/', 1, 100, 0),
+        ('userinfo-list', 'get', '/userinfo/', 1, 200, 5),
+        ('userinfo-detail', 'get', '/userinfo/{info}/', 1, 100, 0),
+        ('events-list', 'get', '/events/', 3, 200, 5),
+        ('events-detail', 'get', '/events/{event}/', 3, 100, 0),
+        ('events-create', 'post', '/events/', 10, 200, 0),
+        ('admin-users', 'get', '/admin/dispute_resolution/user/',
+         3, 1000, 0),
+        ('admin-cases', 'get', '/admin/dispute_resolution/contractcase/',
+         5, 1000, 0),
+        ('admin-stages', 'get', '/admin/dispute_resolution/contractstage/',
+         3, 1000, 0),
+        ('admin-events', 'get', '/admin/dispute_resolution/notifyevent/',
+         3, 1000, 0),
+    )
+
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@example.com',
+                                         name='Admin', family_name='Admin',
+                                         admin=True, staff=True)
+        UserInfo.objects.create(user=self.admin, eth_account='0xadmin')
+        self.results = []
+
+    def tearDown(self):
+        if BENCH_REPORT:
+            with open(BENCH_REPORT, 'a') as report:
+                for result in self.results:
+                    report.write(json.dumps(result) + '\n')
+
+    def _fixture_ids(self):
+        case = ContractCase.objects.order_by('id').first()
+        user = case.party.order_by('id').first()
+        stage = case.stages.order_by('id').first()
+        event = NotifyEvent.objects.feed(user).first()
+        return {'case': case.id, 'user': user.id, 'info': user.info.id,
+                'stage': stage.id, 'event': event.id,
+                'eth_account': user.info.eth_account}
+
+    def _run(self, scale, scenario, ids):
+        name, method, path, max_queries, base_ms, per_case_ms = scenario
+        client = self.client
+        client.force_login(self.admin if method == 'post' or
+                           name.startswith('admin') else
+                           User.objects.get(pk=ids['user']))
+        kwargs = {}
+        if method == 'post':
+            kwargs = {'content_type': 'application/json',
+                      'data': json.dumps({'contract': ids['case'],
+                                          'stage_num': 0,
+                                          'event_type': 'open',
+                                          'address_by': ids['eth_account']})}
+        with CaptureAllQueries() as queries:
+            response = getattr(client, method)(path.format(**ids), **kwargs)
+        # the session and user lookups of the test login are not part of
+        # the endpoint's own budget
+        num_queries = len(queries) - 2
+        # best of a few runs, so a stray pause does not fail the budget
+        elapsed_ms = float('inf')
+        for _ in range(BENCH_REPEAT):
+            start = perf_counter()
+            getattr(client, method)(path.format(**ids), **kwargs)
+            elapsed_ms = min(elapsed_ms, (perf_counter() - start) * 1000)
+        budget_ms = (base_ms + per_case_ms * scale) * BENCH_LATENCY_FACTOR
+        self.results.append({'scenario': name, 'scale': scale,
+                             'queries': num_queries,
+                             'ms': round(elapsed_ms, 3)})
+        self.assertLess(response.status_code, 300, name)
+        self.assertLessEqual(num_queries, max_queries,
+                             '{} at scale {}'.format(name, scale))
+        self.assertLessEqual(elapsed_ms, budget_ms,
+                             '{} at scale {}'.format(name, scale))
+
+    def test_endpoint_budgets(self):
+        for scale in BENCH_SCALES:
+            savepoint = transaction.savepoint()
+            seed(users=scale, cases=scale, random_seed=scale)
+            ids = self._fixture_ids()
+            for scenario in self.SCENARIOS:
+                with self.subTest(scenario=scenario[0], scale=scale):
+                    self._run(scale, scenario, ids)
+            transaction.savepoint_rollback(savepoint)
@@ -0,0 +1,87 @@
+"""
+Chronological timeline of a case: its stages and the caller's events.
+
+Timeline entries are ordered by the key ``(timestamp, kind, id)``; a stage
+sits at midnight of its start date, ahead of events of the same instant.
+A page is built by two range scans over the timeline indexes, each from
+the cursor on and of at most ``limit + 1`` rows, merged in Python, so the
+cost of a page does not depend on the size of the case.
+"""
+import base64
+import datetime
+import heapq
+from itertools import islice
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dispute_resolution.models import NotifyEvent
+
+
+STAGE, EVENT = 0, 1
+KINDS = {STAGE: 'stage', EVENT: 'event'}
+
+
+def stage_time(stage):
+    return timezone.make_aware(
+        datetime.datetime.combine(stage.start, datetime.time.min))
+
+
+def encode_cursor(key):
+    timestamp, kind, pk = key
+    raw = '{}|{}|{}'.format(timestamp.isoformat(), kind, pk)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the key encoded in ``cursor``; ValueError if malformed."""
+    try:
+        timestamp, kind, pk = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split('|')
+        timestamp, kind, pk = parse_datetime(timestamp), int(kind), int(pk)
+    except ValueError:
+        raise ValueError(cursor)
+    if timestamp is None or timezone.is_naive(timestamp) or \
+            kind not in KINDS:
+        raise ValueError(cursor)
+    return timestamp, kind, pk
+
+
+def _stages_after(stages, key):
+    timestamp, kind, pk = key
+    day = timezone.localtime(timestamp).date()
+    if kind == EVENT:
+        # the midnight of that day is not after the event
+        return stages.filter(start__gt=day)
+    return stages.filter(start__gte=day).exclude(start=day, pk__lte=pk)
+
+
+def _events_after(events, key):
+    timestamp, kind, pk = key
+    if kind == STAGE:
+        return events.filter(creation_date__gte=timestamp)
+    return events.filter(creation_date__gte=timestamp) \
+        .exclude(creation_date=timestamp, pk__lte=pk)
+
+
+def case_timeline(case, user, cursor=None, limit=50):
+    """
+    Return up to ``limit`` ``(key, object)`` entries of the timeline of
+    ``case`` as seen by ``user``, following ``cursor`` (a key), and the key
+    to continue from, or None on the last page.
+    """
+    stages = case.stages.order_by('start', 'pk')
+    events = NotifyEvent.objects.feed(user).filter(contract=case) \
+        .order_by('creation_date', 'pk')
+    if cursor is not None:
+        stages = _stages_after(stages, cursor)
+        events = _events_after(events, cursor)
+
+    entries = heapq.merge(
+        (((stage_time(stage), STAGE, stage.pk), stage)
+         for stage in stages[:limit + 1]),
+        (((event.creation_date, EVENT, event.pk), event)
+         for event in events[:limit + 1]))
+    page = list(islice(entries, limit + 1))
+    next_key = page[limit - 1][0] if len(page) > limit else None
+    return page[:limit], next_key
@@ -0,0 +1,167 @@
+"""
+Background verification of dispute result files.
+
+When a dispute is closed the stage records the hash reported from the
+chain and is marked ``pending``; ``schedule_verification`` then queues a
+``verify_stage`` job (see ``jobs``), or without ``JOBS_ASYNC`` hands the
+stage to a small thread pool, which streams the stored file in chunks,
+computes its sha256 and keccak-256 digests and sets
+``result_verification`` to ``verified``, ``mismatch`` or ``missing``.
+Digests are cached by file identity (device, inode, size, mtime), so a
+file shared by several stages is read once.
+
+keccak-256 (the Ethereum hash) needs ``pycryptodome`` (a requirement) or
+``pysha3``; without either only sha256 hashes can be verified and a hash
+matching no sha256 is ``unverifiable`` rather than a ``mismatch``.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from dispute_resolution.blobstore import blob_refs, get_store
+from dispute_resolution.jobs import enqueue, task
+from dispute_resolution.models import ContractStage
+
+try:
+    from Crypto.Hash import keccak as _keccak
+
+    def keccak_256():
+        return _keccak.new(digest_bits=256)
+except ImportError:  # pragma: no cover - depends on the environment
+    try:
+        from sha3 import keccak_256
+    except ImportError:
+        keccak_256 = None
+
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+
+class DigestCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            digests = self._entries.get(key)
+            if digests is not None:
+                self._entries.move_to_end(key)
+            return digests
+
+    def put(self, key, digests):
+        with self._lock:
+            self._entries[key] = digests
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+digest_cache = DigestCache(getattr(settings, 'VERIFICATION_CACHE_SIZE', 1024))
+
+
+def file_digests(path):
+    """Return ``{'sha256': ..., 'keccak256': ...}`` hex digests of a file."""
+    stat = os.stat(path)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    digests = digest_cache.get(key)
+    if digests is not None:
+        return digests
+
+    hashers = {'sha256': hashlib.sha256()}
+    if keccak_256 is not None:
+        hashers['keccak256'] = keccak_256()
+    with open(path, 'rb') as stream:
+        while True:
+            chunk = stream.read(READ_SIZE)
+            if not chunk:
+                break
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    digests = {name: hasher.hexdigest() for name, hasher in hashers.items()}
+    digest_cache.put(key, digests)
+    return digests
+
+
+def normalize_hash(value):
+    value = (value or '').strip().lower()
+    return value[2:] if value.startswith('0x') else value
+
+
+@task(max_attempts=3)
+def verify_stage(stage_id):
+    """Check a stage's result file against its recorded hash."""
+    stage = ContractStage.objects.filter(pk=stage_id) \
+        .values('result_file', 'result_hash').first()
+    if stage is None or not stage['result_hash']:
+        return None
+
+    expected = normalize_hash(stage['result_hash'])
+    store = get_store()
+    paths = [store.path(digest) for digest in blob_refs(stage['result_file'])]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        result = 'missing'
+    elif any(expected in file_digests(path).values() for path in paths):
+        result = 'verified'
+    elif keccak_256 is None:
+        # it may be the keccak-256 of the file, which cannot be computed
+        result = 'unverifiable'
+    else:
+        result = 'mismatch'
+
+    # only record the outcome if the hash was not replaced meanwhile
+    ContractStage.objects.filter(pk=stage_id,
+                                 result_hash=stage['result_hash']) \
+        .update(result_verification=result,
+                result_verified_at=timezone.now(),
+                version=F('version') + 1)
+    logger.info('Result file of stage %s: %s', stage_id, result)
+    return result
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.VERIFICATION_WORKERS,
+                thread_name_prefix='drm-verify')
+        return _executor
+
+
+def _verify_in_worker(stage_id):
+    close_old_connections()
+    try:
+        verify_stage(stage_id)
+    except Exception:
+        logger.exception('Verification of stage %s failed', stage_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_verification(stage_id):
+    """
+    Verify a stage in a background job, in the worker pool without
+    ``JOBS_ASYNC``, or inline when not async.
+    """
+    if not settings.VERIFICATION_ASYNC:
+        return verify_stage(stage_id)
+    if not settings.JOBS_ASYNC:
+        _get_executor().submit(_verify_in_worker, stage_id)
+        return None
+    enqueue('verify_stage', stage_id)
@@ -1,3 +1,295 @@
-from django.shortcuts import render
+import re
 
-# Create your views here.
+import coreapi
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_GET
+from rest_framework import exceptions, status
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.renderers import CoreJSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_swagger.renderers import OpenAPIRenderer, \
+    SwaggerUIRenderer
+
+from dispute_resolution import export, metrics, profiling
+from dispute_resolution.authentication import issue_token
+from dispute_resolution.blobstore import BlobTooLarge, count_refs, \
+    get_store
+from dispute_resolution.models import Blob
+from dispute_resolution.permissions import AdminPermission, BlobPermission
+from dispute_resolution.schema import code_version, get_schema, \
+    schema_audience
+from dispute_resolution.serializers import TokenObtainSerializer
+
+
+@require_GET
+def metrics_view(request):
+    """Prometheus scrape endpoint for the per-request histograms."""
+    return HttpResponse(metrics.render_prometheus(),
+                        content_type='text/plain; version=0.0.4')
+
+
+class ObtainTokenView(APIView):
+    """
+    Exchanges email and password for a bearer token. This is the only
+    place the password hash is checked; later requests send
+    ``Authorization: Bearer <token>``.
+    """
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+    serializer_class = TokenObtainSerializer
+
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data,
+                                           context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        return Response({'token': issue_token(
+                             serializer.validated_data['user']),
+                         'expires_in': settings.TOKEN_MAX_AGE})
+
+
+class BlobUploadView(APIView):
+    """
+    Stores the raw request body in the blob store and returns its sha256.
+    The body is hashed and written in chunks, never held in memory;
+    uploading content that is already stored only returns its digest.
+    An ``X-Content-SHA256`` header, when sent, must match the content.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        if request.stream is None:
+            return Response({'errors': {'body': 'Empty body.'}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        store = get_store()
+        try:
+            digest, size = store.save(request.stream)
+        except BlobTooLarge:
+            return Response({'errors': {'body': 'File is too large.'}},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        # fields may name a blob before it is uploaded
+        _, created = Blob.objects.get_or_create(
+            sha256=digest, defaults={'size': size,
+                                     'refcount': count_refs(digest)})
+        expected = request.META.get('HTTP_X_CONTENT_SHA256')
+        if expected and expected.lower() != digest:
+            # the file is left to gc_blobs: deleting it here would race
+            # with a concurrent upload of the same content
+            return Response({'errors': {'body': 'Checksum mismatch.'}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {'sha256': digest, 'size': size},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+            headers={'Location': reverse('blob-detail', args=(digest,))})
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Return ``(start, length)`` for a single byte range, or None when the
+    header should be ignored (malformed or several ranges). Raises
+    ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError(header)
+        return size - length, length
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+
+class BlobDetailView(APIView):
+    """
+    Streams a stored blob with constant memory. Supports ``Range`` /
+    ``If-Range`` for partial downloads and ``If-None-Match``; blobs never
+    change, so the digest is a strong ETag and responses are immutable.
+    Only users a referencing case, stage or user info is visible to may
+    read a blob (see ``BlobPermission``).
+    """
+    permission_classes = (BlobPermission,)
+
+    def perform_content_negotiation(self, request, force=False):
+        # the body is the file itself whatever the client accepts
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, digest):
+        store = get_store()
+        blob = Blob.objects.filter(pk=digest).first()
+        if blob is None or not store.exists(digest):
+            return Response({'errors': {'blob': 'Not found.'}},
+                            status=status.HTTP_404_NOT_FOUND)
+
+        etag = '"{}"'.format(digest)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if if_none_match.strip() == '*' or etag in if_none_match:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            return response
+
+        start, length = 0, blob.size
+        partial = False
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if range_header and (not if_range or if_range.strip() == etag):
+            try:
+                byte_range = parse_range(range_header, blob.size)
+            except ValueError:
+                response = HttpResponse(
+                    status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = 'bytes */{}'.format(blob.size)
+                return response
+            if byte_range is not None:
+                (start, length), partial = byte_range, True
+
+        response = StreamingHttpResponse(
+            store.iter_range(digest, start, length),
+            status=status.HTTP_206_PARTIAL_CONTENT if partial
+            else status.HTTP_200_OK,
+            content_type='application/octet-stream')
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        if partial:
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, start + length - 1, blob.size)
+        return response
+
+
+class CaseExportView(APIView):
+    """
+    Streams all cases with their stages, party accounts and events as JSON
+    lines (``type=jsonl``) or CSV (``type=csv``), gzipped with ``gzip=1``.
+    Only cases after ``since`` are exported, plus, with ``stages_since`` or
+    ``events_since``, older cases with newer stages or events;
+    ``X-Export-Until``, ``X-Export-Stages-Until`` and
+    ``X-Export-Events-Until`` are these parameters of the next incremental
+    export.
+    """
+    permission_classes = (AdminPermission,)
+
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request):
+        fmt = request.query_params.get('type', 'jsonl')
+        if fmt not in export.FORMATS:
+            return Response({'errors': {'type': 'Unknown export type.'}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        marks = {}
+        for name in ('since', 'stages_since', 'events_since'):
+            value = request.query_params.get(name)
+            try:
+                marks[name] = None if value is None else int(value)
+            except ValueError:
+                return Response({'errors': {name: 'Invalid id.'}},
+                                status=status.HTTP_400_BAD_REQUEST)
+        since = marks.pop('since') or 0
+        gzip = request.query_params.get('gzip') in ('1', 'true')
+
+        until = export.export_until()
+        stages_until, events_until = export.changes_until()
+        filename = 'cases-{}-{}.{}'.format(since, until, fmt)
+        response = StreamingHttpResponse(
+            export.encode(export.iter_cases(since, until, **marks), fmt,
+                          gzip),
+            content_type='application/gzip' if gzip
+            else export.FORMATS[fmt])
+        response['Content-Disposition'] = 'attachment; filename="{}{}"' \
+            .format(filename, '.gz' if gzip else '')
+        response['X-Export-Until'] = str(until)
+        response['X-Export-Stages-Until'] = str(stages_until)
+        response['X-Export-Events-Until'] = str(events_until)
+        return response
+
+
+class ProfileListView(APIView):
+    """The stored request profiles, newest first (admins only)."""
+    permission_classes = (AdminPermission,)
+
+    def get(self, request):
+        return Response(profiling.list_profiles())
+
+
+class ProfileDetailView(APIView):
+    """
+    A stored profile: the request, its SQL and the top ``limit`` functions
+    sorted by ``sort``; ``raw=1`` downloads the pstats file.
+    """
+    permission_classes = (AdminPermission,)
+
+    def get(self, request, profile_id):
+        try:
+            meta = profiling.load_profile(profile_id)
+        except FileNotFoundError:
+            return Response({'errors': {'profile': 'Not found.'}},
+                            status=status.HTTP_404_NOT_FOUND)
+        if request.query_params.get('raw') in ('1', 'true'):
+            return FileResponse(
+                open(profiling.profile_path(profile_id), 'rb'),
+                as_attachment=True, filename=profile_id + '.prof')
+
+        sort = request.query_params.get('sort', 'cumulative')
+        try:
+            limit = int(request.query_params.get('limit', 50))
+        except ValueError:
+            limit = None
+        if sort not in profiling.STATS_SORT_KEYS or not limit or limit < 1:
+            return Response({'errors': {'sort': 'Invalid sort or limit.'}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        meta['stats'] = profiling.render_stats(profile_id, sort, limit)
+        return Response(meta)
+
+
+class SchemaView(APIView):
+    """
+    Swagger UI and the CoreJSON / OpenAPI schema of the API. The schema is
+    generated once per code version (see ``dispute_resolution.schema``);
+    the JSON formats carry an ETag so polling clients mostly get a 304.
+    """
+    _ignore_model_permissions = True
+    exclude_from_schema = True
+    permission_classes = (AllowAny,)
+    renderer_classes = (CoreJSONRenderer, OpenAPIRenderer, SwaggerUIRenderer)
+
+    def get(self, request):
+        audience = schema_audience(request.user)
+        etag = None
+        # the Swagger UI page shows the user and a CSRF token
+        if request.accepted_renderer.format != 'swagger':
+            etag = '"{}-{}-{}"'.format(code_version(), audience,
+                                       request.accepted_renderer.format)
+            if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+                response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+                response['ETag'] = etag
+                return response
+
+        schema = get_schema(audience)
+        if not schema:
+            raise exceptions.ValidationError(
+                'The schema generator did not return a schema Document')
+        response = Response(coreapi.Document(
+            url=request.build_absolute_uri(), title=schema.title,
+            description=schema.description, content=schema.data))
+        if etag is not None:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'no-cache'
+        # the listed endpoints depend on the user
+        patch_vary_headers(response, ('Authorization', 'Cookie'))
+        return response
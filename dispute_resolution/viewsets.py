@@ -1,115 +1,367 @@
+import codecs
+
+from django.conf import settings
+from django.db.models import Q
 from rest_framework import viewsets, status
+from rest_framework.exceptions import APIException, NotFound, \
+    ValidationError
 from rest_framework.authentication import SessionAuthentication, \
     BasicAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from url_filter.integrations.drf import DjangoFilterBackend
-
+from dispute_resolution import counters, feeds
+from dispute_resolution.authentication import BearerTokenAuthentication
+from dispute_resolution.db import run_serialized_write
+from dispute_resolution.filters import PolicyFilterBackend
+from dispute_resolution.importers import import_users, read_rows
 from dispute_resolution.models import User, ContractCase, ContractStage, \
-    NotifyEvent, UserInfo
-from dispute_resolution.permissions import CasePermission, \
-    NotificationPermission, StagePermission, UserInfoPermission, UserPermission
+    NotifyEvent, UserInfo, ConcurrentUpdateError
+from dispute_resolution.permissions import AdminPermission, CasePermission, \
+    NotificationPermission, StagePermission, UserInfoPermission, \
+    UserPermission, scope_cases
 from dispute_resolution.serializers import UserSerializer, \
     ContractCaseSerializer, ContractStageSerializer, NotifyEventSerializer, \
-    UserInfoSerializer
+    UserInfoSerializer, party_prefetch, user_cache, user_info_cache
+from dispute_resolution.timeline import EVENT, KINDS, case_timeline, \
+    decode_cursor, encode_cursor
+
+
+def case_queryset():
+    """Contract cases with everything ContractCaseSerializer renders."""
+    return ContractCase.objects.prefetch_related('stages', party_prefetch())
+
+
+class CachedRetrieveMixin:
+    """
+    Serves ``retrieve`` from ``object_cache``. Reading is allowed to every
+    user passing ``has_permission``, so there is no object to check.
+    Filters in the query string still go through the database.
+    """
+    object_cache = None
+
+    def retrieve(self, request, *args, **kwargs):
+        if request.query_params:
+            return super().retrieve(request, *args, **kwargs)
+        try:
+            data = self.object_cache.get(
+                int(kwargs[self.lookup_url_kwarg or self.lookup_field]))
+        except ValueError:
+            data = None
+        if data is None:
+            raise NotFound()
+        return Response(data)
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource has changed, reload it.'
+    default_code = 'precondition_failed'
+
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The resource was changed concurrently, reload it.'
+    default_code = 'conflict'
+
+
+def version_etag(version):
+    return '"{}"'.format(version)
+
+
+class VersionedUpdateMixin:
+    """
+    Optimistic concurrency for ``VersionedModel`` resources: details carry
+    the version as ``ETag``, updates with an ``If-Match`` header not
+    matching the current version fail with 412, and updates losing a race
+    to another writer fail with 409 instead of overwriting its change.
+    """
 
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        response['ETag'] = version_etag(response.data['version'])
+        return response
 
-class UserViewSet(viewsets.ModelViewSet):
+    def update(self, request, *args, **kwargs):
+        response = super().update(request, *args, **kwargs)
+        response['ETag'] = version_etag(response.data['version'])
+        return response
+
+    def perform_update(self, serializer):
+        if_match = self.request.META.get('HTTP_IF_MATCH')
+        if if_match is not None and if_match.strip() != '*':
+            tags = {tag.strip() for tag in if_match.split(',')}
+            # weak comparison: W/"3" matches "3"
+            tags = {tag[2:] if tag.startswith('W/') else tag for tag in tags}
+            if version_etag(serializer.instance.version) not in tags:
+                raise PreconditionFailed()
+        try:
+            serializer.save()
+        except ConcurrentUpdateError:
+            raise Conflict()
+
+
+class UserViewSet(CachedRetrieveMixin, viewsets.ModelViewSet):
     """
     A viewset that provides the standard actions
     """
-    filter_backends = [DjangoFilterBackend]
+    filter_backends = [PolicyFilterBackend]
     filter_fields = ['name', 'family_name', 'email', 'judge']
+    indexed_filters = {'email': ('exact', 'in'), 'name': ('exact',),
+                       'family_name': ('exact',)}
+    expensive_filters = {'judge': ('exact',)}
 
-    queryset = User.objects.all()
+    queryset = User.objects.select_related('info')
     serializer_class = UserSerializer
+    object_cache = user_cache
 
     permission_classes = (UserPermission,)
 
     @action(methods=['get'], detail=True)
     def contracts(self, request, pk=None):
         user = self.get_object()
-        return Response([ContractCaseSerializer(contract).data
-                         for contract in user.contracts.all()])
+        contracts = scope_cases(case_queryset().filter(party=user),
+                                request.user)
+        return Response(ContractCaseSerializer(contracts, many=True).data)
+
+    @action(methods=['post'], detail=False,
+            permission_classes=[AdminPermission])
+    def bulk(self, request):
+        """
+        Import users from a JSON list, CSV (``text/csv``) or JSON lines
+        body. Invalid and duplicate rows are reported, the rest is created.
+        """
+        if request.content_type.startswith('application/json'):
+            rows = request.data
+            if not isinstance(rows, list):
+                return Response({'errors': {'body': 'Expected a list.'}},
+                                status=status.HTTP_400_BAD_REQUEST)
+        else:
+            fmt = 'csv' if request.content_type.startswith('text/csv') \
+                else 'jsonl'
+            rows = read_rows(codecs.iterdecode(request.stream, 'utf-8'), fmt)
+        report = import_users(rows,
+                              processes=settings.USER_IMPORT_PROCESSES)
+        return Response(report)
 
     @action(methods=['get'], detail=False)
     def self(self, request):
+        """
+        The caller and their unseen events; with ``digest=1`` the events
+        are grouped by case and event type, see ``events/unseen`` for the
+        events of a group.
+        """
         if request.user.is_authenticated:
-            user = UserSerializer(self.request.user)
-            return Response({
-                'self': user.data,
-                'events': [
-                    NotifyEventSerializer(event).data
-                    for event in NotifyEvent.objects.filter(
-                        seen=False,
-                        user_to__in=[self.request.user]
-                    ).all()
-                ]
-            })
+            if request.query_params.get('digest') in ('1', 'true'):
+                events = {'digest': list(feeds.unseen_digest(request.user))}
+            else:
+                events = {'events': NotifyEventSerializer(
+                    feeds.unseen(request.user), many=True,
+                    context={'recipient': request.user, 'seen': set()}
+                ).data}
+            return Response(dict(self=user_cache.get(request.user.pk),
+                                 **events))
         else:
             return Response({'errors': {'auth': 'You are not authorized'}},
                             status=401)
 
+    @action(methods=['get'], detail=False, url_path='self/overview',
+            permission_classes=[IsAuthenticated])
+    def overview(self, request):
+        """
+        The caller's numbers of open, pending and finished cases and of
+        active disputes, and their ``OVERVIEW_RECENT_CASES`` newest cases.
+        """
+        recent = ContractCase.objects.filter(party=request.user) \
+            .order_by('-pk').values('id', 'name', 'finished', 'version')
+        return Response({
+            'counters': counters.counters(request.user),
+            'recent': list(recent[:settings.OVERVIEW_RECENT_CASES]),
+        })
 
-class ContractCaseViewSet(viewsets.ModelViewSet):
+
+class ContractCaseViewSet(VersionedUpdateMixin, viewsets.ModelViewSet):
     """
     A viewset that provides the standard actions
     """
-    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    authentication_classes = (BearerTokenAuthentication,
+                              SessionAuthentication, BasicAuthentication)
     permission_classes = (IsAuthenticated, CasePermission)
 
     ordering_fields = ('id', 'finished', 'party')
     ordering = ('finished',)
 
-    filter_backends = [DjangoFilterBackend]
+    filter_backends = [PolicyFilterBackend]
     filter_fields = ['party', 'files', 'finished']
+    indexed_filters = {'party': ('exact', 'in')}
+    expensive_filters = {'files': ('exact',), 'finished': ('exact',)}
 
-    queryset = ContractCase.objects.all()
+    queryset = case_queryset()
     serializer_class = ContractCaseSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'timeline':
+            # the timeline pages through the stages itself
+            queryset = queryset.prefetch_related(None)
+        return scope_cases(queryset, self.request.user)
+
+    def get_serializer(self, *args, **kwargs):
+        # POST /contracts/ also accepts a list of cases for bulk creation
+        if isinstance(kwargs.get('data'), list):
+            kwargs['many'] = True
+        return super().get_serializer(*args, **kwargs)
+
+    @action(methods=['get'], detail=True)
+    def timeline(self, request, pk=None):
+        """
+        The case's stages and the caller's events in chronological order,
+        ``limit`` entries at a time; pass ``next`` as ``cursor`` to get the
+        following page.
+        """
+        case = self.get_object()
+        try:
+            limit = min(int(request.query_params.get('limit', 50)),
+                        settings.TIMELINE_MAX_LIMIT)
+            if limit < 1:
+                raise ValueError(limit)
+        except ValueError:
+            return Response({'errors': {'limit': 'Invalid limit.'}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        cursor = request.query_params.get('cursor')
+        try:
+            cursor = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            return Response({'errors': {'cursor': 'Invalid cursor.'}},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-class ContractStageViewSet(viewsets.ModelViewSet):
+        entries, next_key = case_timeline(case, request.user, cursor, limit)
+        context = {'recipient': request.user, 'seen': feeds.seen_ids(
+            request.user, [pk for (_, kind, pk), event in entries
+                           if kind == EVENT])}
+        return Response({
+            'results': [{
+                'type': KINDS[kind],
+                'timestamp': timestamp,
+                'data': NotifyEventSerializer(obj, context=context).data
+                if kind == EVENT else ContractStageSerializer(obj).data,
+            } for (timestamp, kind, _), obj in entries],
+            'next': encode_cursor(next_key) if next_key else None,
+        })
+
+
+class ContractStageViewSet(VersionedUpdateMixin, viewsets.ModelViewSet):
     """
     A viewset that provides the standard actions
     """
-    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    authentication_classes = (BearerTokenAuthentication,
+                              SessionAuthentication, BasicAuthentication)
     permission_classes = (IsAuthenticated, StagePermission)
 
-    filter_backends = [DjangoFilterBackend]
+    filter_backends = [PolicyFilterBackend]
     filter_fields = ['owner', 'dispute_starter']
+    indexed_filters = {'owner': ('exact', 'in'),
+                       'dispute_starter': ('exact', 'in')}
 
     queryset = ContractStage.objects.all()
     serializer_class = ContractStageSerializer
 
+    def get_queryset(self):
+        return scope_cases(super().get_queryset(), self.request.user,
+                           case_ref='contract_id')
+
 
 class NotifyEventViewSet(viewsets.ModelViewSet):
     """
     A viewset that provides the standard actions
     """
-    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    authentication_classes = (BearerTokenAuthentication,
+                              SessionAuthentication, BasicAuthentication)
     permission_classes = (IsAuthenticated, NotificationPermission)
 
-    filter_backends = [DjangoFilterBackend]
-    filter_fields = ['user_to', 'user_by', 'contract', 'stage']
+    filter_backends = [PolicyFilterBackend]
+    filter_fields = ['user_by', 'contract', 'stage']
+    view_filters = ['user_to']
+    indexed_filters = {'user_to': ('exact', 'in'), 'user_by': ('exact', 'in'),
+                       'contract': ('exact', 'in'), 'stage': ('exact', 'in')}
 
     serializer_class = NotifyEventSerializer
 
     def get_queryset(self):
-        return NotifyEvent.objects.filter(user_to=self.request.user).all()
+        return NotifyEvent.objects.feed(self.request.user)
+
+    def filter_queryset(self, queryset):
+        """
+        Also filters by ``user_to`` as the serializer shows it: events to
+        the parties are stored without one and shown to the caller with
+        their own id.
+        """
+        queryset = super().filter_queryset(queryset)
+        for param in ('user_to', 'user_to__in'):
+            if param not in self.request.query_params:
+                continue
+            try:
+                ids = {int(value) for value in
+                       self.request.query_params[param].split(',')}
+            except ValueError:
+                raise ValidationError({param: ['Enter a whole number.']})
+            rules = Q(user_to__in=ids)
+            if self.request.user.pk in ids:
+                rules |= Q(user_to__isnull=True)
+            queryset = queryset.filter(rules)
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action != 'create':
+            context['recipient'] = self.request.user
+        return context
+
+    @action(methods=['get'], detail=False)
+    def unseen(self, request):
+        """
+        The caller's unseen events, optionally only those of one
+        ``contract`` and ``event_type`` (a group of the digest).
+        """
+        events = feeds.unseen(request.user)
+        if 'contract' in request.query_params:
+            try:
+                events = events.filter(
+                    contract=int(request.query_params['contract']))
+            except ValueError:
+                return Response({'errors': {'contract': 'Invalid case.'}},
+                                status=status.HTTP_400_BAD_REQUEST)
+        if 'event_type' in request.query_params:
+            events = events.filter(
+                event_type=request.query_params['event_type'])
+        context = dict(self.get_serializer_context(), seen=set())
+        return Response(NotifyEventSerializer(events, many=True,
+                                              context=context).data)
+
+    @action(methods=['post'], detail=False)
+    def seen(self, request):
+        """Mark all events of the caller seen."""
+        run_serialized_write(feeds.mark_all_seen, request.user)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class UserInfoViewSet(viewsets.ModelViewSet):
+class UserInfoViewSet(CachedRetrieveMixin, viewsets.ModelViewSet):
     """
     A viewset that provides the standard actions
     """
-    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    authentication_classes = (BearerTokenAuthentication,
+                              SessionAuthentication, BasicAuthentication)
     permission_classes = (IsAuthenticated, UserInfoPermission)
 
-    filter_backends = [DjangoFilterBackend]
-    filter_fields = ['eth_address', 'organization_name', 'tax_num',
+    filter_backends = [PolicyFilterBackend]
+    filter_fields = ['eth_account', 'organization_name', 'tax_num',
                      'payment_num', 'user', 'files']
+    indexed_filters = {'eth_account': ('exact', 'in'), 'user': ('exact', 'in')}
+    expensive_filters = {'organization_name': ('exact',),
+                         'tax_num': ('exact',), 'payment_num': ('exact',),
+                         'files': ('exact',)}
 
     queryset = UserInfo.objects.all()
     serializer_class = UserInfoSerializer
+    object_cache = user_info_cache
@@ -0,0 +1,21 @@
+"""
+ASGI config for drm_server project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``, to be served by any ASGI server, e.g.::
+
+    uvicorn drm_server.asgi:application
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "drm_server.settings")
+
+# sets Django up, so it has to come first
+wsgi_application = get_wsgi_application()
+
+from dispute_resolution.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler(wsgi_application)
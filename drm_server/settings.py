@@ -44,16 +44,44 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'dispute_resolution.middleware.MetricsMiddleware',
+    'dispute_resolution.middleware.ProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'dispute_resolution.middleware.SessionUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Opt-in request profiler (DRM_PROFILER=1, see dispute_resolution.profiling):
+# requests sending DRM_PROFILER_SECRET as X-Profile header or _profile
+# parameter, and a PROFILER_SAMPLE_RATE share of all requests, are profiled
+# into a ring of the newest PROFILER_MAX_PROFILES in PROFILER_DIR. When off,
+# the middleware drops out of the chain.
+PROFILER_ENABLED = os.environ.get('DRM_PROFILER') == '1'
+PROFILER_SECRET = os.environ.get('DRM_PROFILER_SECRET')
+PROFILER_SAMPLE_RATE = float(os.environ.get('DRM_PROFILER_SAMPLE_RATE', '0'))
+PROFILER_DIR = os.environ.get('DRM_PROFILER_DIR',
+                              os.path.join(BASE_DIR, 'profiles'))
+PROFILER_MAX_PROFILES = 100
+PROFILER_MAX_QUERIES = 1000
+
+# Statements taking at least SLOW_QUERY_MS (DRM_SLOW_QUERY_MS, off when
+# unset) are logged to SLOW_QUERY_LOG with the view and our innermost
+# SLOW_QUERY_STACK_DEPTH frames; "manage.py slow_queries" aggregates them.
+SLOW_QUERY_MS = float(os.environ['DRM_SLOW_QUERY_MS']) \
+    if os.environ.get('DRM_SLOW_QUERY_MS') else None
+SLOW_QUERY_LOG = os.environ.get('DRM_SLOW_QUERY_LOG',
+                                os.path.join(BASE_DIR, 'slow_queries.jsonl'))
+SLOW_QUERY_STACK_DEPTH = 5
+
+# Per-request X-DB-Queries / X-DB-Time / X-Serializer-Time /
+# X-Response-Time headers; histograms are served from /metrics regardless.
+METRICS_DEBUG_HEADERS = DEBUG
+
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_METHODS = (
     'DELETE',
@@ -107,6 +135,42 @@ DATABASES = {
     }
 }
 
+# Opt-in production profile for single-node SQLite deployments
+# (DRM_SQLITE_PRODUCTION=1): WAL journal so readers never block on the
+# writer, persistent connections, and one serialized writer per process
+# for event ingestion (disable with DRM_SQLITE_WRITER=0).
+SQLITE_PRODUCTION = os.environ.get('DRM_SQLITE_PRODUCTION') == '1'
+
+SQLITE_PRAGMAS = {}
+SQLITE_SERIALIZED_WRITER = False
+
+if SQLITE_PRODUCTION:
+    DATABASES['default']['CONN_MAX_AGE'] = None
+    DATABASES['default']['OPTIONS'] = {'timeout': 30}
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # in KiB when negative
+        'busy_timeout': 30000,
+    }
+    SQLITE_SERIALIZED_WRITER = os.environ.get('DRM_SQLITE_WRITER', '1') == '1'
+
+# Event receipts and watermarks are spread by user over EVENT_SHARDS (see
+# dispute_resolution.sharding). DRM_EVENT_SHARDS=N adds N - 1 SQLite files
+# next to the default database; create their tables with
+# "manage.py migrate --database events_<n>", move rows after changing the
+# number of shards with "manage.py event_shards --rebalance".
+EVENT_SHARDS = ['default']
+for num in range(1, int(os.environ.get('DRM_EVENT_SHARDS', 1))):
+    alias = 'events_{}'.format(num)
+    DATABASES[alias] = dict(
+        DATABASES['default'],
+        NAME=os.path.join(BASE_DIR, '{}.sqlite3'.format(alias)))
+    EVENT_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['dispute_resolution.sharding.EventShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -151,6 +215,7 @@ AUTH_USER_MODEL = 'dispute_resolution.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
+        'dispute_resolution.authentication.BearerTokenAuthentication',
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
@@ -158,3 +223,121 @@ REST_FRAMEWORK = {
         'django_filters.rest_framework.DjangoFilterBackend',
     )
 }
+
+# Filter policy of the API views (see dispute_resolution.filters).
+FILTER_MAX_TERMS = 4
+FILTER_MAX_IN_VALUES = 100
+FILTER_EXPENSIVE_RATE = '30/min'
+FILTER_PLAN_CHECK = True
+
+# Bearer tokens issued by /auth/token/ (seconds); verified tokens are kept
+# in a per-process LRU of TOKEN_CACHE_SIZE entries for TOKEN_CACHE_TTL.
+TOKEN_MAX_AGE = 7 * 24 * 60 * 60
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+
+# Sessions (DRM_SESSIONS): "db", "cache" (local cache, written to the
+# database SESSION_WRITE_BEHIND_DELAY seconds after a change, see
+# dispute_resolution.sessions) or "signed_cookies". The user of a session
+# is memoized per process like bearer tokens.
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cache': 'dispute_resolution.sessions',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_ENGINES[os.environ.get('DRM_SESSIONS', 'db')]
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_WRITE_BEHIND_DELAY = 5
+SESSION_USER_CACHE_SIZE = 10000
+SESSION_USER_CACHE_TTL = 60
+
+# Password hashing processes used by users/bulk (None: all cores,
+# 0: hash inline in the request thread).
+USER_IMPORT_PROCESSES = None
+
+# Content-addressed store for case, user-info and dispute result files.
+BLOB_STORE_ROOT = os.environ.get('DRM_BLOB_STORE_ROOT',
+                                 os.path.join(BASE_DIR, 'blobs'))
+BLOB_CHUNK_SIZE = 64 * 1024
+BLOB_MAX_SIZE = 16 * 1024 ** 3
+
+# Saves of cases and stages fail with ConcurrentUpdateError (HTTP 409) when
+# the row changed since it was loaded; event ingestion reloads and reapplies
+# its change up to CONCURRENT_UPDATE_ATTEMPTS times.
+CONCURRENT_UPDATE_ATTEMPTS = 3
+
+# Newest cases listed by users/self/overview next to the case counters.
+OVERVIEW_RECENT_CASES = 10
+
+# Background jobs (see dispute_resolution.jobs). With DRM_JOBS_ASYNC=1
+# they are rows of the Job table and ONLY run while "manage.py run_workers"
+# is running next to the server; otherwise they run inline when queued,
+# except result verification, which then uses a thread pool of the server
+# process. Failed jobs are retried after JOBS_BACKOFF * 2 ** (attempt - 1)
+# seconds (at most JOBS_BACKOFF_MAX), jobs left running by a dead worker
+# are queued again after JOBS_LOCK_TIMEOUT seconds, or fail once they had
+# their attempts.
+JOBS_ASYNC = os.environ.get('DRM_JOBS_ASYNC') == '1'
+JOBS_WORKERS = 2
+JOBS_POLL_INTERVAL = 1.0
+JOBS_MAX_ATTEMPTS = 5
+JOBS_BACKOFF = 2
+JOBS_BACKOFF_MAX = 10 * 60
+JOBS_LOCK_TIMEOUT = 10 * 60
+
+# Dispute result files are hashed by a background job (a thread pool of
+# VERIFICATION_WORKERS without JOBS_ASYNC); set VERIFICATION_ASYNC to False
+# to verify inline.
+VERIFICATION_ASYNC = True
+VERIFICATION_WORKERS = 2
+VERIFICATION_CACHE_SIZE = 1024
+
+# Threads of the ASGI application (drm_server.asgi) running views and the
+# WSGI fallback; 0 runs them inline on the event loop.
+ASGI_THREADS = 32
+
+# The API schema is generated once per code version: SCHEMA_VERSION (e.g.
+# the deployed revision) or else a hash of the sources. Precomputed
+# schemas (manage.py build_schema) are kept in SCHEMA_CACHE_DIR.
+SCHEMA_VERSION = os.environ.get('DRM_CODE_VERSION')
+SCHEMA_CACHE_DIR = os.environ.get('DRM_SCHEMA_CACHE_DIR',
+                                  os.path.join(BASE_DIR, 'schema_cache'))
+
+# Largest page of contracts/{id}/timeline.
+TIMELINE_MAX_LIMIT = 500
+
+# Serialized users and user infos are cached per object version (see
+# dispute_resolution.objectcache). DRM_OBJECT_CACHE picks the backend:
+# locmem (per process), file (shared by the processes of a host) or
+# memcached at DRM_MEMCACHED_LOCATION.
+OBJECT_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'drm-objects',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('DRM_OBJECT_CACHE_DIR',
+                                   os.path.join(BASE_DIR, 'object_cache')),
+    },
+    'memcached': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ.get('DRM_MEMCACHED_LOCATION',
+                                   '127.0.0.1:11211'),
+    },
+}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'objects': OBJECT_CACHE_BACKENDS[
+        os.environ.get('DRM_OBJECT_CACHE', 'locmem')],
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'drm-sessions',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+OBJECT_CACHE_ALIAS = 'objects'
+OBJECT_CACHE_TIMEOUT = 60 * 60
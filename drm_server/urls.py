@@ -16,13 +16,13 @@ Including another URLconf
 from django.conf.urls import url
 from django.contrib import admin
 from rest_framework import routers
-from rest_framework_swagger.views import get_swagger_view
 
+from dispute_resolution.views import metrics_view, ObtainTokenView, \
+    BlobUploadView, BlobDetailView, CaseExportView, ProfileDetailView, \
+    ProfileListView, SchemaView
 from dispute_resolution.viewsets import UserViewSet, NotifyEventViewSet, \
     UserInfoViewSet, ContractStageViewSet, ContractCaseViewSet
 
-schema_view = get_swagger_view(title='Dispute Resolution API')
-
 router = routers.SimpleRouter()
 router.register(r'users', UserViewSet)
 router.register(r'contracts', ContractCaseViewSet)
@@ -33,5 +33,14 @@ urlpatterns = router.urls
 
 urlpatterns += [
     url(r'^admin/', admin.site.urls),
-    url(r'^$', schema_view),
+    url(r'^metrics$', metrics_view, name='metrics'),
+    url(r'^auth/token/$', ObtainTokenView.as_view(), name='auth-token'),
+    url(r'^blobs/$', BlobUploadView.as_view(), name='blob-upload'),
+    url(r'^blobs/(?P<digest>[0-9a-f]{64})/$', BlobDetailView.as_view(),
+        name='blob-detail'),
+    url(r'^export/cases/$', CaseExportView.as_view(), name='export-cases'),
+    url(r'^profiles/$', ProfileListView.as_view(), name='profile-list'),
+    url(r'^profiles/(?P<profile_id>\d{20}-[0-9a-f]{8})/$',
+        ProfileDetailView.as_view(), name='profile-detail'),
+    url(r'^$', SchemaView.as_view(), name='schema'),
 ]